@@ -0,0 +1,272 @@
+import asyncio
+import openai
+import time
+from collections import deque
+from pydantic import BaseModel
+from typing import Optional, List, AsyncIterator, Deque, Dict, Tuple
+
+from config import logger
+
+
+class NoBackendAvailable(Exception):
+    """Все AI-бэкенды недоступны (автоматы разомкнуты или попытки исчерпаны)."""
+
+
+class BackendSettings(BaseModel):
+    """Один OpenAI-совместимый сервер со своей моделью."""
+    name: str
+    base_url: str
+    model_name: str
+    api_key: Optional[str] = None
+
+
+class Backend:
+    """
+    AI-бэкенд со статистикой и автоматом (circuit breaker). Задержка - время до первого фрагмента ответа;
+    по ней и по доле ошибок считаются EWMA. После failure_threshold ошибок подряд автомат размыкается на
+    cooldown секунд, затем пропускает один пробный запрос (half-open): успех замыкает автомат, ошибка
+    размыкает снова.
+    """
+
+    LATENCY_ALPHA = 0.3
+    ERROR_ALPHA = 0.2
+
+    def __init__(self, settings: BackendSettings, client: openai.AsyncOpenAI, failure_threshold: int = 3,
+                 cooldown: float = 30.0):
+        self.name = settings.name
+        self.model_name = settings.model_name
+        self.client = client
+        self.failure_threshold = failure_threshold
+        self.cooldown = cooldown
+        self.state = "closed"
+        self.consecutive_failures = 0
+        self.opened_at = 0.0
+        self.probing = False
+        self.latency_ewma: Optional[float] = None
+        self.error_ewma = 0.0
+        self.latencies: Deque[float] = deque(maxlen=200)
+        self.in_flight = 0
+        self.requests = 0
+        self.failures = 0
+        self.hedges_won = 0
+
+    def available(self) -> bool:
+        if self.state == "open" and time.monotonic() - self.opened_at >= self.cooldown:
+            self.state = "half_open"
+            logger.info(f"AI-бэкенд {self.name}: пробный запрос после {self.cooldown:.0f} с паузы")
+        if self.state == "half_open":
+            return not self.probing
+        return self.state == "closed"
+
+    def score(self) -> float:
+        """Оценка для маршрутизации: меньше - лучше. Бэкенд без замеров пробуется первым."""
+        if self.latency_ewma is None:
+            return 0.0
+        return self.latency_ewma * (1 + 4 * self.error_ewma)
+
+    def p95(self) -> Optional[float]:
+        if len(self.latencies) < 20:
+            return None
+        ordered = sorted(self.latencies)
+        return ordered[int(len(ordered) * 0.95) - 1]
+
+    def acquire(self):
+        self.in_flight += 1
+        self.requests += 1
+        if self.state == "half_open":
+            self.probing = True
+
+    def release(self):
+        self.in_flight -= 1
+        self.probing = False
+
+    def abandon(self):
+        """
+        Попытка отменена до ответа (победил другой бэкенд или запрос больше не нужен). Если это был пробный
+        запрос, его исход неизвестен: автомат снова размыкается и через cooldown пропустит новую пробу.
+        """
+        if self.state == "half_open" and self.probing:
+            self.state = "open"
+            self.opened_at = time.monotonic()
+
+    def record_success(self, latency: float):
+        self.latencies.append(latency)
+        self.latency_ewma = latency if self.latency_ewma is None else \
+            self.LATENCY_ALPHA * latency + (1 - self.LATENCY_ALPHA) * self.latency_ewma
+        self.error_ewma *= 1 - self.ERROR_ALPHA
+        self.consecutive_failures = 0
+        if self.state != "closed":
+            logger.info(f"AI-бэкенд {self.name} снова доступен")
+        self.state = "closed"
+
+    def record_failure(self, error: BaseException):
+        self.failures += 1
+        self.error_ewma = self.ERROR_ALPHA + (1 - self.ERROR_ALPHA) * self.error_ewma
+        self.consecutive_failures += 1
+        if self.state == "half_open" or self.consecutive_failures >= self.failure_threshold:
+            if self.state != "open":
+                logger.warning(f"AI-бэкенд {self.name} отключен на {self.cooldown:.0f} с после "
+                               f"{self.consecutive_failures} ошибок подряд: {error}")
+            self.state = "open"
+            self.opened_at = time.monotonic()
+
+    async def deltas(self, messages: list, stream: bool, **params) -> AsyncIterator[str]:
+        """Фрагменты ответа модели; без потокового режима - весь ответ одним фрагментом."""
+        if stream:
+            response = await self.client.chat.completions.create(model=self.model_name, messages=messages,
+                stream=True, **params)
+            try:
+                async for chunk in response:
+                    if not chunk.choices:
+                        continue
+                    delta = chunk.choices[0].delta.content
+                    if delta:
+                        yield delta
+            finally:
+                await response.close()
+        else:
+            response = await self.client.chat.completions.create(model=self.model_name, messages=messages, **params)
+            yield response.choices[0].message.content or ""
+
+    def stats(self) -> dict:
+        p95 = self.p95()
+        return {"model": self.model_name, "state": self.state, "in_flight": self.in_flight,
+            "requests": self.requests, "failures": self.failures, "hedges_won": self.hedges_won,
+            "latency_ms_ewma": self.latency_ewma * 1000 if self.latency_ewma is not None else None,
+            "latency_ms_p95": p95 * 1000 if p95 is not None else None, "error_rate_ewma": self.error_ewma}
+
+
+Attempt = Tuple[Backend, AsyncIterator[str], str]
+
+
+class BackendPool:
+    """
+    Маршрутизация запросов по нескольким бэкендам: выбирается доступный бэкенд с лучшей оценкой
+    (EWMA задержки с поправкой на ошибки). Если бэкенд упал до первого фрагмента ответа, запрос уходит
+    на следующий. При hedging=True, если первый фрагмент не пришел за p95 задержки бэкенда (не меньше
+    hedge_min_delay), параллельно запускается запрос на другой бэкенд; побеждает ответивший первым,
+    второй запрос отменяется.
+    """
+
+    def __init__(self, backends: List[Backend], hedging: bool = False, hedge_min_delay: float = 1.0):
+        self.backends = backends
+        self.hedging = hedging
+        self.hedge_min_delay = hedge_min_delay
+        self.hedges = 0
+        self.failovers = 0
+
+    def _pick(self, exclude: List[Backend]) -> Optional[Backend]:
+        candidates = [b for b in self.backends if b not in exclude and b.available()]
+        if not candidates:
+            return None
+        return min(candidates, key=lambda b: (b.score(), b.in_flight))
+
+    def _hedge_delay(self, backend: Backend) -> float:
+        p95 = backend.p95()
+        return max(p95 if p95 is not None else 0.0, self.hedge_min_delay)
+
+    async def _first_delta(self, backend: Backend, messages: list, stream: bool, params: dict) -> Attempt:
+        """Открывает запрос и ждет первый фрагмент. Возвращает (бэкенд, генератор, первый фрагмент)."""
+        started = time.perf_counter()
+        gen = backend.deltas(messages, stream, **params)
+        try:
+            first = await gen.__anext__()
+        except StopAsyncIteration:
+            first = ""
+        except BaseException:
+            await gen.aclose()
+            raise
+        backend.record_success(time.perf_counter() - started)
+        return backend, gen, first
+
+    async def complete(self, messages: list, stream: bool = True, **params) -> AsyncIterator[str]:
+        """Фрагменты ответа с выбором бэкенда, переключением при ошибке и hedging."""
+        tried: List[Backend] = []
+        pending: Dict[asyncio.Task, Backend] = {}
+        last_error: Optional[BaseException] = None
+        hedge_at: Optional[float] = None
+        hedge: Optional[Backend] = None
+
+        def start(backend: Backend):
+            nonlocal hedge_at
+            tried.append(backend)
+            backend.acquire()
+            pending[asyncio.create_task(self._first_delta(backend, messages, stream, params))] = backend
+            hedge_at = time.monotonic() + self._hedge_delay(backend) if self.hedging and hedge is None else None
+
+        winner: Optional[Attempt] = None
+        try:
+            while winner is None:
+                if not pending:
+                    backend = self._pick(tried)
+                    if backend is None:
+                        raise last_error or NoBackendAvailable("Нет доступных AI-бэкендов")
+                    if tried:
+                        self.failovers += 1
+                        logger.warning(f"Запрос к AI переключен на бэкенд {backend.name}")
+                    start(backend)
+
+                timeout = max(hedge_at - time.monotonic(), 0) if hedge_at is not None else None
+                done, _ = await asyncio.wait(pending, timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+                if not done:
+                    hedge_at = None
+                    backend = self._pick(tried)
+                    if backend is not None:
+                        hedge = backend
+                        self.hedges += 1
+                        logger.info(f"Дублирующий запрос к AI-бэкенду {backend.name}")
+                        start(backend)
+                    continue
+
+                for task in done:
+                    backend = pending.pop(task)
+                    try:
+                        attempt = task.result()
+                    except Exception as e:
+                        backend.release()
+                        backend.record_failure(e)
+                        last_error = e
+                        logger.error(f"Ошибка AI-бэкенда {backend.name}: {e}")
+                        continue
+                    if winner is None:
+                        winner = attempt
+                    else:
+                        backend.release()
+                        await attempt[1].aclose()
+        finally:
+            for task, backend in pending.items():
+                if not task.done():
+                    task.cancel()
+                    backend.abandon()
+                elif not task.cancelled() and task.exception() is not None:
+                    backend.record_failure(task.exception())
+                elif not task.cancelled():
+                    # Попытка успела получить первый фрагмент уже после выбора победителя: закрываем ее поток
+                    try:
+                        await task.result()[1].aclose()
+                    except Exception as e:
+                        logger.debug(f"Не удалось закрыть лишний ответ AI-бэкенда {backend.name}: {e}")
+                backend.release()
+
+        backend, gen, first = winner
+        if backend is hedge:
+            backend.hedges_won += 1
+        try:
+            if first:
+                yield first
+            async for delta in gen:
+                yield delta
+        except Exception as e:
+            backend.record_failure(e)
+            raise
+        finally:
+            await gen.aclose()
+            backend.release()
+
+    async def close(self):
+        for backend in self.backends:
+            await backend.client.close()
+
+    def stats(self) -> dict:
+        return {"hedging": self.hedging, "hedges": self.hedges, "failovers": self.failovers,
+            "backends": {b.name: b.stats() for b in self.backends}}
@@ -1,10 +1,25 @@
 import asyncio
+import hashlib
+import httpx
+import json
 import openai
 import os
+import time
+from collections import deque
 from dotenv import load_dotenv
-from typing import Optional
+from pydantic import BaseModel
+from typing import Optional, AsyncIterator, Tuple, List, Dict, Deque, Set
 
-from config import logger, AI_MODEL_API_KEY
+from ai_backends import Backend, BackendPool, BackendSettings
+from ai_scheduler import AIScheduler
+from answer_cache import AnswerCache, normalize_question
+from chat_memory import ChatMemory
+from config import logger, AI_MODEL_API_KEY, AI_RETRIEVAL_ENABLED, AI_RETRIEVAL_TOP_K, AI_RETRIEVAL_MIN_SCORE, \
+    AI_CACHE_ENABLED, AI_CACHE_MAX_SIZE, AI_CACHE_TTL, AI_CACHE_NEAR_DUPLICATE_THRESHOLD, AI_FAQ_ENABLED, \
+    AI_FAQ_MIN_SIMILARITY, AI_CONTEXT_POLL_INTERVAL, AI_MAX_CONCURRENCY, AI_MAX_QUEUE, AI_FAQ_FALLBACK_SIMILARITY, \
+    AI_HISTORY_TOKEN_BUDGET, AI_HISTORY_SUMMARY_TOKENS, AI_HISTORY_MAX_MESSAGES, AI_HISTORY_CACHE_SIZE, \
+    AI_HISTORY_CACHE_TTL, AI_ROUTING_ENABLED, AI_ROUTER_MAX_WORDS, AI_ROUTER_FAQ_SIMILARITY
+from context_provider import ContextProvider, ContextSnapshot
 
 CONTEXT_FILE = "company_context.txt"
 AI_PROMPT_TEMPLATE = """You are a virtual assistant for the car rental service YOUR COMPANY in Belgrade. Your task is to answer customer questions using **exclusively** the **CONTEXT** provided below.
@@ -38,60 +53,525 @@ AI_PROMPT_TEMPLATE = """You are a virtual assistant for the car rental service Y
 {question}
 
 **YOUR ANSWER:**"""
-_context_cache = None
+context_provider = ContextProvider(CONTEXT_FILE, poll_interval=AI_CONTEXT_POLL_INTERVAL)
+_answer_cache = AnswerCache(max_size=AI_CACHE_MAX_SIZE, ttl=AI_CACHE_TTL,
+    near_duplicate_threshold=AI_CACHE_NEAR_DUPLICATE_THRESHOLD)
+_answer_sources = {"faq": 0, "cache": 0, "llm": 0}
+ai_scheduler = AIScheduler(max_concurrency=AI_MAX_CONCURRENCY, max_queue=AI_MAX_QUEUE)
+chat_memory = ChatMemory(token_budget=AI_HISTORY_TOKEN_BUDGET, summary_tokens=AI_HISTORY_SUMMARY_TOKENS,
+    max_messages=AI_HISTORY_MAX_MESSAGES, max_chats=AI_HISTORY_CACHE_SIZE, ttl=AI_HISTORY_CACHE_TTL)
+
+History = List[Dict[str, str]]
 
 
 def load_context() -> str:
-    global _context_cache
-    if _context_cache:
-        return _context_cache
-    try:
-        with open(CONTEXT_FILE, "r", encoding="utf-8") as f:
-            _context_cache = f.read()
-        logger.info(f"Контекст из {CONTEXT_FILE} успешно загружен.")
-        return _context_cache
-    except FileNotFoundError:
-        logger.error(f"Файл контекста {CONTEXT_FILE} не найден!")
+    """Возвращает текст текущей версии контекста. Файл читает ContextProvider, здесь диск не используется."""
+    snapshot = context_provider.snapshot
+    if snapshot is None:
         return "Контекст не загружен."
+    return snapshot.context
+
+
+def get_cached_answer(user_message: str) -> Optional[str]:
+    """Ищет готовый ответ в кэше для текущей версии контекста."""
+    snapshot = context_provider.snapshot
+    if not AI_CACHE_ENABLED or snapshot is None:
+        return None
+    started = time.perf_counter()
+    answer = _answer_cache.get(user_message, snapshot.version)
+    if answer is not None:
+        logger.info(f"Ответ AI взят из кэша за {(time.perf_counter() - started) * 1000:.2f} мс")
+    return answer
+
+
+def get_faq_answer(user_message: str, min_similarity: float = AI_FAQ_MIN_SIMILARITY) -> Optional[str]:
+    """Возвращает ответ из контекста, если сообщение почти дословно совпадает с одним из вопросов «👉»."""
+    snapshot = context_provider.snapshot
+    if not AI_FAQ_ENABLED or snapshot is None:
+        return None
+    started = time.perf_counter()
+    match = snapshot.index.faq.match(user_message, min_similarity)
+    if match is None:
+        return None
+    entry, similarity = match
+    logger.info(f"Ответ найден в FAQ (сходство {similarity:.2f}) за {(time.perf_counter() - started) * 1000:.3f} мс: "
+                f"{entry.question}")
+    return entry.answer
+
+
+async def get_chat_turns(chat_id: str, user_message: str) -> History:
+    """
+    Предыдущие реплики чата для промпта в пределах AI_HISTORY_TOKEN_BUDGET. Текущий вопрос клиента
+    (уже сохраненный в БД) в историю не входит.
+    """
+    if AI_HISTORY_TOKEN_BUDGET <= 0:
+        return []
+    try:
+        turns = await chat_memory.get_turns(chat_id)
     except Exception as e:
-        logger.error(f"Ошибка чтения файла контекста {CONTEXT_FILE}: {e}")
-        return "Ошибка загрузки контекста."
+        logger.error(f"Не удалось загрузить историю чата {chat_id} для AI: {e}")
+        return []
+    if turns and turns[-1]["role"] == "user" and turns[-1]["content"] == user_message.strip():
+        turns = turns[:-1]
+    return turns
+
+
+def get_instant_answer(user_message: str, history: Optional[History] = None) -> Optional[Tuple[str, str]]:
+    """
+    Ищет ответ, не обращаясь к модели: сначала в FAQ, затем в кэше.
+    Кэш используется только для вопросов без предыдущих реплик: ответ на уточняющий вопрос зависит от истории.
+    Возвращает пару (ответ, источник), где источник - "faq" или "cache".
+    """
+    answer = get_faq_answer(user_message)
+    if answer is not None:
+        _answer_sources["faq"] += 1
+        return answer, "faq"
+    answer = get_cached_answer(user_message) if not history else None
+    if answer is not None:
+        _answer_sources["cache"] += 1
+        return answer, "cache"
+    return None
+
+
+def get_fallback_answer(user_message: str, history: Optional[History] = None) -> Optional[Tuple[str, str]]:
+    """
+    Запасной ответ, когда модель не ответила вовремя или очередь переполнена: кэш (его мог заполнить
+    параллельный запрос) или FAQ с пониженным порогом сходства.
+    """
+    instant = get_instant_answer(user_message, history)
+    if instant is not None:
+        return instant
+    answer = get_faq_answer(user_message, AI_FAQ_FALLBACK_SIMILARITY)
+    if answer is not None:
+        _answer_sources["faq"] += 1
+        return answer, "faq"
+    return None
+
+
+def _store_answer(user_message: str, version: Optional[str], answer: str, history: Optional[History] = None):
+    _answer_sources["llm"] += 1
+    if AI_CACHE_ENABLED and version is not None and not history:
+        _answer_cache.put(user_message, version, answer)
+
 
+async def reload_ai():
+    """Принудительно перечитывает контекст и конфигурацию AI (команда администратора)."""
+    await context_provider.reload(force=True)
+    await reload_ai_config()
 
-async def get_ai_response(user_message: str) -> Optional[str]:
+
+def get_ai_stats() -> dict:
+    """Счетчики AI-подсистемы для мониторинга."""
+    return {"context": context_provider.stats(), "answer_sources": dict(_answer_sources),
+        "answer_cache": _answer_cache.stats(), "scheduler": ai_scheduler.stats(),
+        "coalescing": {**_coalescing, "in_flight": len(_inflight)}, "chat_memory": chat_memory.stats(),
+        "backends": _pool.stats() if _pool is not None else None,
+        "fast_backends": _fast_pool.stats() if _fast_pool is not None else None,
+        "routing": {"decisions": dict(_route_decisions), "routes": {name: r.stats() for name, r in _routes.items()}}}
+
+
+def select_context(question: str, snapshot: Optional[ContextSnapshot]) -> str:
+    """Подбирает для промпта только записи контекста, релевантные вопросу (или весь контекст, если таких нет)."""
+    if snapshot is None:
+        return "Контекст не загружен."
+    if not AI_RETRIEVAL_ENABLED:
+        return snapshot.context
+
+    started = time.perf_counter()
+    selected, hits = snapshot.index.select(question, AI_RETRIEVAL_TOP_K, AI_RETRIEVAL_MIN_SCORE)
+    elapsed_ms = (time.perf_counter() - started) * 1000
+    if hits:
+        logger.info(f"Поиск по контексту: {len(hits)} из {len(snapshot.index.entries)} записей, "
+                    f"лучший score {hits[0][1]:.2f}, {elapsed_ms:.2f} мс")
+    else:
+        logger.info(f"Поиск по контексту: релевантных записей нет, используется весь контекст, {elapsed_ms:.2f} мс")
+    return selected
+
+
+def _build_messages(user_message: str, history: Optional[History] = None) -> Tuple[list, Optional[str]]:
     """
-    Получает ответ от нейросети через OpenAI API.
+    Собирает сообщения для модели: системное сообщение, предыдущие реплики чата и промпт с контекстом.
+    Возвращает их вместе с версией контекста, по которой построен промпт.
     """
-    context = load_context()
+    snapshot = context_provider.snapshot
+    history = history or []
+    context = select_context(user_message, snapshot)
     prompt = AI_PROMPT_TEMPLATE.format(context=context, question=user_message)
-    logger.info(f"Запрос к AI с промптом: {prompt[:200]}...")
+    full_size = len(snapshot.context) if snapshot else 0
+    history_size = sum(len(turn["content"]) for turn in history)
+    logger.info(f"Запрос к AI: промпт {len(prompt)} символов (контекст {len(context)} из {full_size}), "
+                f"история {len(history)} реплик / {history_size} символов")
+    logger.debug(f"Промпт: {prompt[:200]}...")
+    messages = [{"role": "system", "content": "Ты - полезный ассистент VROOM."}, *history,
+        {"role": "user", "content": prompt}]
+    return messages, snapshot.version if snapshot else None
 
-    try:
-        load_dotenv(override=True)
 
-        base_url = os.getenv("OPENAI_API_BASE")
-        api_key = os.getenv("OPENAI_API_KEY")
-        model_name = os.getenv("OPENAI_MODEL_NAME")
+class AISettings(BaseModel):
+    """Параметры подключения к AI API. Читаются один раз при старте и при явной перезагрузке."""
+    backends: List[BackendSettings] = []
+    max_connections: int = 100
+    max_keepalive_connections: int = 20
+    keepalive_expiry: float = 30.0
+    connect_timeout: float = 5.0
+    read_timeout: float = 60.0
+    max_retries: int = 1
+    breaker_failures: int = 3
+    breaker_cooldown: float = 30.0
+    hedge_enabled: bool = False
+    hedge_min_delay: float = 1.0
+    fast_backends: List[BackendSettings] = []
+    main_max_tokens: int = 1000
+    fast_max_tokens: int = 250
+
+    @classmethod
+    def from_env(cls) -> "AISettings":
+        """
+        Бэкенды задаются в AI_BACKENDS списком JSON-объектов {"name", "base_url", "model_name", "api_key"};
+        без него используется один бэкенд из OPENAI_API_BASE / OPENAI_MODEL_NAME / OPENAI_API_KEY.
+        Быстрая модель для простых вопросов - AI_FAST_BACKENDS в том же формате либо AI_FAST_MODEL_NAME
+        на тех же серверах, что и основная.
+        """
+        default_key = os.getenv("OPENAI_API_KEY") or "none"
+        raw_backends = os.getenv("AI_BACKENDS", "").strip()
+        if raw_backends:
+            backends = [BackendSettings(**{"api_key": default_key, **item}) for item in json.loads(raw_backends)]
+        elif os.getenv("OPENAI_API_BASE"):
+            backends = [BackendSettings(name="default", base_url=os.getenv("OPENAI_API_BASE"),
+                model_name=os.getenv("OPENAI_MODEL_NAME") or "", api_key=default_key)]
+        else:
+            backends = []
+        raw_fast_backends = os.getenv("AI_FAST_BACKENDS", "").strip()
+        fast_model = os.getenv("AI_FAST_MODEL_NAME", "").strip()
+        if raw_fast_backends:
+            fast_backends = [BackendSettings(**{"api_key": default_key, **item})
+                for item in json.loads(raw_fast_backends)]
+        elif fast_model:
+            fast_backends = [backend.copy(update={"name": f"{backend.name}-fast", "model_name": fast_model})
+                for backend in backends]
+        else:
+            fast_backends = []
+        return cls(backends=backends, fast_backends=fast_backends,
+            main_max_tokens=int(os.getenv("AI_MAX_TOKENS", "1000")),
+            fast_max_tokens=int(os.getenv("AI_FAST_MAX_TOKENS", "250")),
+            max_connections=int(os.getenv("AI_HTTP_MAX_CONNECTIONS", "100")),
+            max_keepalive_connections=int(os.getenv("AI_HTTP_MAX_KEEPALIVE_CONNECTIONS", "20")),
+            keepalive_expiry=float(os.getenv("AI_HTTP_KEEPALIVE_EXPIRY", "30")),
+            connect_timeout=float(os.getenv("AI_HTTP_CONNECT_TIMEOUT", "5")),
+            read_timeout=float(os.getenv("AI_HTTP_READ_TIMEOUT", "60")),
+            max_retries=int(os.getenv("AI_MAX_RETRIES", "1")),
+            breaker_failures=int(os.getenv("AI_BREAKER_FAILURES", "3")),
+            breaker_cooldown=float(os.getenv("AI_BREAKER_COOLDOWN", "30")),
+            hedge_enabled=os.getenv("AI_HEDGE_ENABLED", "false").strip().lower() in ("1", "true", "yes"),
+            hedge_min_delay=float(os.getenv("AI_HEDGE_MIN_DELAY", "1.0")))
+
+
+_settings: Optional[AISettings] = None
+_pool: Optional[BackendPool] = None
+_fast_pool: Optional[BackendPool] = None
+# Отложенное закрытие пулов после /reload: ссылка нужна, иначе задачу может собрать сборщик мусора
+_closing_tasks: Set[asyncio.Task] = set()
+
+
+def _create_client(settings: AISettings, backend: BackendSettings) -> openai.AsyncOpenAI:
+    http_client = httpx.AsyncClient(
+        limits=httpx.Limits(max_connections=settings.max_connections,
+            max_keepalive_connections=settings.max_keepalive_connections, keepalive_expiry=settings.keepalive_expiry),
+        timeout=httpx.Timeout(settings.read_timeout, connect=settings.connect_timeout))
+    return openai.AsyncOpenAI(base_url=backend.base_url, api_key=backend.api_key or "none", http_client=http_client,
+        max_retries=settings.max_retries)
+
+
+def _create_pool(settings: AISettings, backend_settings: List[BackendSettings]) -> Optional[BackendPool]:
+    if not backend_settings:
+        return None
+    backends = [Backend(backend, _create_client(settings, backend), failure_threshold=settings.breaker_failures,
+        cooldown=settings.breaker_cooldown) for backend in backend_settings]
+    return BackendPool(backends, hedging=settings.hedge_enabled, hedge_min_delay=settings.hedge_min_delay)
+
+
+def _describe_backends(backends: List[BackendSettings]) -> str:
+    return ", ".join(f"{b.name} ({b.base_url}, модель {b.model_name})" for b in backends) or "нет"
+
+
+async def init_ai_client():
+    """Создает клиенты AI-бэкендов с пулами соединений. Вызывается из lifespan приложения."""
+    global _settings, _pool, _fast_pool
+    if _settings is not None:
+        return
+    _settings = AISettings.from_env()
+    if not _settings.backends:
+        logger.error("OPENAI_API_BASE не найден в переменных окружения!")
+    _pool = _create_pool(_settings, _settings.backends)
+    _fast_pool = _create_pool(_settings, _settings.fast_backends)
+    hedging = "включен" if _settings.hedge_enabled else "выключен"
+    logger.info(f"Клиент AI инициализирован: {_describe_backends(_settings.backends)}; быстрая модель: "
+                f"{_describe_backends(_settings.fast_backends)}; соединений до {_settings.max_connections} "
+                f"на бэкенд, hedging {hedging}")
+
+
+async def reload_ai_config():
+    """
+    Перечитывает .env и пересоздает клиенты AI. Запросы, начатые на старых клиентах, дорабатывают:
+    старые клиенты закрываются после истечения таймаута чтения. Статистика бэкендов начинается заново.
+    """
+    global _settings, _pool, _fast_pool
+    load_dotenv(override=True)
+    old_pools = [pool for pool in (_pool, _fast_pool) if pool is not None]
+    _settings = AISettings.from_env()
+    _pool = _create_pool(_settings, _settings.backends)
+    _fast_pool = _create_pool(_settings, _settings.fast_backends)
+    logger.info(f"Конфигурация AI перезагружена: {_describe_backends(_settings.backends)}; быстрая модель: "
+                f"{_describe_backends(_settings.fast_backends)}")
+
+    if old_pools:
+        async def close_later():
+            await asyncio.sleep(_settings.read_timeout)
+            for pool in old_pools:
+                await pool.close()
 
-        if not base_url:
-            logger.error("OPENAI_API_BASE не найден в переменных окружения!")
+        task = asyncio.create_task(close_later())
+        _closing_tasks.add(task)
+        task.add_done_callback(_closing_tasks.discard)
+
+
+async def close_ai_client():
+    global _settings, _pool, _fast_pool
+    for pool in (_pool, _fast_pool):
+        if pool is not None:
+            await pool.close()
+    if _settings is not None:
+        _settings, _pool, _fast_pool = None, None, None
+        logger.info("Клиент AI закрыт.")
+
+
+async def _get_pool(route: str = "main") -> BackendPool:
+    if _settings is None:
+        await init_ai_client()
+    if route == "fast" and _fast_pool is not None:
+        return _fast_pool
+    if _pool is None:
+        raise RuntimeError("OPENAI_API_BASE не найден в переменных окружения!")
+    return _pool
+
+
+SMALL_TALK_WORDS = {"привет", "здравствуйте", "здравствуй", "добрый", "доброе", "день", "вечер", "утро", "спасибо",
+    "большое", "благодарю", "спс", "ок", "окей", "ok", "хорошо", "понятно", "ясно", "отлично", "супер", "класс",
+    "пока", "до", "свидания", "да", "нет", "ага", "угу", "hi", "hello", "thanks"}
+COMPLEX_STEMS = ("почему", "сравн", "рассчит", "посчит", "объясн", "разниц", "если", "итого", "возвр", "штраф",
+    "авари", "дтп", "повреж", "жалоб", "проблем", "ошибк", "получает", "работает", "отмен", "компенс")
+
+
+class RouteStats:
+    """Задержки запросов к модели по одному маршруту: до первого фрагмента и до конца ответа."""
+
+    def __init__(self):
+        self.requests = 0
+        self.errors = 0
+        self.first: Deque[float] = deque(maxlen=1000)
+        self.total: Deque[float] = deque(maxlen=1000)
+
+    @staticmethod
+    def _percentile(values: Deque[float], q: float) -> Optional[float]:
+        if not values:
             return None
+        ordered = sorted(values)
+        return ordered[max(int(len(ordered) * q) - 1, 0)] * 1000
+
+    def stats(self) -> dict:
+        return {"requests": self.requests, "errors": self.errors,
+            "first_ms_p50": self._percentile(self.first, 0.5), "first_ms_p95": self._percentile(self.first, 0.95),
+            "total_ms_p50": self._percentile(self.total, 0.5), "total_ms_p95": self._percentile(self.total, 0.95)}
+
+
+_route_decisions: Dict[str, int] = {}
+_routes = {"fast": RouteStats(), "main": RouteStats()}
+
+
+def classify_question(user_message: str, history: Optional[History] = None) -> Tuple[str, str]:
+    """
+    Локальная оценка сложности сообщения по лексическим признакам. Возвращает (маршрут, причина):
+    "fast" - приветствия, благодарности и вопросы, близкие к записям FAQ; "main" - все остальное,
+    в том числе короткие уточнения, смысл которых зависит от истории.
+    """
+    words = normalize_question(user_message).split()
+    if not words:
+        return "fast", "empty"
+    if len(words) <= AI_ROUTER_MAX_WORDS and all(word in SMALL_TALK_WORDS for word in words):
+        return "fast", "small_talk"
+    if any(word.startswith(stem) for word in words for stem in COMPLEX_STEMS):
+        return "main", "complex_marker"
+    if history and len(words) <= AI_ROUTER_MAX_WORDS:
+        return "main", "follow_up"
+    if len(words) > AI_ROUTER_MAX_WORDS * 3 or user_message.count("?") > 1:
+        return "main", "long"
+    snapshot = context_provider.snapshot
+    if AI_FAQ_ENABLED and snapshot is not None and \
+            snapshot.index.faq.match(user_message, AI_ROUTER_FAQ_SIMILARITY) is not None:
+        return "fast", "faq_like"
+    return "main", "default"
+
+
+def _choose_route(user_message: str, history: Optional[History]) -> Tuple[str, int]:
+    """Маршрут запроса и лимит токенов. Без настроенной быстрой модели все идет на основную."""
+    if not AI_ROUTING_ENABLED or _fast_pool is None:
+        return "main", _settings.main_max_tokens
+    route, reason = classify_question(user_message, history)
+    _route_decisions[f"{route}:{reason}"] = _route_decisions.get(f"{route}:{reason}", 0) + 1
+    logger.info(f"Маршрут запроса к AI: {route} ({reason})")
+    return route, _settings.fast_max_tokens if route == "fast" else _settings.main_max_tokens
+
+
+class InFlightAnswer:
+    """
+    Один запрос к модели, ответ которого получают все, кто задал тот же вопрос, пока запрос выполняется.
+    Каждый подписчик читает фрагменты независимо, поэтому таймаут или отмена одного не влияют на остальных.
+    Когда уходит последний подписчик (таймаут, отмена ответа), запрос к модели отменяется.
+    """
+
+    def __init__(self):
+        self.chunks: List[str] = []
+        self.done = False
+        self.error: Optional[BaseException] = None
+        self.task: Optional[asyncio.Task] = None
+        self.subscribers = 0
+        self.abandoned = False
+        self._condition = asyncio.Condition()
+
+    async def publish(self, delta: str):
+        async with self._condition:
+            self.chunks.append(delta)
+            self._condition.notify_all()
 
-        logger.info(f"Подключение к AI с параметрами:")
-        logger.info(f"Base URL: {base_url}")
-        logger.info(f"API Key: {api_key}")
-        logger.info(f"Model: {model_name}")
-        logger.info(f"Prompt: {prompt}")
-        client = openai.OpenAI(base_url=base_url, api_key=api_key)
+    async def finish(self, error: Optional[BaseException] = None):
+        async with self._condition:
+            self.done = True
+            self.error = error
+            self._condition.notify_all()
 
-        response = await asyncio.to_thread(client.chat.completions.create, model=model_name,
-            messages=[{"role": "system", "content": "Ты - полезный ассистент VROOM."},
-                {"role": "user", "content": prompt}], temperature=1, max_tokens=1000)
+    async def subscribe(self) -> AsyncIterator[str]:
+        position = 0
+        self.subscribers += 1
+        try:
+            while True:
+                async with self._condition:
+                    await self._condition.wait_for(lambda: self.done or len(self.chunks) > position)
+                while position < len(self.chunks):
+                    yield self.chunks[position]
+                    position += 1
+                if self.done and position == len(self.chunks):
+                    if self.error is not None:
+                        raise self.error
+                    return
+        finally:
+            self.subscribers -= 1
+            if self.subscribers == 0 and not self.done:
+                self._abandon()
+
+    def _abandon(self):
+        """Ответ больше никто не ждет: новые вопросы не присоединяются к нему, запрос к модели отменяется."""
+        self.abandoned = True
+        if self.task is not None and not self.task.done():
+            self.task.cancel()
+
+
+InFlightKey = Tuple[str, Optional[str], Optional[str]]
+_inflight: Dict[InFlightKey, InFlightAnswer] = {}
+_coalescing = {"upstream": 0, "collapsed": 0, "cancelled": 0}
+
+
+def _history_digest(history: Optional[History]) -> Optional[str]:
+    if not history:
+        return None
+    digest = hashlib.sha1()
+    for turn in history:
+        digest.update(f"{turn['role']}\0{turn['content']}\0".encode("utf-8"))
+    return digest.hexdigest()[:16]
+
+
+def _inflight_key(user_message: str, history: Optional[History] = None) -> InFlightKey:
+    snapshot = context_provider.snapshot
+    return normalize_question(user_message), snapshot.version if snapshot else None, _history_digest(history)
+
+
+def is_answer_in_flight(user_message: str, history: Optional[History] = None) -> bool:
+    """Проверяет, выполняется ли уже запрос к модели с тем же вопросом и той же историей."""
+    flight = _inflight.get(_inflight_key(user_message, history))
+    return flight is not None and not flight.abandoned
+
+
+async def _request_upstream(key: InFlightKey, flight: InFlightAnswer, user_message: str, stream: bool,
+                            history: Optional[History]):
+    route_stats = None
+    try:
+        messages, version = _build_messages(user_message, history)
+        if _settings is None:
+            await init_ai_client()
+        route, max_tokens = _choose_route(user_message, history)
+        pool = await _get_pool(route)
+        route_stats = _routes[route]
+        route_stats.requests += 1
+        started = time.perf_counter()
+        async for delta in pool.complete(messages, stream, temperature=1, max_tokens=max_tokens):
+            if not flight.chunks:
+                route_stats.first.append(time.perf_counter() - started)
+            await flight.publish(delta)
+        route_stats.total.append(time.perf_counter() - started)
 
-        ai_result = response.choices[0].message.content.strip()
         logger.info("AI сгенерировал ответ.")
-        return ai_result
+        ai_result = "".join(flight.chunks).strip()
+        if ai_result:
+            _store_answer(user_message, version, ai_result, history)
+        await flight.finish()
+    except asyncio.CancelledError as e:
+        _coalescing["cancelled"] += 1
+        logger.info("Запрос к AI отменен: ответ больше никто не ждет")
+        await flight.finish(e)
+        raise
+    except Exception as e:
+        if route_stats is not None:
+            route_stats.errors += 1
+        await flight.finish(e)
+    finally:
+        # Вместо отмененного запроса в _inflight мог появиться новый с тем же ключом
+        if _inflight.get(key) is flight:
+            del _inflight[key]
+
 
+def _join_or_request(user_message: str, stream: bool, history: Optional[History] = None) -> InFlightAnswer:
+    key = _inflight_key(user_message, history)
+    flight = _inflight.get(key)
+    if flight is not None and not flight.abandoned:
+        _coalescing["collapsed"] += 1
+        logger.info(f"Вопрос присоединен к уже выполняющемуся запросу к AI (ожидающих объединено: "
+                    f"{_coalescing['collapsed']})")
+        return flight
+    flight = InFlightAnswer()
+    _inflight[key] = flight
+    _coalescing["upstream"] += 1
+    flight.task = asyncio.create_task(_request_upstream(key, flight, user_message, stream, history))
+    return flight
+
+
+async def get_ai_response(user_message: str, history: Optional[History] = None) -> Optional[str]:
+    """
+    Получает ответ от нейросети через OpenAI API. Готовые ответы (FAQ, кэш) ищутся отдельно через get_instant_answer.
+    history - предыдущие реплики чата (см. get_chat_turns).
+    Одновременные одинаковые вопросы обслуживаются одним запросом к модели.
+    """
+    try:
+        chunks = [delta async for delta in _join_or_request(user_message, False, history).subscribe()]
+        return "".join(chunks).strip()
     except Exception as e:
         logger.error(f"Ошибка при запросе к AI API: {e}")
         return None
+
+
+async def stream_ai_response(user_message: str, history: Optional[History] = None) -> AsyncIterator[str]:
+    """
+    Потоково получает ответ нейросети: отдает фрагменты текста по мере генерации.
+    Одновременные одинаковые вопросы обслуживаются одним запросом к модели.
+    Ошибки API пробрасываются вызывающему коду.
+    """
+    async for delta in _join_or_request(user_message, True, history).subscribe():
+        yield delta
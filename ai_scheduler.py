@@ -0,0 +1,137 @@
+import asyncio
+import time
+from collections import deque
+from contextlib import asynccontextmanager
+from typing import Optional, Callable, Awaitable, Deque, Set, Tuple
+
+from config import logger
+
+
+class AIQueueFull(Exception):
+    """Очередь запросов к AI переполнена."""
+
+
+class AIUserBusy(Exception):
+    """У пользователя уже есть вопрос, ожидающий ответа AI."""
+
+
+QueueCallback = Callable[[int], Awaitable[None]]
+
+
+class AIScheduler:
+    """
+    Допуск запросов к AI: не больше max_concurrency одновременных запросов, не больше одного вопроса
+    на пользователя, ожидающие стоят в очереди длиной до max_queue и получают свою позицию через callback.
+    """
+
+    def __init__(self, max_concurrency: int, max_queue: int):
+        self.max_concurrency = max_concurrency
+        self.max_queue = max_queue
+        self._active = 0
+        self._waiters: Deque[Tuple[asyncio.Future, Optional[QueueCallback]]] = deque()
+        self._users: Set[int] = set()
+        self._wait_times: Deque[float] = deque(maxlen=1000)
+        self.admitted = 0
+        self.rejected_queue_full = 0
+        self.rejected_user_busy = 0
+        self.timeouts = 0
+        self.max_queue_depth = 0
+        self._notify_task: Optional[asyncio.Task] = None
+        self._notify_again = False
+
+    def _schedule_notify(self):
+        """
+        Позиции в очереди изменились. Рассылает их одна задача (ссылка на нее хранится): изменение во время
+        рассылки вызывает еще один проход с актуальными позициями, а не параллельную рассылку.
+        """
+        self._notify_again = True
+        if self._notify_task is None or self._notify_task.done():
+            self._notify_task = asyncio.create_task(self._notify_loop())
+
+    async def _notify_loop(self):
+        while self._notify_again:
+            self._notify_again = False
+            await self._notify_positions()
+
+    async def _notify_positions(self):
+        for position, (_, callback) in enumerate(list(self._waiters), start=1):
+            if callback is not None:
+                try:
+                    await callback(position)
+                except Exception as e:
+                    logger.debug(f"Не удалось сообщить позицию в очереди AI: {e}")
+
+    def _wake_next(self):
+        while self._waiters and self._active < self.max_concurrency:
+            future, _ = self._waiters.popleft()
+            if not future.done():
+                self._active += 1
+                future.set_result(None)
+
+    async def _acquire(self, on_queue_position: Optional[QueueCallback]):
+        if self._active < self.max_concurrency and not self._waiters:
+            self._active += 1
+            return
+        if len(self._waiters) >= self.max_queue:
+            self.rejected_queue_full += 1
+            raise AIQueueFull()
+
+        future = asyncio.get_running_loop().create_future()
+        waiter = (future, on_queue_position)
+        self._waiters.append(waiter)
+        self.max_queue_depth = max(self.max_queue_depth, len(self._waiters))
+        try:
+            if on_queue_position is not None:
+                try:
+                    await on_queue_position(len(self._waiters))
+                except Exception as e:
+                    logger.debug(f"Не удалось сообщить позицию в очереди AI: {e}")
+            await future
+        except asyncio.CancelledError:
+            if future.done() and not future.cancelled():
+                self._active -= 1
+                self._wake_next()
+            elif waiter in self._waiters:
+                self._waiters.remove(waiter)
+                self._schedule_notify()
+            raise
+        self._schedule_notify()
+
+    def _release(self):
+        self._active -= 1
+        self._wake_next()
+
+    @asynccontextmanager
+    async def slot(self, user_id: int, on_queue_position: Optional[QueueCallback] = None,
+                   needs_capacity: bool = True):
+        """
+        Занимает слот для запроса к AI на время блока. Ожидание в очереди можно прервать отменой задачи.
+        needs_capacity=False - запрос не обращается к модели сам (присоединяется к чужому), проверяется
+        только ограничение на пользователя.
+        """
+        if user_id in self._users:
+            self.rejected_user_busy += 1
+            raise AIUserBusy()
+        self._users.add(user_id)
+        try:
+            if not needs_capacity:
+                yield
+                return
+            started = time.perf_counter()
+            await self._acquire(on_queue_position)
+            self._wait_times.append(time.perf_counter() - started)
+            self.admitted += 1
+            try:
+                yield
+            finally:
+                self._release()
+        finally:
+            self._users.discard(user_id)
+
+    def stats(self) -> dict:
+        waits = sorted(self._wait_times)
+        return {"active": self._active, "queued": len(self._waiters), "max_queue_depth": self.max_queue_depth,
+            "admitted": self.admitted, "rejected_queue_full": self.rejected_queue_full,
+            "rejected_user_busy": self.rejected_user_busy, "timeouts": self.timeouts,
+            "wait_ms_avg": sum(waits) / len(waits) * 1000 if waits else 0.0,
+            "wait_ms_p95": waits[int(len(waits) * 0.95) - 1] * 1000 if waits else 0.0}
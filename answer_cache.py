@@ -0,0 +1,144 @@
+import hashlib
+import numpy as np
+import re
+import time
+import zlib
+from collections import OrderedDict
+from typing import Optional, Dict, Tuple, Set
+
+WORD_RE = re.compile(r"\w+", re.UNICODE)
+SHINGLE_SIZE = 3
+MINHASH_PRIME = (1 << 31) - 1
+
+
+def normalize_question(text: str) -> str:
+    """Приводит вопрос к каноническому виду: нижний регистр, ё -> е, без пунктуации и лишних пробелов."""
+    return " ".join(WORD_RE.findall(text.lower().replace("ё", "е")))
+
+
+def context_version(context: str) -> str:
+    return hashlib.sha1(context.encode("utf-8")).hexdigest()[:16]
+
+
+class MinHasher:
+    """MinHash-сигнатуры по символьным шинглам для оценки сходства Жаккара между вопросами."""
+
+    def __init__(self, num_perm: int = 64, seed: int = 1):
+        rng = np.random.default_rng(seed)
+        self.a = rng.integers(1, MINHASH_PRIME, size=num_perm, dtype=np.int64)
+        self.b = rng.integers(0, MINHASH_PRIME, size=num_perm, dtype=np.int64)
+
+    def signature(self, text: str) -> np.ndarray:
+        if len(text) <= SHINGLE_SIZE:
+            shingles = {text}
+        else:
+            shingles = {text[i:i + SHINGLE_SIZE] for i in range(len(text) - SHINGLE_SIZE + 1)}
+        hashes = np.array([zlib.crc32(s.encode("utf-8")) % MINHASH_PRIME for s in shingles], dtype=np.int64)
+        return ((np.outer(hashes, self.a) + self.b) % MINHASH_PRIME).min(axis=0)
+
+
+class AnswerCache:
+    """
+    LRU-кэш ответов AI с TTL. Ключ - нормализованный вопрос и версия контекста; при смене версии
+    контекста кэш очищается целиком, а ответы, посчитанные по старой версии, не сохраняются. Если задан
+    near_duplicate_threshold, при промахе ищется похожий вопрос через MinHash LSH (полосы по 4 значения
+    сигнатуры).
+    """
+
+    BAND_ROWS = 4
+
+    def __init__(self, max_size: int = 1000, ttl: float = 3600, near_duplicate_threshold: float = 0.0,
+                 num_perm: int = 64):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.near_duplicate_threshold = near_duplicate_threshold
+        self._entries: "OrderedDict[str, Tuple[str, float, Optional[np.ndarray]]]" = OrderedDict()
+        self._buckets: Dict[Tuple[int, bytes], Set[str]] = {}
+        self._hasher = MinHasher(num_perm) if near_duplicate_threshold > 0 else None
+        self._context_version: Optional[str] = None
+        self.hits = 0
+        self.near_hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def _bands(self, signature: np.ndarray):
+        for band in range(len(signature) // self.BAND_ROWS):
+            yield band, signature[band * self.BAND_ROWS:(band + 1) * self.BAND_ROWS].tobytes()
+
+    def _check_version(self, version: str):
+        if version != self._context_version:
+            self.clear()
+            self._context_version = version
+
+    def _remove(self, key: str):
+        _, _, signature = self._entries.pop(key)
+        if signature is not None:
+            for band_key in self._bands(signature):
+                bucket = self._buckets.get(band_key)
+                if bucket:
+                    bucket.discard(key)
+                    if not bucket:
+                        del self._buckets[band_key]
+
+    def _lookup(self, key: str) -> Optional[str]:
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        if entry[1] < time.monotonic():
+            self._remove(key)
+            return None
+        self._entries.move_to_end(key)
+        return entry[0]
+
+    def _find_near_duplicate(self, signature: np.ndarray) -> Optional[str]:
+        candidates = set()
+        for band_key in self._bands(signature):
+            candidates |= self._buckets.get(band_key, set())
+        if not candidates:
+            return None
+        keys = list(candidates)
+        similarities = (np.stack([self._entries[key][2] for key in keys]) == signature).mean(axis=1)
+        best = int(similarities.argmax())
+        if similarities[best] < self.near_duplicate_threshold:
+            return None
+        return self._lookup(keys[best])
+
+    def get(self, question: str, version: str) -> Optional[str]:
+        self._check_version(version)
+        key = normalize_question(question)
+        answer = self._lookup(key)
+        if answer is not None:
+            self.hits += 1
+            return answer
+        if self._hasher is not None and key:
+            answer = self._find_near_duplicate(self._hasher.signature(key))
+            if answer is not None:
+                self.near_hits += 1
+                return answer
+        self.misses += 1
+        return None
+
+    def put(self, question: str, version: str, answer: str):
+        if version != self._context_version:
+            return
+        key = normalize_question(question)
+        if not key:
+            return
+        if key in self._entries:
+            self._remove(key)
+        signature = self._hasher.signature(key) if self._hasher is not None else None
+        self._entries[key] = (answer, time.monotonic() + self.ttl, signature)
+        if signature is not None:
+            for band_key in self._bands(signature):
+                self._buckets.setdefault(band_key, set()).add(key)
+        while len(self._entries) > self.max_size:
+            self._remove(next(iter(self._entries)))
+            self.evictions += 1
+
+    def clear(self):
+        self._entries.clear()
+        self._buckets.clear()
+
+    def stats(self) -> dict:
+        return {"size": len(self._entries), "hits": self.hits, "near_hits": self.near_hits, "misses": self.misses,
+            "evictions": self.evictions, "context_version": self._context_version}
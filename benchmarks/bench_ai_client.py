@@ -0,0 +1,104 @@
+"""
+Бенчмарк накладных расходов на запрос к AI API: клиент, создаваемый на каждый запрос
+(openai.OpenAI + asyncio.to_thread, как было раньше), против общего AsyncOpenAI с пулом соединений.
+
+Запуск из корня репозитория:
+    python benchmarks/bench_ai_client.py --requests 200 --concurrency 20
+
+Ответы отдает локальная заглушка, поэтому измеряется только стоимость клиента и соединений.
+"""
+import argparse
+import asyncio
+import json
+import os
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+COMPLETION = {"id": "bench", "object": "chat.completion", "created": 0, "model": "bench",
+    "choices": [{"index": 0, "message": {"role": "assistant", "content": "ok"}, "finish_reason": "stop"}],
+    "usage": {"prompt_tokens": 1, "completion_tokens": 1, "total_tokens": 2}}
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        body = json.dumps(COMPLETION).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def start_stub_server() -> str:
+    server = ThreadingHTTPServer(("127.0.0.1", 0), StubHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return f"http://127.0.0.1:{server.server_address[1]}/v1"
+
+
+async def legacy_request(base_url: str):
+    import openai
+
+    client = openai.OpenAI(base_url=base_url, api_key="bench")
+    await asyncio.to_thread(client.chat.completions.create, model="bench",
+        messages=[{"role": "user", "content": "ping"}], max_tokens=1)
+
+
+async def run(name: str, request, total: int, concurrency: int):
+    semaphore = asyncio.Semaphore(concurrency)
+    latencies = []
+
+    async def one():
+        async with semaphore:
+            started = time.perf_counter()
+            await request()
+            latencies.append(time.perf_counter() - started)
+
+    started = time.perf_counter()
+    await asyncio.gather(*(one() for _ in range(total)))
+    elapsed = time.perf_counter() - started
+    latencies.sort()
+    print(f"{name:<10} {total / elapsed:8.1f} req/s   mean {sum(latencies) / len(latencies) * 1000:7.2f} ms   "
+          f"p95 {latencies[int(len(latencies) * 0.95) - 1] * 1000:7.2f} ms")
+
+
+async def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--requests", type=int, default=200)
+    parser.add_argument("--concurrency", type=int, default=20)
+    parser.add_argument("--base-url", help="OpenAI-совместимый сервер; по умолчанию поднимается заглушка")
+    args = parser.parse_args()
+
+    base_url = args.base_url or start_stub_server()
+    os.environ["OPENAI_API_BASE"] = base_url
+    os.environ.setdefault("OPENAI_MODEL_NAME", "bench")
+    for name, value in (("TELEGRAM_BOT_TOKEN", "0:bench"), ("MONGO_CONNECTION_STRING", "mongodb://localhost"),
+                        ("MANAGER_GROUP_CHAT_ID", "0")):
+        os.environ.setdefault(name, value)
+
+    import ai_integration
+
+    await ai_integration.init_ai_client()
+    client = (await ai_integration._get_pool()).backends[0].client
+
+    async def shared_request():
+        await client.chat.completions.create(model="bench", messages=[{"role": "user", "content": "ping"}],
+            max_tokens=1)
+
+    print(f"{args.requests} запросов, параллельно {args.concurrency}, сервер {base_url}")
+    await run("legacy", lambda: legacy_request(base_url), args.requests, args.concurrency)
+    await run("shared", shared_request, args.requests, args.concurrency)
+    await ai_integration.close_ai_client()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,72 @@
+"""
+Проверка пула AI-бэкендов на локальных заглушках (fake_llm_server): быстрый, медленный и сбоящий сервер.
+Показывает, как распределяются запросы, когда размыкается автомат сбоящего бэкенда и сколько
+выигрывают дублирующие запросы (hedging).
+
+Запуск из корня репозитория:
+    python benchmarks/bench_backend_pool.py --requests 300 --concurrency 10 --hedge
+"""
+import argparse
+import asyncio
+import json
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from fake_llm_server import FakeLLMConfig, serve_in_thread
+
+
+async def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--requests", type=int, default=300)
+    parser.add_argument("--concurrency", type=int, default=10)
+    parser.add_argument("--hedge", action="store_true", help="включить дублирующие запросы")
+    args = parser.parse_args()
+
+    for name, value in (("TELEGRAM_BOT_TOKEN", "0:bench"), ("MONGO_CONNECTION_STRING", "mongodb://localhost"),
+                        ("MANAGER_GROUP_CHAT_ID", "0")):
+        os.environ.setdefault(name, value)
+    os.environ["AI_BACKENDS"] = json.dumps([
+        {"name": "fast", "base_url": serve_in_thread(FakeLLMConfig(latency=0.05, jitter=0.05)), "model_name": "bench"},
+        {"name": "slow", "base_url": serve_in_thread(FakeLLMConfig(latency=0.3)), "model_name": "bench"},
+        {"name": "flaky", "base_url": serve_in_thread(FakeLLMConfig(latency=0.02, error_rate=0.5)),
+            "model_name": "bench"}])
+    os.environ["AI_MAX_RETRIES"] = "0"
+    os.environ["AI_BREAKER_COOLDOWN"] = "2"
+    os.environ["AI_HEDGE_ENABLED"] = "true" if args.hedge else "false"
+    os.environ["AI_HEDGE_MIN_DELAY"] = "0.1"
+
+    import ai_integration
+
+    await ai_integration.init_ai_client()
+    pool = await ai_integration._get_pool()
+    semaphore = asyncio.Semaphore(args.concurrency)
+    latencies = []
+    errors = 0
+
+    async def one():
+        nonlocal errors
+        async with semaphore:
+            started = time.perf_counter()
+            try:
+                async for _ in pool.complete([{"role": "user", "content": "ping"}], stream=False, max_tokens=1):
+                    pass
+                latencies.append(time.perf_counter() - started)
+            except Exception:
+                errors += 1
+
+    started = time.perf_counter()
+    await asyncio.gather(*(one() for _ in range(args.requests)))
+    elapsed = time.perf_counter() - started
+    latencies.sort()
+    p50, p95 = latencies[len(latencies) // 2], latencies[int(len(latencies) * 0.95) - 1]
+    print(f"{args.requests} запросов за {elapsed:.2f} с, ошибок {errors}; p50 {p50 * 1000:.1f} мс, "
+          f"p95 {p95 * 1000:.1f} мс")
+    print(json.dumps(pool.stats(), indent=2, ensure_ascii=False))
+    await ai_integration.close_ai_client()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
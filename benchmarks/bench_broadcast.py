@@ -0,0 +1,129 @@
+"""
+Рассылка по большому числу соединений: прежний путь (json.dumps и ожидание отправки в каждое соединение
+по очереди) против ConnectionManager.broadcast (одна сериализация, постановка в очереди соединений пачками,
+отправка писателями соединений параллельно). Соединения имитируются объектами с задержкой send_text,
+сеть и MongoDB не нужны; websocket_manager при импорте создает клиент MinIO, поэтому нужен .env проекта.
+
+Запуск из корня репозитория:
+    python benchmarks/bench_broadcast.py --connections 10000 --send-latency 0.001
+"""
+import argparse
+import asyncio
+import json
+import os
+import sys
+import time
+from datetime import datetime
+from typing import Optional
+
+from dotenv import load_dotenv
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+class FakeWebSocket:
+    def __init__(self, latency: float):
+        self.latency = latency
+        self.received = 0
+        self.scope = {"subprotocols": []}
+
+    async def accept(self, subprotocol: Optional[str] = None):
+        pass
+
+    async def send_text(self, data: str):
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        self.received += 1
+
+    async def close(self, code: int = 1000):
+        pass
+
+
+def sample_message() -> dict:
+    return {"type": "status_update", "payload": {"chat_id": "5f0c2d9e-1b7a-4c2e-9a51-3b8f0e6d7c21",
+        "message": "Плановые работы: чат может быть недоступен с 02:00 до 02:15", "timestamp": datetime.now(),
+        "show_buttons": False}}
+
+
+def bench_encoding(encode_message, iterations: int):
+    message = sample_message()
+
+    def json_default(obj):
+        return obj.isoformat() if isinstance(obj, datetime) else obj
+
+    for name, encode in (("json.dumps", lambda: json.dumps(message, default=json_default)),
+                         ("encode_message", lambda: encode_message(message))):
+        started = time.perf_counter()
+        for _ in range(iterations):
+            encode()
+        elapsed = time.perf_counter() - started
+        print(f"{name:<15} {elapsed / iterations * 1e6:6.2f} мкс на сообщение")
+
+
+async def bench_sequential(sockets, message: dict) -> float:
+    """Как раньше: сериализация и ожидание отправки для каждого соединения по очереди."""
+    started = time.perf_counter()
+    for ws in sockets:
+        await ws.send_text(json.dumps(message, default=lambda o: o.isoformat()))
+    return time.perf_counter() - started
+
+
+async def bench_broadcast(manager, sockets, message: dict, args) -> tuple:
+    started = time.perf_counter()
+    accepted = await manager.broadcast(message, batch_size=args.batch_size)
+    enqueued = time.perf_counter() - started
+    while sum(ws.received for ws in sockets) < accepted:
+        await asyncio.sleep(0.005)
+    return enqueued, time.perf_counter() - started, accepted
+
+
+async def main():
+    load_dotenv()
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--connections", type=int, default=10000)
+    parser.add_argument("--send-latency", type=float, default=0.001, help="задержка отправки одного кадра, с")
+    parser.add_argument("--batch-size", type=int, default=500)
+    parser.add_argument("--audience", type=float, default=1.0, help="доля пользователей в фильтрованной рассылке")
+    parser.add_argument("--skip-sequential", action="store_true", help="не гонять прежний последовательный путь")
+    args = parser.parse_args()
+
+    from delivery import InProcessDelivery
+    from websocket_manager import ConnectionManager, encode_message, orjson
+    from config import logger
+
+    logger.remove()
+    print(f"Кодировщик: {'orjson' if orjson is not None else 'json'}")
+    bench_encoding(encode_message, 20000)
+
+    manager = ConnectionManager(delivery=InProcessDelivery(), max_queue=10)
+    sockets = [FakeWebSocket(args.send_latency) for _ in range(args.connections)]
+    for user_id, ws in enumerate(sockets):
+        await manager.connect(ws, user_id)
+    message = sample_message()
+
+    if not args.skip_sequential:
+        elapsed = await bench_sequential(sockets, message)
+        print(f"Последовательно: {args.connections} соединений за {elapsed:.3f} с")
+        for ws in sockets:
+            ws.received = 0
+
+    enqueued, delivered, accepted = await bench_broadcast(manager, sockets, message, args)
+    print(f"broadcast: поставлено в очереди за {enqueued * 1000:.1f} мс, доставлено {accepted} за {delivered:.3f} с")
+
+    if args.audience < 1.0:
+        for ws in sockets:
+            ws.received = 0
+        audience = range(0, args.connections, max(int(1 / args.audience), 1))
+        started = time.perf_counter()
+        accepted = await manager.broadcast(message, user_ids=audience, batch_size=args.batch_size)
+        while sum(ws.received for ws in sockets) < accepted:
+            await asyncio.sleep(0.005)
+        print(f"broadcast по аудитории: {accepted} соединений за {time.perf_counter() - started:.3f} с")
+
+    for connections in list(manager.active_connections.values()):
+        for connection in list(connections):
+            manager.disconnect(connection)
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,141 @@
+"""
+Форматы кадров WebSocket: JSON-текст против MessagePack, каждый без сжатия и с permessage-deflate.
+Показывает байты в сети для типичных кадров (init с историей и медиа, сообщение чата, фрагмент ответа AI)
+и время кодирования/декодирования одного кадра. Сжатие считается так же, как его делает permessage-deflate:
+raw deflate с окном 2^15 и сбросом после каждого кадра - с контекстом между кадрами (по умолчанию у
+браузеров и uvicorn) и без него (no_context_takeover). Проекту не нужны ни .env, ни MongoDB.
+
+Запуск из корня репозитория:
+    python benchmarks/bench_protocol.py --history 30 --iterations 5000
+"""
+import argparse
+import json
+import time
+import uuid
+import zlib
+from datetime import datetime, timedelta, timezone
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+CHAT_ID = str(uuid.uuid4())
+USER_ID = 5234567890
+
+
+def json_default(obj):
+    if isinstance(obj, datetime):
+        return obj.isoformat()
+    raise TypeError(f"Тип {type(obj).__name__} не сериализуется в JSON")
+
+
+def history_message(index: int, now: datetime) -> dict:
+    timestamp = (now - timedelta(minutes=index)).isoformat()
+    if index % 7 == 3:
+        return {"text": None, "sender_id": str(USER_ID), "timestamp": timestamp,
+            "media": {"type": "photo", "file_id": f"chat_media/{CHAT_ID}/{uuid.uuid4()}.jpg",
+                "caption": "Скриншот ошибки", "mime_type": "image/jpeg", "file_size": 184320 + index, "duration": None,
+                "width": 1080, "height": 2340},
+            "media_url": f"https://storage.example.com/chat/{uuid.uuid4()}.jpg?X-Amz-Signature={uuid.uuid4().hex * 2}"}
+    if index % 2:
+        return {"text": "Здравствуйте! Не приходит код подтверждения при входе, что делать?",
+            "sender_id": str(USER_ID), "timestamp": timestamp}
+    return {"text": "Проверьте, пожалуйста, папку «Спам» и правильность номера телефона. Если код так и не пришел, "
+        "запросите его повторно через 60 секунд или выберите получение кода звонком.", "sender_id": "ai",
+        "timestamp": timestamp}
+
+
+def sample_frames(history_size: int, count: int) -> dict:
+    """По count разных кадров каждого типа: страницы истории, сообщения чата, фрагменты одного ответа AI."""
+    now = datetime.now(timezone.utc)
+    messages = [history_message(index, now) for index in range(history_size * count, 0, -1)]
+    answer = messages[-2]["text"].split(" ")
+    stream_id = uuid.uuid4().hex
+    return {
+        "init": [{"type": "init", "payload": {"chat_id": CHAT_ID, "history": messages[start:start + history_size],
+            "cursor": f"{messages[start]['timestamp']}|{uuid.uuid4()}", "show_buttons": True, "seq": 184 + start,
+            "epoch": "3f9a1c2e"}} for start in range(0, len(messages), history_size)],
+        "message": [{"type": "message", "payload": {"chat_id": CHAT_ID, "sender_id": message["sender_id"],
+            "text": message["text"], "timestamp": now - timedelta(seconds=index), "show_buttons": True,
+            "seq": 185 + index}} for index, message in enumerate(messages[-count:]) if message.get("text")],
+        "ai_chunk": [{"type": "ai_chunk", "payload": {"chat_id": CHAT_ID, "stream_id": stream_id, "sender_id": "ai",
+            "delta": answer[index % len(answer)] + " "}} for index in range(count)],
+    }
+
+
+def codecs() -> dict:
+    result = {"json": (lambda m: json.dumps(m, default=json_default, ensure_ascii=False).encode(), json.loads),
+        "json-ascii": (lambda m: json.dumps(m, default=json_default).encode(), json.loads)}
+    if orjson is not None:
+        result["orjson"] = (lambda m: orjson.dumps(m, default=json_default, option=orjson.OPT_NON_STR_KEYS),
+            orjson.loads)
+    if msgpack is not None:
+        result["msgpack"] = (lambda m: msgpack.packb(m, default=json_default), msgpack.unpackb)
+    return result
+
+
+def deflate_sizes(frames: list) -> tuple:
+    """Суммарный размер кадров после permessage-deflate: с контекстом между кадрами и без него."""
+    stream = zlib.compressobj(wbits=-15)
+    with_context = 0
+    without_context = 0
+    for data in frames:
+        with_context += len(stream.compress(data) + stream.flush(zlib.Z_SYNC_FLUSH)) - 4
+        without_context += len(deflate(data)) - 4
+    return with_context, without_context
+
+
+def deflate(data: bytes) -> bytes:
+    compressor = zlib.compressobj(wbits=-15)
+    return compressor.compress(data) + compressor.flush(zlib.Z_SYNC_FLUSH)
+
+
+def per_frame_us(action, iterations: int) -> float:
+    started = time.perf_counter()
+    for _ in range(iterations):
+        action()
+    return (time.perf_counter() - started) / iterations * 1e6
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--history", type=int, default=30, help="сообщений в истории init")
+    parser.add_argument("--iterations", type=int, default=5000)
+    parser.add_argument("--stream", type=int, default=50, help="разных кадров каждого типа (сжатие с контекстом)")
+    args = parser.parse_args()
+    if msgpack is None:
+        print("Пакет msgpack не установлен: сравнивается только JSON")
+
+    frames = sample_frames(args.history, args.stream)
+    available = codecs()
+    print(f"{'кадр':<9} {'формат':<10} {'байт':>7} {'deflate':>8} {'deflate*':>9} {'кодир., мкс':>12} "
+          f"{'декод., мкс':>12} {'сжатие, мкс':>12} {'распак., мкс':>13}")
+    for frame_name, messages in frames.items():
+        message = messages[0]
+        iterations = max(args.iterations // (10 if frame_name == "init" else 1), 1)
+        for codec_name, (encode, decode) in available.items():
+            encoded = [encode(item) for item in messages]
+            size = sum(map(len, encoded)) / len(encoded)
+            with_context, without_context = deflate_sizes(encoded)
+            data = encoded[0]
+            compressed = deflate(data)
+            encode_us = per_frame_us(lambda: encode(message), iterations)
+            decode_us = per_frame_us(lambda: decode(data), iterations)
+            deflate_us = per_frame_us(lambda: deflate(data), iterations)
+            inflate_us = per_frame_us(lambda: zlib.decompressobj(wbits=-15).decompress(compressed), iterations)
+            print(f"{frame_name:<9} {codec_name:<10} {size:>7.0f} {with_context / len(encoded):>8.0f} "
+                  f"{without_context / len(encoded):>9.0f} {encode_us:>12.1f} {decode_us:>12.1f} {deflate_us:>12.1f} "
+                  f"{inflate_us:>13.1f}")
+    print("Байты - средний кадр: без сжатия, deflate - с контекстом между кадрами (по умолчанию), deflate* - без "
+          "контекста. json-ascii - json.dumps с экранированием кириллицы (\\uXXXX). Сжатие выполняется для каждого "
+          "соединения отдельно, сериализация - один раз на рассылку.")
+
+
+if __name__ == "__main__":
+    main()
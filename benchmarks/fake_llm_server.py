@@ -0,0 +1,147 @@
+"""
+Локальная замена LLM с API chat completions (в том числе потоковым), чтобы гонять нагрузочные тесты
+без расхода токенов. Задержка до первого токена, скорость генерации, длина ответа и доля ошибок
+настраиваются параметрами.
+
+Запуск отдельно:
+    python benchmarks/fake_llm_server.py --port 9000 --latency 0.5 --tokens-per-sec 40 --error-rate 0.02
+и в .env сервиса: OPENAI_API_BASE=http://127.0.0.1:9000/v1
+
+Из других бенчмарков: serve_in_thread(FakeLLMConfig(...)) возвращает base_url запущенного сервера.
+"""
+import argparse
+import asyncio
+import json
+import random
+import socket
+import threading
+import time
+import uuid
+
+import uvicorn
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse, StreamingResponse
+from pydantic import BaseModel
+
+ANSWER_WORDS = ("Аренда автомобиля оформляется на сайте или через бота. Для бронирования нужны паспорт и "
+                "водительское удостоверение, залог возвращается после сдачи машины. Если остались вопросы, "
+                "позовите оператора кнопкой ниже.").split()
+
+
+class FakeLLMConfig(BaseModel):
+    latency: float = 0.3
+    jitter: float = 0.0
+    tokens_per_sec: float = 50.0
+    answer_tokens: int = 60
+    error_rate: float = 0.0
+    error_status: int = 500
+
+
+class FakeLLMStats:
+    def __init__(self):
+        self.requests = 0
+        self.streams = 0
+        self.errors = 0
+        self.in_flight = 0
+
+
+def _answer_tokens(count: int):
+    return [ANSWER_WORDS[i % len(ANSWER_WORDS)] + " " for i in range(count)]
+
+
+def create_app(config: FakeLLMConfig) -> FastAPI:
+    app = FastAPI(title="Fake LLM")
+    stats = FakeLLMStats()
+    app.state.stats = stats
+
+    def chunk(completion_id: str, model: str, delta: dict, finish_reason=None) -> str:
+        body = {"id": completion_id, "object": "chat.completion.chunk", "created": int(time.time()), "model": model,
+            "choices": [{"index": 0, "delta": delta, "finish_reason": finish_reason}]}
+        return f"data: {json.dumps(body, ensure_ascii=False)}\n\n"
+
+    @app.post("/v1/chat/completions")
+    async def chat_completions(request: Request):
+        body = await request.json()
+        stats.requests += 1
+        model = body.get("model") or "fake"
+        tokens = _answer_tokens(min(config.answer_tokens, body.get("max_tokens") or config.answer_tokens))
+        completion_id = f"chatcmpl-{uuid.uuid4().hex[:12]}"
+        delay = config.latency + (random.expovariate(1 / config.jitter) if config.jitter else 0)
+        token_delay = 1 / config.tokens_per_sec if config.tokens_per_sec > 0 else 0
+
+        if random.random() < config.error_rate:
+            stats.errors += 1
+            await asyncio.sleep(delay)
+            return JSONResponse({"error": {"message": "injected failure", "type": "server_error"}},
+                status_code=config.error_status)
+
+        if body.get("stream"):
+            stats.streams += 1
+
+            async def events():
+                stats.in_flight += 1
+                try:
+                    await asyncio.sleep(delay)
+                    yield chunk(completion_id, model, {"role": "assistant", "content": ""})
+                    for token in tokens:
+                        yield chunk(completion_id, model, {"content": token})
+                        await asyncio.sleep(token_delay)
+                    yield chunk(completion_id, model, {}, "stop")
+                    yield "data: [DONE]\n\n"
+                finally:
+                    stats.in_flight -= 1
+
+            return StreamingResponse(events(), media_type="text/event-stream")
+
+        stats.in_flight += 1
+        try:
+            await asyncio.sleep(delay + token_delay * len(tokens))
+        finally:
+            stats.in_flight -= 1
+        return {"id": completion_id, "object": "chat.completion", "created": int(time.time()), "model": model,
+            "choices": [{"index": 0, "message": {"role": "assistant", "content": "".join(tokens).strip()},
+                "finish_reason": "stop"}],
+            "usage": {"prompt_tokens": 0, "completion_tokens": len(tokens), "total_tokens": len(tokens)}}
+
+    @app.get("/stats")
+    async def get_stats():
+        return vars(stats)
+
+    return app
+
+
+def _free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def serve_in_thread(config: FakeLLMConfig, port: int = 0) -> str:
+    """Запускает сервер в фоновом потоке и возвращает его base_url (…/v1)."""
+    port = port or _free_port()
+    server = uvicorn.Server(uvicorn.Config(create_app(config), host="127.0.0.1", port=port, log_level="warning"))
+    threading.Thread(target=server.run, daemon=True).start()
+    while not server.started:
+        time.sleep(0.01)
+    return f"http://127.0.0.1:{port}/v1"
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=9000)
+    parser.add_argument("--latency", type=float, default=0.3, help="задержка до первого токена, с")
+    parser.add_argument("--jitter", type=float, default=0.0, help="средняя случайная добавка к задержке, с")
+    parser.add_argument("--tokens-per-sec", type=float, default=50.0)
+    parser.add_argument("--answer-tokens", type=int, default=60)
+    parser.add_argument("--error-rate", type=float, default=0.0, help="доля запросов, завершающихся ошибкой")
+    parser.add_argument("--error-status", type=int, default=500)
+    args = parser.parse_args()
+
+    config = FakeLLMConfig(latency=args.latency, jitter=args.jitter, tokens_per_sec=args.tokens_per_sec,
+        answer_tokens=args.answer_tokens, error_rate=args.error_rate, error_status=args.error_status)
+    uvicorn.run(create_app(config), host=args.host, port=args.port, log_level="warning")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,149 @@
+"""
+Нагрузочный тест чата целиком: N клиентов Mini App подключаются к /ws с подписанным initData
+(как его проверяет websocket_endpoint) и ведут диалоги из нескольких вопросов. Для каждого вопроса
+измеряется время до первого сообщения AI (ai_chunk / ai_response / ai_done / error) и до полного ответа.
+
+Сервис должен быть запущен с тем же TELEGRAM_BOT_TOKEN, а чтобы не тратить токены - с
+OPENAI_API_BASE, указывающим на benchmarks/fake_llm_server.py:
+    python benchmarks/fake_llm_server.py --port 9000 &
+    OPENAI_API_BASE=http://127.0.0.1:9000/v1 python main.py
+    python benchmarks/load_ws.py --url ws://127.0.0.1:8000/ws --clients 200 --turns 3
+
+Пользователи создаются с ID начиная с --user-id-base, используйте тестовую базу.
+"""
+import argparse
+import asyncio
+import hashlib
+import hmac
+import json
+import os
+import random
+import sys
+import time
+from typing import List, Optional
+from urllib.parse import urlencode, quote
+
+import websockets
+from dotenv import load_dotenv
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from context_index import parse_context_entries
+
+FIRST_FRAMES = {"ai_chunk", "ai_response", "ai_done", "error"}
+FINAL_FRAMES = {"ai_response", "ai_done", "error"}
+FOLLOW_UPS = ["А сколько это стоит?", "А если на неделю?", "Спасибо! А залог нужен?", "Понятно, а можно доставку?"]
+
+
+def sign_init_data(bot_token: str, user_id: int, user_name: str) -> str:
+    """Формирует initData Telegram Web App с подписью, которую принимает websocket_endpoint."""
+    fields = {"auth_date": str(int(time.time())), "query_id": f"load-{user_id}",
+        "user": json.dumps({"id": user_id, "first_name": user_name, "username": user_name}, separators=(",", ":"))}
+    check_string = "\n".join(f"{key}={value}" for key, value in sorted(fields.items()))
+    secret_key = hmac.new("WebAppData".encode(), bot_token.encode(), hashlib.sha256).digest()
+    fields["hash"] = hmac.new(secret_key, check_string.encode(), hashlib.sha256).hexdigest()
+    return urlencode(fields)
+
+
+def load_questions(path: str) -> List[str]:
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            questions = [entry.question for entry in parse_context_entries(f.read()) if entry.question]
+    except FileNotFoundError:
+        questions = []
+    return questions or ["Какие документы нужны для аренды?", "Есть ли доставка автомобиля в аэропорт?"]
+
+
+class Results:
+    def __init__(self):
+        self.first_message: List[float] = []
+        self.full_answer: List[float] = []
+        self.answers = 0
+        self.errors = 0
+        self.timeouts = 0
+        self.queued = 0
+        self.connect_failures = 0
+
+
+def percentile(values: List[float], q: float) -> float:
+    ordered = sorted(values)
+    return ordered[max(int(len(ordered) * q + 0.999999) - 1, 0)] if ordered else 0.0
+
+
+async def run_client(index: int, args, questions: List[str], results: Results):
+    user_id = args.user_id_base + index
+    url = f"{args.url}?initData={quote(sign_init_data(args.bot_token, user_id, f'load_{user_id}'))}"
+    await asyncio.sleep(random.uniform(0, args.ramp_up))
+    try:
+        async with websockets.connect(url, max_size=None, open_timeout=30) as ws:
+            chat_id: Optional[str] = None
+            while True:
+                frame = json.loads(await asyncio.wait_for(ws.recv(), 30))
+                if frame["type"] == "init":
+                    chat_id = frame["payload"].get("chat_id")
+                    break
+
+            for turn in range(args.turns):
+                text = random.choice(questions) if turn == 0 else random.choice(FOLLOW_UPS + questions)
+                await ws.send(json.dumps({"type": "message", "payload": {"text": text, "chat_id": chat_id}}))
+                sent = time.perf_counter()
+                first = None
+                try:
+                    while True:
+                        frame = json.loads(await asyncio.wait_for(ws.recv(), args.answer_timeout))
+                        kind = frame.get("type")
+                        if kind == "ai_queue":
+                            results.queued += 1
+                        if kind in FIRST_FRAMES and first is None:
+                            first = time.perf_counter() - sent
+                            results.first_message.append(first)
+                        if kind in FINAL_FRAMES:
+                            results.full_answer.append(time.perf_counter() - sent)
+                            chat_id = frame["payload"].get("chat_id") or chat_id
+                            if kind == "error":
+                                results.errors += 1
+                            else:
+                                results.answers += 1
+                            break
+                except asyncio.TimeoutError:
+                    results.timeouts += 1
+                await asyncio.sleep(random.expovariate(1 / args.think_time) if args.think_time > 0 else 0)
+    except Exception as e:
+        results.connect_failures += 1
+        if results.connect_failures <= 5:
+            print(f"Клиент {user_id}: {type(e).__name__}: {e}")
+
+
+async def main():
+    load_dotenv()
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--url", default="ws://127.0.0.1:8000/ws")
+    parser.add_argument("--clients", type=int, default=50)
+    parser.add_argument("--turns", type=int, default=3, help="вопросов в диалоге одного клиента")
+    parser.add_argument("--think-time", type=float, default=1.0, help="средняя пауза между вопросами, с")
+    parser.add_argument("--ramp-up", type=float, default=5.0, help="за сколько секунд подключаются все клиенты")
+    parser.add_argument("--answer-timeout", type=float, default=60.0)
+    parser.add_argument("--user-id-base", type=int, default=900_000_000)
+    parser.add_argument("--bot-token", default=os.getenv("TELEGRAM_BOT_TOKEN"))
+    parser.add_argument("--context", default="company_context.txt", help="откуда брать вопросы")
+    args = parser.parse_args()
+    if not args.bot_token:
+        parser.error("нужен --bot-token или TELEGRAM_BOT_TOKEN в окружении")
+
+    questions = load_questions(args.context)
+    results = Results()
+    started = time.perf_counter()
+    await asyncio.gather(*(run_client(i, args, questions, results) for i in range(args.clients)))
+    elapsed = time.perf_counter() - started
+
+    print(f"{args.clients} клиентов x {args.turns} вопросов за {elapsed:.1f} с: ответов {results.answers}, "
+          f"ошибок {results.errors}, таймаутов {results.timeouts}, сбоев подключения {results.connect_failures}, "
+          f"сообщений об очереди {results.queued}")
+    print(f"Пропускная способность: {results.answers / elapsed:.2f} ответов/с")
+    for name, values in (("первое сообщение", results.first_message), ("полный ответ", results.full_answer)):
+        print(f"{name:<17} p50 {percentile(values, 0.5) * 1000:8.1f} мс   p95 {percentile(values, 0.95) * 1000:8.1f} мс"
+              f"   p99 {percentile(values, 0.99) * 1000:8.1f} мс   (n={len(values)})")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
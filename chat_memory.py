@@ -0,0 +1,115 @@
+import time
+from collections import OrderedDict, deque
+from typing import Optional, List, Dict, Deque, Tuple
+
+import database as db
+from config import logger
+
+SUMMARY_PREFIX = "Ранее в этом диалоге клиент спрашивал: "
+
+
+def estimate_tokens(text: str) -> int:
+    """Грубая оценка числа токенов без токенизатора: для русского текста ~3 символа на токен."""
+    return len(text) // 3 + 1
+
+
+class ChatHistoryWindow:
+    """
+    Последние реплики одного чата в пределах бюджета токенов. Старые реплики вытесняются первыми;
+    вопросы клиента из вытесненных реплик дописываются в краткую сводку, которая сама ограничена
+    summary_tokens (0 - сводка не ведется).
+    """
+
+    def __init__(self, token_budget: int, summary_tokens: int = 0):
+        self.token_budget = token_budget
+        self.summary_tokens = summary_tokens
+        self.turns: Deque[Tuple[str, str, int]] = deque()
+        self.tokens = 0
+        self.summary: List[str] = []
+        self.summary_size = 0
+        self.loaded_at = time.monotonic()
+
+    def _summarize(self, role: str, content: str):
+        if self.summary_tokens <= 0 or role != "user":
+            return
+        point = content if len(content) <= 200 else content[:200] + "…"
+        self.summary.append(point)
+        self.summary_size += estimate_tokens(point)
+        while self.summary and self.summary_size > self.summary_tokens:
+            self.summary_size -= estimate_tokens(self.summary.pop(0))
+
+    def append(self, role: str, content: str):
+        content = content.strip()
+        if not content:
+            return
+        tokens = estimate_tokens(content)
+        self.turns.append((role, content, tokens))
+        self.tokens += tokens
+        while self.turns and self.tokens > self.token_budget:
+            old_role, old_content, old_tokens = self.turns.popleft()
+            self.tokens -= old_tokens
+            self._summarize(old_role, old_content)
+
+    def messages(self) -> List[Dict[str, str]]:
+        """Реплики в формате сообщений chat completions, сводка (если есть) идет первой."""
+        result = []
+        if self.summary:
+            result.append({"role": "system", "content": SUMMARY_PREFIX + "; ".join(self.summary)})
+        result.extend({"role": role, "content": content} for role, content, _ in self.turns)
+        return result
+
+
+class ChatMemory:
+    """
+    Кэш окон истории по чатам (LRU). Окно читается из MongoDB один раз, дальше пополняется новыми
+    репликами через record. Окна старше ttl перечитываются, чтобы подхватить сообщения, записанные
+    другими воркерами.
+    """
+
+    def __init__(self, token_budget: int, summary_tokens: int, max_messages: int, max_chats: int, ttl: float):
+        self.token_budget = token_budget
+        self.summary_tokens = summary_tokens
+        self.max_messages = max_messages
+        self.max_chats = max_chats
+        self.ttl = ttl
+        self._windows: "OrderedDict[str, ChatHistoryWindow]" = OrderedDict()
+        self.hits = 0
+        self.loads = 0
+
+    async def _load(self, chat_id: str) -> ChatHistoryWindow:
+        window = ChatHistoryWindow(self.token_budget, self.summary_tokens)
+        chat = await db.get_chat_by_id(chat_id)
+        if chat is None:
+            return window
+        history = await db.get_recent_chat_history(chat_id, self.max_messages, since=chat.reopened_at)
+        for msg in history:
+            if msg.text:
+                window.append("user" if msg.sender_id == str(chat.user_id) else "assistant", msg.text)
+        self.loads += 1
+        logger.debug(f"История чата {chat_id} загружена в память: {len(window.turns)} реплик, ~{window.tokens} токенов")
+        return window
+
+    async def get_turns(self, chat_id: str) -> List[Dict[str, str]]:
+        window = self._windows.get(chat_id)
+        if window is not None and time.monotonic() - window.loaded_at < self.ttl:
+            self.hits += 1
+            self._windows.move_to_end(chat_id)
+        else:
+            window = await self._load(chat_id)
+            self._windows[chat_id] = window
+            while len(self._windows) > self.max_chats:
+                self._windows.popitem(last=False)
+        return window.messages()
+
+    def record(self, chat_id: str, role: str, text: Optional[str]):
+        """Добавляет реплику в окно чата, если оно уже загружено (иначе она будет прочитана из БД)."""
+        window = self._windows.get(chat_id)
+        if window is not None and text:
+            window.append(role, text)
+
+    def forget(self, chat_id: str):
+        """Сбрасывает окно чата, например после переоткрытия, когда история начинается заново."""
+        self._windows.pop(chat_id, None)
+
+    def stats(self) -> dict:
+        return {"chats": len(self._windows), "hits": self.hits, "loads": self.loads}
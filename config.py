@@ -10,6 +10,50 @@ DATABASE_NAME = os.getenv("DATABASE_NAME")
 MANAGER_GROUP_CHAT_ID_RAW = os.getenv("MANAGER_GROUP_CHAT_ID")
 AI_MODEL_API_KEY = os.getenv("AI_MODEL_API_KEY")
 ADMIN_USER_ID = os.getenv("ADMIN_USER_ID")
+AI_STREAMING_ENABLED = os.getenv("AI_STREAMING_ENABLED", "true").strip().lower() in ("1", "true", "yes")
+AI_RETRIEVAL_ENABLED = os.getenv("AI_RETRIEVAL_ENABLED", "true").strip().lower() in ("1", "true", "yes")
+AI_RETRIEVAL_TOP_K = int(os.getenv("AI_RETRIEVAL_TOP_K", "4"))
+AI_RETRIEVAL_MIN_SCORE = float(os.getenv("AI_RETRIEVAL_MIN_SCORE", "1.0"))
+AI_CACHE_ENABLED = os.getenv("AI_CACHE_ENABLED", "true").strip().lower() in ("1", "true", "yes")
+AI_CACHE_MAX_SIZE = int(os.getenv("AI_CACHE_MAX_SIZE", "1000"))
+AI_CACHE_TTL = float(os.getenv("AI_CACHE_TTL", "3600"))
+AI_CACHE_NEAR_DUPLICATE_THRESHOLD = float(os.getenv("AI_CACHE_NEAR_DUPLICATE_THRESHOLD", "0"))
+AI_FAQ_ENABLED = os.getenv("AI_FAQ_ENABLED", "true").strip().lower() in ("1", "true", "yes")
+AI_FAQ_MIN_SIMILARITY = float(os.getenv("AI_FAQ_MIN_SIMILARITY", "0.75"))
+AI_CONTEXT_POLL_INTERVAL = float(os.getenv("AI_CONTEXT_POLL_INTERVAL", "5"))
+AI_MAX_CONCURRENCY = int(os.getenv("AI_MAX_CONCURRENCY", "8"))
+AI_MAX_QUEUE = int(os.getenv("AI_MAX_QUEUE", "50"))
+AI_REQUEST_TIMEOUT = float(os.getenv("AI_REQUEST_TIMEOUT", "45"))
+AI_FAQ_FALLBACK_SIMILARITY = float(os.getenv("AI_FAQ_FALLBACK_SIMILARITY", "0.5"))
+AI_HISTORY_TOKEN_BUDGET = int(os.getenv("AI_HISTORY_TOKEN_BUDGET", "1500"))
+AI_HISTORY_SUMMARY_TOKENS = int(os.getenv("AI_HISTORY_SUMMARY_TOKENS", "200"))
+AI_HISTORY_MAX_MESSAGES = int(os.getenv("AI_HISTORY_MAX_MESSAGES", "50"))
+AI_HISTORY_CACHE_SIZE = int(os.getenv("AI_HISTORY_CACHE_SIZE", "2000"))
+AI_HISTORY_CACHE_TTL = float(os.getenv("AI_HISTORY_CACHE_TTL", "600"))
+AI_ROUTING_ENABLED = os.getenv("AI_ROUTING_ENABLED", "true").strip().lower() in ("1", "true", "yes")
+AI_ROUTER_MAX_WORDS = int(os.getenv("AI_ROUTER_MAX_WORDS", "6"))
+AI_ROUTER_FAQ_SIMILARITY = float(os.getenv("AI_ROUTER_FAQ_SIMILARITY", "0.45"))
+WS_MAX_CONNECTIONS_PER_USER = int(os.getenv("WS_MAX_CONNECTIONS_PER_USER", "5"))
+WS_DELIVERY_BACKEND = os.getenv("WS_DELIVERY_BACKEND", "local").strip().lower()
+WS_PRESENCE_TTL = float(os.getenv("WS_PRESENCE_TTL", "60"))
+WS_QUEUE_SIZE = int(os.getenv("WS_QUEUE_SIZE", "100"))
+WS_OVERFLOW_POLICY = os.getenv("WS_OVERFLOW_POLICY", "drop_oldest").strip().lower()
+WS_SEND_TIMEOUT = float(os.getenv("WS_SEND_TIMEOUT", "10"))
+WS_BROADCAST_BATCH_SIZE = int(os.getenv("WS_BROADCAST_BATCH_SIZE", "500"))
+WS_REPLAY_BUFFER = int(os.getenv("WS_REPLAY_BUFFER", "200"))
+WS_REPLAY_TTL = int(os.getenv("WS_REPLAY_TTL", "3600"))
+WS_HISTORY_PAGE_SIZE = int(os.getenv("WS_HISTORY_PAGE_SIZE", "30"))
+WS_PING_INTERVAL = float(os.getenv("WS_PING_INTERVAL", "25"))
+WS_IDLE_TIMEOUT = float(os.getenv("WS_IDLE_TIMEOUT", "70"))
+WS_MAX_PENDING_MESSAGES = int(os.getenv("WS_MAX_PENDING_MESSAGES", "20"))
+WS_MSGPACK_ENABLED = os.getenv("WS_MSGPACK_ENABLED", "true").strip().lower() in ("1", "true", "yes")
+WS_PER_MESSAGE_DEFLATE = os.getenv("WS_PER_MESSAGE_DEFLATE", "true").strip().lower() in ("1", "true", "yes")
+WS_INIT_DATA_MAX_AGE = float(os.getenv("WS_INIT_DATA_MAX_AGE", "86400"))
+WS_SESSION_TOKEN_TTL = float(os.getenv("WS_SESSION_TOKEN_TTL", "900"))
+WS_TELEGRAM_DIGEST_WINDOW = float(os.getenv("WS_TELEGRAM_DIGEST_WINDOW", "30"))
+MANAGER_REGISTRY_POLL_INTERVAL = float(os.getenv("MANAGER_REGISTRY_POLL_INTERVAL", "10"))
+DB_CHECK_QUERY_PLANS = os.getenv("DB_CHECK_QUERY_PLANS", "false").strip().lower() in ("1", "true", "yes")
+RUN_TELEGRAM_BOT = os.getenv("RUN_TELEGRAM_BOT", "true").strip().lower() in ("1", "true", "yes")
 
 if not TELEGRAM_BOT_TOKEN:
     logger.error("TELEGRAM_BOT_TOKEN не найден в .env")
@@ -0,0 +1,153 @@
+import numpy as np
+import re
+from pydantic import BaseModel
+from typing import List, Tuple, Optional
+
+ENTRY_MARKER = "👉"
+STEM_LENGTH = 6
+TOKEN_RE = re.compile(r"\w+", re.UNICODE)
+STOP_WORDS = {"и", "в", "во", "на", "не", "что", "как", "а", "то", "все", "она", "так", "его", "но", "да", "ты", "к",
+    "у", "же", "вы", "за", "бы", "по", "только", "ее", "мне", "было", "вот", "от", "меня", "еще", "нет", "о", "из",
+    "ему", "теперь", "когда", "даже", "ну", "ли", "если", "уже", "или", "ни", "быть", "был", "него", "до", "вас",
+    "нибудь", "уж", "вам", "там", "потом", "себя", "ничего", "ей", "может", "они", "тут", "где", "есть", "надо",
+    "ней", "для", "мы", "тебя", "их", "чем", "была", "сам", "чтоб", "без", "будто", "чего", "раз", "тоже", "себе",
+    "под", "будет", "ж", "тогда", "кто", "этот", "того", "потому", "этого", "какой", "ним", "здесь", "этом", "один",
+    "мой", "тем", "чтобы", "нее", "были", "куда", "зачем", "всех", "можно", "при", "об", "хоть", "после", "над",
+    "больше", "тот", "через", "эти", "нас", "про", "всего", "них", "какая", "много", "разве", "эту", "моя", "свою",
+    "этой", "перед", "иногда", "лучше", "чуть", "том", "нельзя", "такой", "им", "более", "всегда", "конечно", "всю",
+    "между", "это", "я", "сколько"}
+
+
+class ContextEntry(BaseModel):
+    question: str = ""
+    answer: str = ""
+
+    @property
+    def text(self) -> str:
+        if not self.question:
+            return self.answer
+        return f"{ENTRY_MARKER} {self.question}\n\n{self.answer}"
+
+
+def parse_context_entries(context: str) -> List[ContextEntry]:
+    """Разбивает контекст на записи вида «👉 вопрос / ответ». Текст до первого вопроса становится отдельной записью."""
+    entries = []
+    question = ""
+    answer_lines = []
+
+    def flush():
+        answer = "\n".join(answer_lines).strip()
+        if question or answer:
+            entries.append(ContextEntry(question=question, answer=answer))
+
+    for line in context.splitlines():
+        stripped = line.strip()
+        if stripped.startswith(ENTRY_MARKER):
+            flush()
+            question = stripped[len(ENTRY_MARKER):].strip()
+            answer_lines = []
+        else:
+            answer_lines.append(line)
+    flush()
+    return entries
+
+
+def tokenize(text: str) -> List[str]:
+    """
+    Нормализует текст в список термов: нижний регистр, ё -> е, служебные слова и слова короче двух символов
+    отбрасываются.
+    Вместо морфологии слова обрезаются до STEM_LENGTH символов, чтобы «автомобиль» и «автомобиля» совпадали.
+    """
+    text = text.lower().replace("ё", "е")
+    return [token[:STEM_LENGTH] for token in TOKEN_RE.findall(text) if len(token) > 1 and token not in STOP_WORDS]
+
+
+class BM25Index:
+    """Лексический индекс BM25 по списку документов. Веса термов считаются один раз при построении."""
+
+    def __init__(self, documents: List[str], k1: float = 1.5, b: float = 0.75):
+        tokenized = [tokenize(document) for document in documents]
+        self.vocabulary = {}
+        for tokens in tokenized:
+            for token in tokens:
+                self.vocabulary.setdefault(token, len(self.vocabulary))
+
+        tf = np.zeros((len(documents), len(self.vocabulary)), dtype=np.float32)
+        for row, tokens in enumerate(tokenized):
+            for token in tokens:
+                tf[row, self.vocabulary[token]] += 1
+
+        doc_lengths = tf.sum(axis=1, keepdims=True)
+        avg_length = float(doc_lengths.mean()) if len(documents) else 0.0
+        df = (tf > 0).sum(axis=0)
+        idf = np.log(1 + (len(documents) - df + 0.5) / (df + 0.5))
+        norm = k1 * (1 - b + b * doc_lengths / max(avg_length, 1.0))
+        self.weights = (tf * (k1 + 1) / (tf + norm) * idf).astype(np.float32)
+
+    def __len__(self) -> int:
+        return self.weights.shape[0]
+
+    def search(self, query: str, top_k: int) -> List[Tuple[int, float]]:
+        """Возвращает до top_k пар (номер документа, score) по убыванию score, без нулевых совпадений."""
+        columns = list({self.vocabulary[token] for token in tokenize(query) if token in self.vocabulary})
+        if not columns or not len(self):
+            return []
+        scores = self.weights[:, columns].sum(axis=1)
+        top_k = min(top_k, len(scores))
+        best = np.argpartition(-scores, top_k - 1)[:top_k]
+        best = best[np.argsort(-scores[best])]
+        return [(int(i), float(scores[i])) for i in best if scores[i] > 0]
+
+
+class FAQMatcher:
+    """
+    Таблица вопросов из контекста для ответа без обращения к модели. Сходство вопросов - коэффициент
+    Жаккара по множествам нормализованных термов, считается сразу для всех вопросов матрично.
+    """
+
+    def __init__(self, entries: List[ContextEntry]):
+        self.entries = [entry for entry in entries if entry.question and entry.answer]
+        token_sets = [set(tokenize(entry.question)) for entry in self.entries]
+        self.vocabulary = {}
+        for tokens in token_sets:
+            for token in tokens:
+                self.vocabulary.setdefault(token, len(self.vocabulary))
+        self.matrix = np.zeros((len(self.entries), len(self.vocabulary)), dtype=np.float32)
+        for row, tokens in enumerate(token_sets):
+            for token in tokens:
+                self.matrix[row, self.vocabulary[token]] = 1
+        self.sizes = self.matrix.sum(axis=1)
+
+    def match(self, question: str, min_similarity: float) -> Optional[Tuple[ContextEntry, float]]:
+        tokens = set(tokenize(question))
+        if not tokens or not self.entries:
+            return None
+        columns = [self.vocabulary[token] for token in tokens if token in self.vocabulary]
+        if not columns:
+            return None
+        intersection = self.matrix[:, columns].sum(axis=1)
+        similarity = intersection / (self.sizes + len(tokens) - intersection)
+        best = int(similarity.argmax())
+        if similarity[best] < min_similarity:
+            return None
+        return self.entries[best], float(similarity[best])
+
+
+class ContextIndex:
+    """Записи контекста, BM25-индекс и таблица FAQ по ним. Строится один раз при загрузке контекста."""
+
+    def __init__(self, context: str):
+        self.context = context
+        self.entries = parse_context_entries(context)
+        self.index = BM25Index([entry.text for entry in self.entries])
+        self.faq = FAQMatcher(self.entries)
+
+    def select(self, question: str, top_k: int, min_score: float) -> Tuple[str, List[Tuple[int, float]]]:
+        """
+        Возвращает текст контекста для промпта и найденные записи. Если лучшая запись набирает меньше
+        min_score, возвращается весь контекст, а список записей пуст.
+        """
+        hits = self.index.search(question, top_k)
+        if not hits or hits[0][1] < min_score:
+            return self.context, []
+        return "\n\n".join(self.entries[i].text for i, _ in sorted(hits)), hits
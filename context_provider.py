@@ -0,0 +1,86 @@
+import asyncio
+import os
+import time
+from typing import Optional
+
+from answer_cache import context_version
+from config import logger
+from context_index import ContextIndex
+
+
+class ContextSnapshot:
+    """Неизменяемая версия контекста вместе с построенными по ней индексами."""
+
+    def __init__(self, context: str, mtime: Optional[float]):
+        self.context = context
+        self.mtime = mtime
+        self.version = context_version(context)
+        self.index = ContextIndex(context)
+        self.loaded_at = time.time()
+
+
+class ContextProvider:
+    """
+    Держит текущий снимок контекста. Файл читается и индексируется в отдельном потоке, после чего
+    снимок подменяется одной операцией присваивания: запросы, уже получившие старый снимок, дорабатывают
+    на нем, новые видят новый. На пути обработки запроса диск не читается.
+    """
+
+    def __init__(self, path: str, poll_interval: float = 5.0):
+        self.path = path
+        self.poll_interval = poll_interval
+        self.snapshot: Optional[ContextSnapshot] = None
+        self.reloads = 0
+        self._lock = asyncio.Lock()
+        self._watcher: Optional[asyncio.Task] = None
+
+    async def start(self):
+        await self.reload(force=True)
+        if self.poll_interval > 0 and self._watcher is None:
+            self._watcher = asyncio.create_task(self._watch())
+
+    async def stop(self):
+        if self._watcher is not None:
+            self._watcher.cancel()
+            self._watcher = None
+
+    def _load(self, force: bool) -> Optional[ContextSnapshot]:
+        mtime = os.stat(self.path).st_mtime
+        if not force and self.snapshot is not None and self.snapshot.mtime == mtime:
+            return None
+        with open(self.path, "r", encoding="utf-8") as f:
+            context = f.read()
+        if not force and self.snapshot is not None and context_version(context) == self.snapshot.version:
+            self.snapshot.mtime = mtime
+            return None
+        return ContextSnapshot(context, mtime)
+
+    async def reload(self, force: bool = False) -> bool:
+        """Перечитывает файл контекста. Возвращает True, если была установлена новая версия."""
+        async with self._lock:
+            try:
+                snapshot = await asyncio.to_thread(self._load, force)
+            except FileNotFoundError:
+                logger.error(f"Файл контекста {self.path} не найден!")
+                return False
+            except Exception as e:
+                logger.error(f"Ошибка чтения файла контекста {self.path}: {e}")
+                return False
+            if snapshot is None:
+                return False
+            self.snapshot = snapshot
+            self.reloads += 1
+            logger.info(f"Контекст из {self.path} загружен (версия {snapshot.version}), "
+                        f"записей в индексе: {len(snapshot.index.entries)}.")
+            return True
+
+    async def _watch(self):
+        while True:
+            await asyncio.sleep(self.poll_interval)
+            await self.reload()
+
+    def stats(self) -> dict:
+        snapshot = self.snapshot
+        return {"version": snapshot.version if snapshot else None, "reloads": self.reloads,
+            "entries": len(snapshot.index.entries) if snapshot else 0,
+            "loaded_at": snapshot.loaded_at if snapshot else None}
@@ -1,8 +1,11 @@
 from datetime import datetime, timezone
 from motor.motor_asyncio import AsyncIOMotorClient, AsyncIOMotorDatabase
-from typing import Optional, List, Dict, Any, Literal
+from pymongo.errors import DuplicateKeyError
+from typing import Optional, List, Dict, Any, Literal, Tuple
 
-from config import MONGO_CONNECTION_STRING, DATABASE_NAME, logger, ADMIN_USER_ID
+from config import MONGO_CONNECTION_STRING, DATABASE_NAME, logger, ADMIN_USER_ID, DB_CHECK_QUERY_PLANS
+from db_migrations import apply_migrations, check_query_plans
+from manager_registry import manager_registry
 from models import User, Chat, Message, Manager
 
 client: AsyncIOMotorClient = None
@@ -19,22 +22,22 @@ async def connect_db():
         logger.info("Успешное подключение к MongoDB")
 
         try:
-
-            await db.chats.create_index("topic_id")
-
-            await db.chats.create_index("chat_id", unique=True)
-
-            await db.chats.create_index("user_id")
-
-            await db.chats.create_index("manager_id")
-
-            await db.chats.create_index("status")
-            logger.info("Созданы необходимые индексы для коллекции chats")
+            await apply_migrations(db)
         except Exception as e:
             logger.error(f"Ошибка при создании индексов: {e}")
 
         logger.info("Индексы MongoDB проверены/созданы.")
 
+        if DB_CHECK_QUERY_PLANS:
+            problems = await check_query_plans(db)
+            if problems:
+                raise RuntimeError(f"Запросы без индекса: {'; '.join(problems)}")
+
+        try:
+            await manager_registry.start(db)
+        except Exception as e:
+            logger.error(f"Не удалось загрузить список менеджеров, проверка пойдет через базу: {e}")
+
         if ADMIN_USER_ID and await db.managers.count_documents({}) == 0:
             try:
                 admin_id = int(ADMIN_USER_ID)
@@ -45,7 +48,6 @@ async def connect_db():
             except Exception as e:
                 logger.error(f"Не удалось добавить первого менеджера: {e}")
 
-
     except Exception as e:
         logger.error(f"Не удалось подключиться к MongoDB: {e}")
         raise
@@ -53,6 +55,7 @@ async def connect_db():
 
 async def close_db():
     global client
+    manager_registry.stop()
     if client:
         client.close()
         logger.info("Соединение с MongoDB закрыто.")
@@ -70,7 +73,11 @@ async def find_or_create_user(user_id: int, user_name: Optional[str] = None) ->
         logger.info(f"Создание нового пользователя: ID {user_id}")
         new_user = User(user_id=user_id, user_name=user_name or f"User_{user_id}",
             created_at=datetime.now(timezone.utc), updated_at=datetime.now(timezone.utc))
-        await db.users.insert_one(new_user.dict())
+        try:
+            await db.users.insert_one(new_user.dict())
+        except DuplicateKeyError:
+            # Пользователя одновременно создало другое соединение (user_id уникален)
+            return await get_user(user_id)
         return new_user
     elif user_name and user.user_name != user_name:
         await db.users.update_one({"user_id": user_id},
@@ -128,6 +135,50 @@ async def get_chat_history(chat_id: str, limit: int = 50, for_manager: bool = Fa
     return [Message.parse_obj(msg) for msg in messages_data]
 
 
+async def get_recent_chat_history(chat_id: str, limit: int, since: Optional[datetime] = None) -> List[Message]:
+    """Получает последние limit сообщений чата (начиная с since, если задано) в хронологическом порядке"""
+    query: Dict[str, Any] = {"chat_id": chat_id}
+    if since:
+        query["timestamp"] = {"$gte": since}
+    messages_cursor = db.chat_messages.find(query).sort("timestamp", -1).limit(limit)
+    messages_data = await messages_cursor.to_list(length=limit)
+    return [Message.parse_obj(msg) for msg in reversed(messages_data)]
+
+
+def encode_history_cursor(cursor: Optional[Tuple[datetime, str]]) -> Optional[str]:
+    """Курсор страницы истории для клиента: "timestamp|_id"."""
+    if cursor is None:
+        return None
+    timestamp, message_id = cursor
+    return f"{timestamp.isoformat()}|{message_id}"
+
+
+def decode_history_cursor(value: str) -> Tuple[datetime, str]:
+    """Разбирает курсор клиента; ValueError (или AttributeError для не-строки) - курсор некорректен."""
+    timestamp, message_id = value.split("|", 1)
+    return datetime.fromisoformat(timestamp), message_id
+
+
+async def get_chat_history_page(chat_id: str, limit: int, before: Optional[Tuple[datetime, str]] = None,
+                                since: Optional[datetime] = None) -> Tuple[List[Message], Optional[Tuple[datetime, str]]]:
+    """
+    Страница истории чата (keyset-пагинация по timestamp, при равном времени - по _id): limit сообщений,
+    предшествующих before, в хронологическом порядке, и курсор (timestamp, _id) следующей, более старой
+    страницы или None, если старше сообщений нет
+    """
+    query: Dict[str, Any] = {"chat_id": chat_id}
+    if since:
+        query["timestamp"] = {"$gte": since}
+    if before:
+        timestamp, message_id = before
+        query["$or"] = [{"timestamp": {"$lt": timestamp}}, {"timestamp": timestamp, "_id": {"$lt": message_id}}]
+    messages_cursor = db.chat_messages.find(query).sort([("timestamp", -1), ("_id", -1)]).limit(limit + 1)
+    messages_data = await messages_cursor.to_list(length=limit + 1)
+    messages = [Message.parse_obj(msg) for msg in reversed(messages_data[:limit])]
+    next_cursor = (messages[0].timestamp, messages[0].id) if len(messages_data) > limit else None
+    return messages, next_cursor
+
+
 async def get_chat_messages(chat_id: str) -> List[Message]:
     """Получает все сообщения чата"""
     messages_cursor = db.chat_messages.find({"chat_id": chat_id})
@@ -176,6 +227,9 @@ async def reset_chat_manager(chat_id: str) -> bool:
 
 
 async def is_manager(user_id: int) -> bool:
+    """Проверка по списку менеджеров в памяти (см. manager_registry.py); в базу - только если он не загружен."""
+    if manager_registry.loaded:
+        return manager_registry.contains(user_id)
     manager = await db.managers.find_one({"user_id": user_id})
     return manager is not None
 
@@ -184,12 +238,17 @@ async def add_manager(user_id: int, name: Optional[str] = None) -> None:
     manager = Manager(user_id=user_id, name=name)
     try:
         await db.managers.insert_one(manager.dict())
+        await manager_registry.added(manager)
         logger.info(f"Менеджер {user_id} ({name}) добавлен.")
+    except DuplicateKeyError:
+        logger.info(f"Менеджер {user_id} уже добавлен.")
     except Exception as e:
         logger.warning(f"Не удалось добавить менеджера {user_id}: {e}")
 
 
 async def get_all_managers() -> List[Manager]:
+    if manager_registry.loaded:
+        return manager_registry.all()
     managers_cursor = db.managers.find({})
     managers_data = await managers_cursor.to_list(length=None)
     return [Manager(**m) for m in managers_data]
@@ -262,6 +321,11 @@ async def get_active_chats() -> List[Chat]:
     return [Chat.parse_obj(chat) for chat in chats_data]
 
 
+async def get_active_chat_user_ids() -> List[int]:
+    """ID пользователей, у которых есть открытый чат (с AI или с оператором) - аудитория рассылок"""
+    return await db.chats.distinct("user_id", {"status": {"$in": ["ai_pending", "active"]}})
+
+
 async def get_last_message(chat_id: str) -> Optional[Message]:
     """Получает последнее сообщение в чате"""
     message_data = await db.chat_messages.find_one({"chat_id": chat_id}, sort=[("timestamp", -1)])
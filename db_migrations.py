@@ -0,0 +1,226 @@
+"""
+Версионированные миграции схемы MongoDB: индексы и подготовка данных под них. Каждая миграция выполняется
+один раз, номер примененной записывается в коллекцию schema_migrations; сами шаги идемпотентны
+(create_index с той же спецификацией ничего не делает), поэтому одновременный старт нескольких воркеров
+безопасен. Миграции применяются при подключении к базе (database.connect_db).
+
+Миграции не удаляют данные. Если уникальный индекс не создается из-за дубликатов, миграция не
+записывается (и повторяется при следующем старте), а дубликаты выводятся в лог; удалить их можно
+только вручную командой --dedupe: без --apply она лишь показывает, что будет удалено.
+
+check_query_plans выполняет explain() для горячих запросов и сообщает о тех, что читают всю коллекцию
+(COLLSCAN). Запуск вручную из корня репозитория:
+    python db_migrations.py                    # применить недостающие миграции
+    python db_migrations.py --status           # показать примененные миграции
+    python db_migrations.py --check            # проверить планы запросов (код возврата 1 при COLLSCAN)
+    python db_migrations.py --dedupe           # показать дубликаты user_id в users и managers
+    python db_migrations.py --dedupe --apply   # удалить их (остается самый ранний документ) и применить миграции
+"""
+import argparse
+import asyncio
+import sys
+from datetime import datetime, timezone
+from typing import Awaitable, Callable, Dict, Iterator, List, Tuple
+
+from motor.motor_asyncio import AsyncIOMotorDatabase
+from pymongo import ASCENDING, DESCENDING
+from pymongo.errors import DuplicateKeyError, OperationFailure
+
+from config import logger
+
+Migration = Tuple[int, str, Callable[[AsyncIOMotorDatabase], Awaitable[None]]]
+
+# Коллекции с уникальным user_id (миграция 4) и команда --dedupe
+UNIQUE_USER_ID_COLLECTIONS = ("users", "managers")
+
+
+class DuplicatesFound(Exception):
+    """Уникальный индекс не создан: в коллекции есть дубликаты, их нужно разобрать вручную (--dedupe)."""
+
+
+async def _chats_baseline(db: AsyncIOMotorDatabase):
+    await db.chats.create_index("topic_id")
+    await db.chats.create_index("chat_id", unique=True)
+    await db.chats.create_index("manager_id")
+    await db.chats.create_index("status")
+
+
+async def _chat_messages_by_chat(db: AsyncIOMotorDatabase):
+    # История (sort timestamp), последнее сообщение и keyset-страницы (sort timestamp, _id) читаются по индексу
+    await db.chat_messages.create_index([("chat_id", ASCENDING), ("timestamp", ASCENDING), ("_id", ASCENDING)],
+        name="chat_id_timestamp")
+
+
+async def _chats_by_user(db: AsyncIOMotorDatabase):
+    # get_active_chat: последний чат пользователя; индекс заменяет прежний индекс только по user_id
+    await db.chats.create_index([("user_id", ASCENDING), ("created_at", DESCENDING)], name="user_id_created_at")
+    await _drop_index(db.chats, "user_id_1")
+
+
+async def _unique_user_ids(db: AsyncIOMotorDatabase):
+    blocked = []
+    for name in UNIQUE_USER_ID_COLLECTIONS:
+        duplicates = await find_duplicates(db[name], "user_id")
+        if duplicates:
+            for group in duplicates:
+                logger.warning(f"{name}: user_id={group['_id']} повторяется в документах {group['ids']}")
+            blocked.append(f"{name} ({len(duplicates)} user_id)")
+            continue
+        await db[name].create_index("user_id", unique=True)
+    if blocked:
+        raise DuplicatesFound(f"уникальный индекс user_id не создан, есть дубликаты: {', '.join(blocked)}. "
+                              f"Проверьте их командой python db_migrations.py --dedupe")
+
+
+async def _drop_index(collection, name: str):
+    try:
+        await collection.drop_index(name)
+    except OperationFailure as e:
+        if e.code != 27:  # IndexNotFound
+            raise
+
+
+async def find_duplicates(collection, field: str) -> List[dict]:
+    """Группы документов с одинаковым field: {"_id": значение, "ids": _id документов по возрастанию}."""
+    pipeline = [{"$sort": {"_id": 1}}, {"$group": {"_id": f"${field}", "ids": {"$push": "$_id"}, "count": {"$sum": 1}}},
+        {"$match": {"count": {"$gt": 1}}}]
+    return [group async for group in collection.aggregate(pipeline, allowDiskUse=True)]
+
+
+async def remove_duplicates(collection, field: str, apply: bool = False) -> int:
+    """
+    Оставляет самый ранний документ для каждого значения field. Без apply ничего не удаляет, только выводит
+    план. Возвращает число документов, которые удалены (или были бы удалены).
+    """
+    total = 0
+    for group in await find_duplicates(collection, field):
+        extra = group["ids"][1:]
+        total += len(extra)
+        if apply:
+            result = await collection.delete_many({"_id": {"$in": extra}})
+            logger.warning(f"{collection.name}: удалено {result.deleted_count} дубликатов {field}={group['_id']}")
+        else:
+            print(f"{collection.name}: {field}={group['_id']} - остается {group['ids'][0]}, удаляются {extra}")
+    return total
+
+
+MIGRATIONS: List[Migration] = [
+    (1, "Индексы chats: topic_id, chat_id (уникальный), manager_id, status", _chats_baseline),
+    (2, "Индекс chat_messages (chat_id, timestamp, _id)", _chat_messages_by_chat),
+    (3, "Индекс chats (user_id, created_at) вместо user_id", _chats_by_user),
+    (4, "Уникальный user_id в users и managers", _unique_user_ids),
+]
+
+
+async def applied_versions(db: AsyncIOMotorDatabase) -> Dict[int, dict]:
+    return {doc["_id"]: doc async for doc in db.schema_migrations.find({})}
+
+
+async def apply_migrations(db: AsyncIOMotorDatabase) -> List[int]:
+    """Применяет недостающие миграции по порядку и возвращает их номера."""
+    applied = await applied_versions(db)
+    done = []
+    for version, description, migrate in MIGRATIONS:
+        if version in applied:
+            continue
+        logger.info(f"Миграция {version}: {description}")
+        await migrate(db)
+        try:
+            await db.schema_migrations.insert_one({"_id": version, "description": description,
+                "applied_at": datetime.now(timezone.utc)})
+        except DuplicateKeyError:
+            pass  # ту же миграцию одновременно применил другой воркер
+        done.append(version)
+    if done:
+        logger.info(f"Применены миграции базы: {done}")
+    return done
+
+
+# Горячие запросы приложения с типичными условиями (значения не важны - важен план)
+HOT_QUERIES = [
+    ("chat_messages: история чата", "chat_messages",
+        lambda c: c.find({"chat_id": ""}).sort("timestamp", 1).limit(50)),
+    ("chat_messages: последнее сообщение", "chat_messages",
+        lambda c: c.find({"chat_id": ""}).sort("timestamp", -1).limit(1)),
+    ("chat_messages: страница истории", "chat_messages",
+        lambda c: c.find({"chat_id": "", "$or": [{"timestamp": {"$lt": datetime.now(timezone.utc)}},
+            {"timestamp": datetime.now(timezone.utc), "_id": {"$lt": ""}}]}).sort([("timestamp", -1), ("_id", -1)])
+            .limit(31)),
+    ("users: по user_id", "users", lambda c: c.find({"user_id": 0}).limit(1)),
+    ("managers: по user_id", "managers", lambda c: c.find({"user_id": 0}).limit(1)),
+    ("chats: последний чат пользователя", "chats",
+        lambda c: c.find({"user_id": 0}).sort("created_at", -1).limit(1)),
+    ("chats: по chat_id", "chats", lambda c: c.find({"chat_id": ""}).limit(1)),
+    ("chats: по topic_id", "chats", lambda c: c.find({"topic_id": 0}).limit(1)),
+]
+
+
+def _stages(plan) -> Iterator[str]:
+    """Все стадии плана explain (inputStage, inputStages, queryPlan для SBE)."""
+    if isinstance(plan, dict):
+        if "stage" in plan:
+            yield plan["stage"]
+        for value in plan.values():
+            yield from _stages(value)
+    elif isinstance(plan, list):
+        for item in plan:
+            yield from _stages(item)
+
+
+async def check_query_plans(db: AsyncIOMotorDatabase) -> List[str]:
+    """Возвращает описания горячих запросов, план которых читает всю коллекцию (COLLSCAN)."""
+    problems = []
+    for name, collection, build in HOT_QUERIES:
+        explain = await build(db[collection]).explain()
+        stages = set(_stages(explain.get("queryPlanner", {}).get("winningPlan", {})))
+        if "COLLSCAN" in stages:
+            problems.append(f"{name}: COLLSCAN")
+        elif "SORT" in stages:
+            logger.warning(f"Запрос '{name}' сортирует в памяти (нет подходящего индекса для сортировки)")
+    return problems
+
+
+async def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--status", action="store_true", help="показать примененные миграции")
+    parser.add_argument("--check", action="store_true", help="проверить планы горячих запросов")
+    parser.add_argument("--dedupe", action="store_true", help="показать дубликаты user_id в users и managers")
+    parser.add_argument("--apply", action="store_true", help="вместе с --dedupe: удалить дубликаты")
+    args = parser.parse_args()
+    if args.apply and not args.dedupe:
+        parser.error("--apply используется только вместе с --dedupe")
+
+    import database
+
+    await database.connect_db()
+    try:
+        if args.dedupe:
+            total = 0
+            for name in UNIQUE_USER_ID_COLLECTIONS:
+                total += await remove_duplicates(database.db[name], "user_id", apply=args.apply)
+            if not total:
+                print("Дубликатов нет")
+            elif args.apply:
+                print(f"Удалено дубликатов: {total}")
+                await apply_migrations(database.db)
+            else:
+                print(f"Будет удалено дубликатов: {total}. Для удаления запустите с --dedupe --apply")
+        if args.status:
+            applied = await applied_versions(database.db)
+            for version, description, _ in MIGRATIONS:
+                applied_at = applied.get(version, {}).get("applied_at")
+                status = f"применена {applied_at}" if applied_at else "не применена"
+                print(f"{version:>3} {description} - {status}")
+        if args.check:
+            problems = await check_query_plans(database.db)
+            for problem in problems:
+                print(problem)
+            print("Планы запросов в порядке" if not problems else f"Запросов без индекса: {len(problems)}")
+            return 1 if problems else 0
+    finally:
+        await database.close_db()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(asyncio.run(main()))
@@ -0,0 +1,219 @@
+import asyncio
+import os
+import socket
+import time
+import uuid
+from datetime import datetime, timedelta, timezone
+from typing import Awaitable, Callable, Dict, Optional, Set, Tuple
+
+import database
+from config import logger
+
+DeliverHandler = Callable[[int, str], Awaitable[bool]]
+
+
+class DeliveryBackend:
+    """
+    Доставка сообщений клиентам, подключенным к другим процессам. ConnectionManager сначала доставляет
+    сообщение в свои соединения, а затем, если пользователь подключен к другому воркеру, публикует его
+    через бэкенд; воркер, у которого есть соединение пользователя, доставляет его локально.
+    """
+
+    def __init__(self):
+        self.worker_id = f"{socket.gethostname()}-{os.getpid()}-{uuid.uuid4().hex[:6]}"
+        self.published = 0
+        self.received = 0
+
+    async def start(self, deliver: DeliverHandler):
+        """deliver(user_id, serialized_message) - локальная доставка сообщения, пришедшего от другого воркера."""
+
+    async def stop(self):
+        pass
+
+    def track(self, user_id: int, delta: int):
+        """Учитывает открытие (+1) или закрытие (-1) соединения пользователя на этом воркере."""
+
+    async def has_remote_connections(self, user_id: int) -> bool:
+        return False
+
+    async def publish(self, user_id: int, serialized_message: str):
+        pass
+
+    def stats(self) -> dict:
+        return {"backend": type(self).__name__, "worker_id": self.worker_id, "published": self.published,
+            "received": self.received}
+
+
+class InProcessDelivery(DeliveryBackend):
+    """
+    Один процесс: все соединения и так локальные. Для тестов можно связать несколько экземпляров
+    общим словарем peers, имитируя несколько воркеров в одном процессе.
+    """
+
+    def __init__(self, peers: Optional[Dict[str, "InProcessDelivery"]] = None):
+        super().__init__()
+        self.peers = peers if peers is not None else {}
+        self.connections: Dict[int, int] = {}
+        self._deliver: Optional[DeliverHandler] = None
+
+    async def start(self, deliver: DeliverHandler):
+        self._deliver = deliver
+        self.peers[self.worker_id] = self
+
+    async def stop(self):
+        self.peers.pop(self.worker_id, None)
+
+    def track(self, user_id: int, delta: int):
+        count = self.connections.get(user_id, 0) + delta
+        if count > 0:
+            self.connections[user_id] = count
+        else:
+            self.connections.pop(user_id, None)
+
+    async def has_remote_connections(self, user_id: int) -> bool:
+        return any(user_id in peer.connections for peer in self.peers.values() if peer is not self)
+
+    async def publish(self, user_id: int, serialized_message: str):
+        self.published += 1
+        for peer in list(self.peers.values()):
+            if peer is not self and user_id in peer.connections and peer._deliver is not None:
+                peer.received += 1
+                await peer._deliver(user_id, serialized_message)
+
+
+class MongoDelivery(DeliveryBackend):
+    """
+    Доставка между воркерами через MongoDB. Какие пользователи подключены к какому воркеру, хранится
+    в коллекции ws_presence (записи продлеваются heartbeat-ом и удаляются TTL-индексом, если воркер
+    упал). Сообщения записываются в ws_deliveries, каждый воркер читает новые записи через change stream
+    и доставляет их своим соединениям. Change stream требует replica set (подойдет и одноузловой).
+    """
+
+    PRESENCE_CACHE_TTL = 2.0
+
+    def __init__(self, presence_ttl: float = 60.0, message_ttl: int = 60):
+        super().__init__()
+        self.presence_ttl = presence_ttl
+        self.message_ttl = message_ttl
+        self.connections: Dict[int, int] = {}
+        self._presence_cache: Dict[int, Tuple[bool, float]] = {}
+        # Запись присутствия: одна задача на пользователя, пишет последнее значение connections
+        self._presence_writers: Dict[int, asyncio.Task] = {}
+        self._presence_dirty: Set[int] = set()
+        self._tasks = []
+        self._deliver: Optional[DeliverHandler] = None
+
+    @property
+    def db(self):
+        return database.db
+
+    async def start(self, deliver: DeliverHandler):
+        self._deliver = deliver
+        await self.db.ws_presence.create_index([("user_id", 1), ("worker_id", 1)], unique=True)
+        await self.db.ws_presence.create_index("expires_at", expireAfterSeconds=0)
+        await self.db.ws_deliveries.create_index("created_at", expireAfterSeconds=self.message_ttl)
+        self._tasks = [asyncio.create_task(self._watch()), asyncio.create_task(self._heartbeat())]
+        logger.info(f"Доставка сообщений между воркерами через MongoDB запущена (воркер {self.worker_id})")
+
+    async def stop(self):
+        for task in self._tasks + list(self._presence_writers.values()):
+            task.cancel()
+        self._tasks = []
+        self._presence_writers.clear()
+        self._presence_dirty.clear()
+        try:
+            await self.db.ws_presence.delete_many({"worker_id": self.worker_id})
+        except Exception as e:
+            logger.warning(f"Не удалось удалить записи присутствия воркера {self.worker_id}: {e}")
+
+    def _expires_at(self) -> datetime:
+        return datetime.now(timezone.utc) + timedelta(seconds=self.presence_ttl)
+
+    def track(self, user_id: int, delta: int):
+        count = self.connections.get(user_id, 0) + delta
+        if count > 0:
+            self.connections[user_id] = count
+        else:
+            self.connections.pop(user_id, None)
+        self._presence_dirty.add(user_id)
+        if user_id not in self._presence_writers:
+            self._presence_writers[user_id] = asyncio.create_task(self._store_presence(user_id))
+
+    async def _store_presence(self, user_id: int):
+        """
+        Записывает число соединений пользователя, пока оно меняется. Записи одного пользователя идут по
+        очереди и всегда с последним значением, поэтому быстрое переподключение не оставит в базе устаревшее.
+        """
+        try:
+            while user_id in self._presence_dirty:
+                self._presence_dirty.discard(user_id)
+                count = self.connections.get(user_id, 0)
+                try:
+                    if count > 0:
+                        await self.db.ws_presence.update_one({"user_id": user_id, "worker_id": self.worker_id},
+                            {"$set": {"connections": count, "expires_at": self._expires_at()}}, upsert=True)
+                    else:
+                        await self.db.ws_presence.delete_one({"user_id": user_id, "worker_id": self.worker_id})
+                except Exception as e:
+                    logger.error(f"Не удалось обновить присутствие пользователя {user_id}: {e}")
+        finally:
+            if self._presence_writers.get(user_id) is asyncio.current_task():
+                del self._presence_writers[user_id]
+
+    async def has_remote_connections(self, user_id: int) -> bool:
+        cached = self._presence_cache.get(user_id)
+        now = time.monotonic()
+        if cached is not None and now - cached[1] < self.PRESENCE_CACHE_TTL:
+            return cached[0]
+        try:
+            found = await self.db.ws_presence.find_one({"user_id": user_id, "worker_id": {"$ne": self.worker_id},
+                "expires_at": {"$gt": datetime.now(timezone.utc)}}, projection={"_id": 1}) is not None
+        except Exception as e:
+            logger.error(f"Не удалось проверить присутствие пользователя {user_id}: {e}")
+            return False
+        self._presence_cache[user_id] = (found, now)
+        if len(self._presence_cache) > 10000:
+            self._presence_cache.clear()
+        return found
+
+    async def publish(self, user_id: int, serialized_message: str):
+        self.published += 1
+        await self.db.ws_deliveries.insert_one({"user_id": user_id, "origin": self.worker_id,
+            "message": serialized_message, "created_at": datetime.now(timezone.utc)})
+
+    async def _watch(self):
+        pipeline = [{"$match": {"operationType": "insert", "fullDocument.origin": {"$ne": self.worker_id}}}]
+        resume_token = None
+        while True:
+            try:
+                async with self.db.ws_deliveries.watch(pipeline, resume_after=resume_token) as stream:
+                    async for change in stream:
+                        resume_token = stream.resume_token
+                        document = change["fullDocument"]
+                        if document["user_id"] in self.connections:
+                            self.received += 1
+                            await self._deliver(document["user_id"], document["message"])
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"Ошибка change stream доставки сообщений: {e}; повтор через 5 с")
+                await asyncio.sleep(5)
+
+    async def _heartbeat(self):
+        while True:
+            await asyncio.sleep(self.presence_ttl / 3)
+            if not self.connections:
+                continue
+            try:
+                await self.db.ws_presence.update_many({"worker_id": self.worker_id,
+                    "user_id": {"$in": list(self.connections)}}, {"$set": {"expires_at": self._expires_at()}})
+            except Exception as e:
+                logger.error(f"Не удалось продлить присутствие воркера {self.worker_id}: {e}")
+
+
+def create_delivery_backend(name: str, presence_ttl: float = 60.0) -> DeliveryBackend:
+    if name == "mongo":
+        return MongoDelivery(presence_ttl=presence_ttl)
+    if name != "local":
+        logger.error(f"Неизвестный бэкенд доставки {name}, используется local")
+    return InProcessDelivery()
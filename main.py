@@ -1,14 +1,13 @@
 import asyncio
-import hashlib
-import hmac
 import io
 import json
 import os
 import platform
 import shutil
 import sys
+import uuid
 from aiogram.types import InlineKeyboardButton, InlineKeyboardMarkup, InputFile, FSInputFile
-from contextlib import asynccontextmanager
+from contextlib import aclosing, asynccontextmanager
 from datetime import datetime, timedelta
 from fastapi import BackgroundTasks
 from fastapi import FastAPI, WebSocket, WebSocketDisconnect, Request, HTTPException, Depends, Response, UploadFile, \
@@ -17,18 +16,24 @@ from fastapi.responses import HTMLResponse, JSONResponse, StreamingResponse, Fil
 from fastapi.staticfiles import StaticFiles
 from fastapi.templating import Jinja2Templates
 from telegram import WebAppData
-from typing import Optional, List
-from urllib.parse import parse_qs
+from typing import Hashable, Optional, List, Tuple
 
 import database as db
-from ai_integration import get_ai_response
-from config import MANAGER_GROUP_CHAT_ID, TELEGRAM_BOT_TOKEN
+from ai_integration import get_ai_response, stream_ai_response, init_ai_client, close_ai_client, get_ai_stats, \
+    get_instant_answer, get_fallback_answer, context_provider, ai_scheduler, is_answer_in_flight, chat_memory, \
+    get_chat_turns
+from ai_scheduler import AIQueueFull, AIUserBusy
+from config import MANAGER_GROUP_CHAT_ID, AI_STREAMING_ENABLED, AI_REQUEST_TIMEOUT, \
+    RUN_TELEGRAM_BOT, WS_HISTORY_PAGE_SIZE, WS_MAX_PENDING_MESSAGES, WS_PER_MESSAGE_DEFLATE
+from manager_registry import manager_registry
+from message_pipeline import MessagePipeline
 from config import logger
 from minio_storage import minio_storage
 from models import UserInfo, Message as DbMessage, Chat, WebSocketMessage, MediaContent
 from telegram_bot import notify_managers_new_request, bot as tg_bot, create_manager_chat_topic
 from utils import cleanup_chat_files
-from websocket_manager import manager as ws_manager
+from webapp_auth import AuthError, session_auth
+from websocket_manager import manager as ws_manager, ClientConnection
 
 
 def get_windows_version():
@@ -43,13 +48,22 @@ async def lifespan(app: FastAPI):
     try:
 
         await db.connect_db()
-        from telegram_bot import run_bot
-        loop = asyncio.get_running_loop()
-        loop.create_task(run_bot())
-        logger.info("FastAPI приложение запущено, бот запущен в фоновом режиме.")
+        await context_provider.start()
+        await init_ai_client()
+        await ws_manager.start()
+        if RUN_TELEGRAM_BOT:
+            from telegram_bot import run_bot
+            loop = asyncio.get_running_loop()
+            loop.create_task(run_bot())
+            logger.info("FastAPI приложение запущено, бот запущен в фоновом режиме.")
+        else:
+            logger.info("FastAPI приложение запущено без Telegram бота (RUN_TELEGRAM_BOT=false).")
 
         yield
 
+        await ws_manager.stop()
+        await close_ai_client()
+        await context_provider.stop()
         await db.close_db()
         logger.info("FastAPI приложение остановлено.")
     except Exception as e:
@@ -144,6 +158,7 @@ async def handle_request_manager(chat_id: str):
                         message_thread_id=old_topic_id)
 
                     await db.reopen_chat(chat_id, old_topic_id)
+                    chat_memory.forget(chat_id)
 
                     await ws_manager.send_personal_message({"type": "status_update", "payload": {
                         "message": "Чат переоткрыт. Ожидайте ответа оператора.", "chat_id": chat_id}}, chat.user_id)
@@ -154,6 +169,7 @@ async def handle_request_manager(chat_id: str):
                     old_topic_id = None
 
             await db.reopen_chat(chat_id)
+            chat_memory.forget(chat_id)
             chat.status = "active"
             chat.manager_requested = False
             chat.topic_id = None
@@ -200,6 +216,13 @@ async def handle_request_manager(chat_id: str):
     return {"status": "success", "message": "Запрос на менеджера отправлен"}
 
 
+@app.get("/api/metrics")
+async def get_metrics():
+    """Счетчики сервиса для мониторинга"""
+    return {"ai": get_ai_stats(), "websocket": ws_manager.stats(), "auth": session_auth.stats(),
+        "managers": manager_registry.stats()}
+
+
 @app.get("/api/media/{file_path:path}")
 async def get_media(file_path: str):
     """Получает медиа-файл из MinIO"""
@@ -273,6 +296,7 @@ async def upload_file(request: Request, file: UploadFile = File(...)):
 
             db_message = DbMessage(chat_id=chat_id, sender_id=sender_id, text=text, media=media)
             await db.add_message(db_message)
+            chat_memory.record(chat_id, "user", text)
 
             return {"success": True, "file_url": presigned_url, "file_path": minio_path,
                 "message_id": str(db_message.id)}
@@ -319,281 +343,437 @@ async def handle_take_chat(chat_id: str, manager_id: int):
     return {"status": "success", "message": "Чат успешно взят"}
 
 
-@app.websocket("/ws")
-async def websocket_endpoint(websocket: WebSocket):
-    """Основной эндпоинт для WebSocket соединения клиента"""
-    try:
-
-        init_data = websocket.query_params.get("initData")
-        if not init_data:
-            logger.warning("WebSocket: Отсутствует InitData")
-            await websocket.close(code=1008)
-            return
-
-        try:
+AI_ERROR_MESSAGE = "К сожалению, возникла ошибка при обработке вашего запроса. Попробуйте позже или позовите оператора."
+AI_BUSY_MESSAGE = "Пожалуйста, дождитесь ответа на предыдущий вопрос."
+
+
+async def deliver_ai_answer(user_id: int, chat_id: str, text: str, source: str, stream_id: Optional[str] = None):
+    """Сохраняет ответ AI и отправляет его клиенту: ai_done для потокового ответа, иначе ai_response."""
+    ai_msg = DbMessage(chat_id=chat_id, sender_id="ai", text=text, source=source)
+    await db.add_message(ai_msg)
+    chat_memory.record(chat_id, "assistant", text)
+    payload = {"chat_id": chat_id, "sender_id": "ai", "text": text, "source": source,
+        "timestamp": ai_msg.timestamp.isoformat(), "show_buttons": True}
+    if stream_id:
+        payload["stream_id"] = stream_id
+    await ws_manager.send_personal_message({"type": "ai_done" if stream_id else "ai_response", "payload": payload},
+        user_id)
+
+
+async def generate_ai_answer(user_id: int, chat_id: str, text: str, stream_id: str,
+                             history: List[dict]) -> Optional[str]:
+    """Запрашивает ответ модели в слоте планировщика; в потоковом режиме пересылает фрагменты клиенту."""
+
+    async def on_queue_position(position: int):
+        await ws_manager.send_personal_message({"type": "ai_queue",
+            "payload": {"chat_id": chat_id, "stream_id": stream_id, "position": position}}, user_id,
+            telegram_fallback=False)
+
+    async with ai_scheduler.slot(user_id, on_queue_position, needs_capacity=not is_answer_in_flight(text, history)):
+        if not AI_STREAMING_ENABLED:
+            return await get_ai_response(text, history)
+
+        chunks = []
+        # aclosing: при отмене или таймауте подписка на ответ закрывается сразу, и если других ожидающих нет,
+        # запрос к модели отменяется (а не дорабатывает до сборки генератора мусорщиком)
+        async with aclosing(stream_ai_response(text, history)) as deltas:
+            async for delta in deltas:
+                chunks.append(delta)
+                await ws_manager.send_personal_message({"type": "ai_chunk",
+                    "payload": {"chat_id": chat_id, "stream_id": stream_id, "sender_id": "ai", "delta": delta}},
+                    user_id, telegram_fallback=False)
+        return "".join(chunks).strip()
+
+
+async def send_ai_answer(user_id: int, chat_id: str, text: str):
+    """
+    Получает ответ AI на сообщение клиента, сохраняет его в БД и отправляет клиенту.
+    В промпт добавляются предыдущие реплики чата (в пределах AI_HISTORY_TOKEN_BUDGET).
+    В потоковом режиме фрагменты ответа уходят сообщениями ai_chunk, итоговый текст - сообщением ai_done.
+    Ответы из FAQ и кэша отправляются сразу одним сообщением; источник ответа сохраняется в поле source.
+    Если модель не ответила за AI_REQUEST_TIMEOUT или очередь переполнена, отправляется запасной ответ
+    из кэша/FAQ, а при его отсутствии - ошибка с кнопкой вызова оператора.
+    """
+    history = await get_chat_turns(chat_id, text)
+    instant = get_instant_answer(text, history)
+    if instant:
+        ai_response, source = instant
+        await deliver_ai_answer(user_id, chat_id, ai_response, source)
+        return
 
-            parsed_data = parse_qs(init_data)
+    stream_id = str(uuid.uuid4())
+    ai_response = None
+    try:
+        ai_response = await asyncio.wait_for(generate_ai_answer(user_id, chat_id, text, stream_id, history),
+            AI_REQUEST_TIMEOUT)
+    except AIUserBusy:
+        await ws_manager.send_personal_message({"type": "error",
+            "payload": {"chat_id": chat_id, "message": AI_BUSY_MESSAGE}}, user_id)
+        return
+    except AIQueueFull:
+        logger.warning(f"Очередь AI переполнена, запрос из чата {chat_id} не принят")
+    except asyncio.TimeoutError:
+        ai_scheduler.timeouts += 1
+        logger.warning(f"AI не ответил за {AI_REQUEST_TIMEOUT} с для чата {chat_id}")
+    except Exception as e:
+        logger.error(f"Ошибка при запросе к AI API для чата {chat_id}: {e}")
 
-            if 'hash' not in parsed_data or 'user' not in parsed_data:
-                logger.warning("WebSocket: Отсутствуют необходимые поля в InitData")
-                await websocket.close(code=1008)
-                return
+    if ai_response:
+        await deliver_ai_answer(user_id, chat_id, ai_response, "llm", stream_id if AI_STREAMING_ENABLED else None)
+        return
 
-            received_hash = parsed_data['hash'][0]
-            user_data = json.loads(parsed_data['user'][0])
+    fallback = get_fallback_answer(text, history)
+    if fallback:
+        await deliver_ai_answer(user_id, chat_id, fallback[0], fallback[1],
+            stream_id if AI_STREAMING_ENABLED else None)
+        return
 
-            check_string = []
-            for key, value in parsed_data.items():
-                if key != 'hash':
-                    if isinstance(value, list):
-                        check_string.append(f"{key}={value[0]}")
-                    else:
-                        check_string.append(f"{key}={value}")
-            check_string = '\n'.join(sorted(check_string))
+    await ws_manager.send_personal_message({"type": "error",
+        "payload": {"chat_id": chat_id, "stream_id": stream_id, "message": AI_ERROR_MESSAGE,
+            "show_operator_button": True}}, user_id)
 
-            secret_key = hmac.new("WebAppData".encode(), TELEGRAM_BOT_TOKEN.encode(), hashlib.sha256).digest()
 
-            computed_hash = hmac.new(secret_key, check_string.encode(), hashlib.sha256).hexdigest()
+async def get_history_page(chat: Chat, before: Optional[Tuple[datetime, str]] = None) -> dict:
+    """Страница истории для клиента (после повторного открытия чата - только новые сообщения) и курсор старше."""
+    history, cursor = await db.get_chat_history_page(chat.chat_id, WS_HISTORY_PAGE_SIZE, before=before,
+        since=chat.reopened_at)
+    history_payload = []
 
-            if computed_hash != received_hash:
-                logger.warning("WebSocket: Неверная подпись InitData")
-                await websocket.close(code=1008)
-                return
+    for msg in history:
+        msg_data = {"text": msg.text, "sender_id": msg.sender_id, "timestamp": msg.timestamp.isoformat(), }
 
-            user_id = user_data['id']
-            user_name = user_data.get('username', '')
-            if not user_name:
-                user_name = user_data.get('first_name', '')
-                if 'last_name' in user_data:
-                    user_name += f" {user_data['last_name']}"
+        if msg.media:
+            msg_data["media"] = msg.media.dict()
 
-            logger.debug(f"Попытка WebSocket подключения от user_id={user_id}, user_name={user_name}")
+        history_payload.append(msg_data)
 
-            try:
-                user = await get_user_from_query(user_id, user_name)
-                logger.info(f"WebSocket: Пользователь {user.user_id} ({user.user_name}) аутентифицирован.")
-            except HTTPException as e:
-                logger.warning(f"WebSocket: Ошибка аутентификации для user_id={user_id}. Детали: {e.detail}")
-                await websocket.close(code=1008)
-                return
-            except Exception as e:
-                logger.error(f"WebSocket: Непредвиденная ошибка при получении пользователя {user_id}: {e}")
-                await websocket.close(code=1011)
-                return
+    return {"chat_id": chat.chat_id, "history": history_payload, "cursor": db.encode_history_cursor(cursor),
+        "show_buttons": bool(history) and history[-1].sender_id == "ai"}
 
-            await ws_manager.connect(websocket, user.user_id)
 
-            chat = await db.get_active_chat(user.user_id)
-            current_chat_id = None
-            print(f"chat: {chat}")
-            if chat:
-                logger.info(
-                    f"Найден активный чат {chat.chat_id} для пользователя {user.user_id}, статус: {chat.status}")
+class ClientSession:
+    """Состояние WebSocket-сессии клиента, общее для цикла приема и задач обработки сообщений."""
 
-                if chat.status == "closed":
-                    await db.reai_pending_chat(chat.chat_id)
+    def __init__(self, user: db.User, connection: ClientConnection, chat: Optional[Chat]):
+        self.user = user
+        self.connection = connection
+        self.chat = chat
+        self.chat_id = chat.chat_id if chat else None
 
-                current_chat_id = chat.chat_id
+    def pipeline_key(self, pipeline: MessagePipeline) -> Hashable:
+        """
+        Очередь MessagePipeline для нового сообщения: текущий чат сессии, а до его создания - пользователь.
+        Пока не обработаны сообщения, отправленные до создания чата, следующие встают в ту же очередь.
+        """
+        if self.chat_id is None or pipeline.busy(self.user.user_id):
+            return self.user.user_id
+        return self.chat_id
 
-                history = await db.get_chat_history(chat.chat_id, for_manager=False)
-                history_payload = []
 
-                for msg in history:
-                    msg_data = {"text": msg.text, "sender_id": msg.sender_id, "timestamp": msg.timestamp.isoformat(), }
+# Обрабатываются сразу в цикле приема, не дожидаясь очереди сообщений соединения
+CONTROL_MESSAGE_TYPES = ("cancel", "start_new_chat", "load_more")
 
-                    if msg.media:
-                        msg_data["media"] = msg.media.dict()
 
-                    history_payload.append(msg_data)
+async def handle_client_message(session: ClientSession, message_data: dict):
+    """Сообщение клиента (текст или файл): сохранение, ответ AI или пересылка оператору (в MessagePipeline)."""
+    try:
+        text = message_data["payload"].get("text", "")
+        file_info = message_data["payload"].get("file")
 
-                show_buttons = False
-                if history and history[-1].sender_id == "ai":
-                    show_buttons = True
+        if file_info:
 
-                await ws_manager.send_personal_message({"type": "init",
-                                                        "payload": {"chat_id": chat.chat_id, "history": history_payload,
-                                                            "status": chat.status, "show_buttons": show_buttons}},
-                    user.user_id)
-            else:
+            logger.debug(
+                "Пропускаем отправку файла через WebSocket, так как он уже отправлен через upload_file")
 
-                logger.info(
-                    f"Активный чат для пользователя {user.user_id} не найден. Будет создан при первом сообщении.")
+            last_message = await db.get_last_message(session.chat_id)
+            if last_message and last_message.media:
 
-                await ws_manager.send_personal_message(
-                    {"type": "init", "payload": {"chat_id": None, "history": [], "status": "no_chat"}}, user.user_id)
+                await ws_manager.send_personal_message({"type": "message",
+                    "payload": {"chat_id": session.chat_id, "sender_id": str(session.user.user_id),
+                        "text": text, "timestamp": last_message.timestamp.isoformat(),
+                        "media": last_message.media.dict()}}, session.user.user_id)
 
-            try:
-                while True:
-                    data = await websocket.receive_text()
-                    logger.debug(f"WebSocket: Получено сообщение от {user.user_id}: {data}")
+                if session.chat.status == "active" and session.chat.topic_id:
                     try:
-                        message_data = json.loads(data)
 
-                        if "type" not in message_data or "payload" not in message_data:
-                            raise ValueError("Invalid message format")
+                        message_text = f"<b>Сообщение от клиента ({session.user.user_name}):</b>\n{text}"
+
+                        close_button = InlineKeyboardButton(text="✅ Завершить чат",
+                                                            callback_data=f"closechat_{session.chat.chat_id}")
+                        keyboard = InlineKeyboardMarkup(inline_keyboard=[[close_button]])
+
+                        file_url = minio_storage.get_presigned_url(last_message.media.file_id)
+
+                        if last_message.media.type == "photo":
+                            await tg_bot.send_photo(chat_id=MANAGER_GROUP_CHAT_ID, photo=file_url,
+                                caption=message_text, message_thread_id=session.chat.topic_id,
+                                parse_mode="HTML", reply_markup=keyboard)
+                        elif last_message.media.type == "video":
+                            await tg_bot.send_video(chat_id=MANAGER_GROUP_CHAT_ID, video=file_url,
+                                caption=message_text, message_thread_id=session.chat.topic_id,
+                                parse_mode="HTML", reply_markup=keyboard)
+                        elif last_message.media.type == "voice":
+                            await tg_bot.send_voice(chat_id=MANAGER_GROUP_CHAT_ID, voice=file_url,
+                                caption=message_text, message_thread_id=session.chat.topic_id,
+                                parse_mode="HTML", reply_markup=keyboard)
+                        elif last_message.media.type == "document":
+                            await tg_bot.send_document(chat_id=MANAGER_GROUP_CHAT_ID,
+                                document=file_url, caption=message_text,
+                                message_thread_id=session.chat.topic_id, parse_mode="HTML",
+                                reply_markup=keyboard)
+
+                        logger.info(
+                            f"Медиа-сообщение от клиента {session.user.user_id} отправлено в чат менеджеров")
+                    except Exception as e:
+                        logger.error(f"Ошибка отправки медиа-сообщения в чат менеджеров: {e}")
+        else:
 
-                        if message_data["type"] == "message":
-                            text = message_data["payload"].get("text", "")
-                            file_info = message_data["payload"].get("file")
-
-                            if file_info:
+            if not session.chat_id:
 
-                                logger.debug(
-                                    "Пропускаем отправку файла через WebSocket, так как он уже отправлен через upload_file")
+                existing_chat = await db.get_active_chat(session.user.user_id)
+                if existing_chat:
+                    session.chat_id = existing_chat.chat_id
 
-                                last_message = await db.get_last_message(current_chat_id)
-                                if last_message and last_message.media:
+                    if existing_chat.status == "closed":
+                        await db.reopen_chat(session.chat_id)
+                        chat_memory.forget(session.chat_id)
+                else:
 
-                                    await ws_manager.send_personal_message({"type": "message",
-                                        "payload": {"chat_id": current_chat_id, "sender_id": str(user.user_id),
-                                            "text": text, "timestamp": last_message.timestamp.isoformat(),
-                                            "media": last_message.media.dict()}}, user.user_id)
+                    session.chat = await db.create_chat(session.user.user_id)
+                    session.chat_id = session.chat.chat_id
 
-                                    if chat.status == "active" and chat.topic_id:
-                                        try:
+                client_msg = DbMessage(chat_id=session.chat_id, sender_id=str(session.user.user_id),
+                    text=text)
+                await db.add_message(client_msg)
+                chat_memory.record(session.chat_id, "user", text)
 
-                                            message_text = f"<b>Сообщение от клиента ({user.user_name}):</b>\n{text}"
+                await send_ai_answer(session.user.user_id, session.chat_id, text)
+            else:
 
-                                            close_button = InlineKeyboardButton(text="✅ Завершить чат",
-                                                                                callback_data=f"closechat_{chat.chat_id}")
-                                            keyboard = InlineKeyboardMarkup(inline_keyboard=[[close_button]])
+                session.chat = await db.get_chat_by_id(session.chat_id)
+                if not session.chat or session.chat.status == "closed":
+                    logger.warning(
+                        f"WebSocket: Попытка отправить сообщение в несуществующий или закрытый чат {session.chat_id} от {session.user.user_id}")
 
-                                            file_url = minio_storage.get_presigned_url(last_message.media.file_id)
+                    await ws_manager.send_personal_message({"type": "error", "payload": {
+                        "message": "Текущий чат завершен. Пожалуйста, начните новый чат.",
+                        "show_new_chat_button": True, "chat_id": session.chat_id}}, session.user.user_id)
+                    session.chat_id = None
+                    return
 
-                                            if last_message.media.type == "photo":
-                                                await tg_bot.send_photo(chat_id=MANAGER_GROUP_CHAT_ID, photo=file_url,
-                                                    caption=message_text, message_thread_id=chat.topic_id,
-                                                    parse_mode="HTML", reply_markup=keyboard)
-                                            elif last_message.media.type == "video":
-                                                await tg_bot.send_video(chat_id=MANAGER_GROUP_CHAT_ID, video=file_url,
-                                                    caption=message_text, message_thread_id=chat.topic_id,
-                                                    parse_mode="HTML", reply_markup=keyboard)
-                                            elif last_message.media.type == "voice":
-                                                await tg_bot.send_voice(chat_id=MANAGER_GROUP_CHAT_ID, voice=file_url,
-                                                    caption=message_text, message_thread_id=chat.topic_id,
-                                                    parse_mode="HTML", reply_markup=keyboard)
-                                            elif last_message.media.type == "document":
-                                                await tg_bot.send_document(chat_id=MANAGER_GROUP_CHAT_ID,
-                                                    document=file_url, caption=message_text,
-                                                    message_thread_id=chat.topic_id, parse_mode="HTML",
-                                                    reply_markup=keyboard)
+                client_msg = DbMessage(chat_id=session.chat_id, sender_id=str(session.user.user_id),
+                                       text=text)
+                await db.add_message(client_msg)
+                chat_memory.record(session.chat_id, "user", text)
 
-                                            logger.info(
-                                                f"Медиа-сообщение от клиента {user.user_id} отправлено в чат менеджеров")
-                                        except Exception as e:
-                                            logger.error(f"Ошибка отправки медиа-сообщения в чат менеджеров: {e}")
-                            else:
+                if session.chat.status == "ai_pending":
 
-                                if not current_chat_id:
+                    await send_ai_answer(session.user.user_id, session.chat_id, text)
 
-                                    existing_chat = await db.get_active_chat(user.user_id)
-                                    if existing_chat:
-                                        current_chat_id = existing_chat.chat_id
+                elif session.chat.status == "active" and session.chat.topic_id:
+                    try:
 
-                                        if existing_chat.status == "closed":
-                                            await db.reopen_chat(current_chat_id)
-                                    else:
+                        message_text = f"<b>Сообщение от клиента ({session.user.user_name}):</b>\n{text}"
 
-                                        chat = await db.create_chat(user.user_id)
-                                        current_chat_id = chat.chat_id
+                        close_button = InlineKeyboardButton(text="✅ Завершить чат",
+                                                            callback_data=f"closechat_{session.chat.chat_id}")
+                        keyboard = InlineKeyboardMarkup(inline_keyboard=[[close_button]])
 
-                                    ai_response = await get_ai_response(text)
+                        await tg_bot.send_message(chat_id=MANAGER_GROUP_CHAT_ID, text=message_text,
+                            message_thread_id=session.chat.topic_id, parse_mode="HTML",
+                            reply_markup=keyboard)
+                        logger.info(
+                            f"Сообщение от клиента {session.user.user_id} отправлено в чат менеджеров")
+                    except Exception as e:
+                        logger.error(f"Ошибка отправки сообщения в чат менеджеров: {e}")
+    except asyncio.CancelledError:
+        raise
+    except Exception as e:
+        logger.error(f"WebSocket: Ошибка обработки сообщения от {session.user.user_id}: {e}")
+
+        await ws_manager.send_personal_message({"type": "error",
+                                                "payload": {"message": "Произошла ошибка на сервере.",
+                                                            "chat_id": session.chat_id}}, session.user.user_id)
+
+
+async def handle_control_message(session: ClientSession, pipeline: MessagePipeline, message_data: dict):
+    """Управляющие сообщения: отмена ответа AI, новый чат, подгрузка истории."""
+    if message_data["type"] == "cancel":
+        chat_id = session.chat_id
+        # Сообщения, отправленные до создания чата, стоят в очереди пользователя (см. ClientSession.pipeline_key).
+        # Отмена задачи закрывает ее подписку на ответ модели; если клиент был единственным ожидающим,
+        # отменяется и запрос к модели
+        cancelled = pipeline.cancel(session.user.user_id) + (pipeline.cancel(chat_id) if chat_id else 0)
+        logger.info(f"WebSocket: Клиент {session.user.user_id} отменил ожидание ответа в чате {chat_id} "
+                    f"(отменено сообщений: {cancelled})")
+        await ws_manager.send_personal_message({"type": "ai_cancelled",
+            "payload": {"chat_id": chat_id, "cancelled": cancelled}}, session.user.user_id, telegram_fallback=False)
+    elif message_data["type"] == "load_more":
+        # Клиент не запрашивает следующую страницу, пока не получит ответ: history_page или history_error
+        # (retryable - сбой базы, тот же курсор можно запросить позже)
+        chat_id = message_data["payload"].get("chat_id")
+        cursor = message_data["payload"].get("cursor")
+        error = None
+        retryable = False
+        # Без курсора или без чата загружать нечего: пустая страница без курсора
+        page = {"chat_id": session.chat_id, "history": [], "cursor": None}
+        before = None
+        if chat_id != session.chat_id:
+            error = "История другого чата недоступна"
+        elif cursor:
+            try:
+                before = db.decode_history_cursor(cursor)
+            except (AttributeError, ValueError):
+                error = "Некорректный курсор истории"
+        if before is not None:
+            try:
+                chat = await db.get_chat_by_id(chat_id)
+                if chat is not None:
+                    page = await get_history_page(chat, before=before)
+            except Exception as e:
+                logger.error(f"WebSocket: Ошибка загрузки истории чата {chat_id}: {e}")
+                error = "Не удалось загрузить историю"
+                retryable = True
+        if error:
+            logger.warning(f"WebSocket: load_more от {session.user.user_id} для чата {chat_id} отклонен: {error}")
+            await ws_manager.send_to_connection(session.connection, {"type": "history_error",
+                "payload": {"chat_id": session.chat_id, "message": error, "retryable": retryable}})
+            return
+        await ws_manager.send_to_connection(session.connection, {"type": "history_page",
+            "payload": {"chat_id": page["chat_id"], "history": page["history"], "cursor": page["cursor"],
+                "has_more": page["cursor"] is not None}})
+    elif message_data["type"] == "start_new_chat":
+        # Ответ AI, который еще готовится для прежнего диалога, в новый диалог не попадет
+        pipeline.cancel(session.chat_id)
+        pipeline.cancel(session.user.user_id)
 
-                                    client_msg = DbMessage(chat_id=current_chat_id, sender_id=str(user.user_id),
-                                        text=text)
-                                    await db.add_message(client_msg)
+        logger.info(f"WebSocket: Клиент {session.user.user_id} инициировал новый чат.")
 
-                                    if ai_response:
+        session.chat = await db.get_active_chat(session.user.user_id)
+        await db.reai_pending_chat(session.chat.chat_id)
+        chat_memory.forget(session.chat.chat_id)
 
-                                        ai_msg = DbMessage(chat_id=current_chat_id, sender_id="ai", text=ai_response)
-                                        await db.add_message(ai_msg)
+        await ws_manager.send_personal_message({"type": "init",
+            "payload": {"chat_id": session.chat.chat_id, "history": [], "status": "ai_pending",
+                **await ws_manager.replay_position(session.chat.chat_id)}}, session.user.user_id)
 
-                                        await ws_manager.send_personal_message({"type": "ai_response",
-                                            "payload": {"chat_id": current_chat_id, "sender_id": "ai",
-                                                "text": ai_response, "timestamp": ai_msg.timestamp.isoformat(),
-                                                "show_buttons": True}}, user.user_id)
-                                    else:
 
-                                        error_message = "К сожалению, возникла ошибка при обработке вашего запроса. Попробуйте позже или позовите оператора."
-                                        await ws_manager.send_personal_message({"type": "error",
-                                            "payload": {"chat_id": current_chat_id, "message": error_message,
-                                                "show_operator_button": True}}, user.user_id)
-                                else:
+@app.websocket("/ws")
+async def websocket_endpoint(websocket: WebSocket):
+    """Основной эндпоинт для WebSocket соединения клиента"""
+    try:
 
-                                    chat = await db.get_chat_by_id(current_chat_id)
-                                    if not chat or chat.status == "closed":
-                                        logger.warning(
-                                            f"WebSocket: Попытка отправить сообщение в несуществующий или закрытый чат {current_chat_id} от {user.user_id}")
+        try:
+            auth = session_auth.authenticate(websocket.query_params.get("session"),
+                websocket.query_params.get("initData"))
+        except AuthError as e:
+            logger.warning(f"WebSocket: Ошибка аутентификации: {e}")
+            await websocket.close(code=1008)
+            return
+        if auth is None:
+            logger.warning("WebSocket: Отсутствует InitData")
+            await websocket.close(code=1008)
+            return
 
-                                        await ws_manager.send_personal_message({"type": "error", "payload": {
-                                            "message": "Текущий чат завершен. Пожалуйста, начните новый чат.",
-                                            "show_new_chat_button": True, "chat_id": current_chat_id}}, user.user_id)
-                                        current_chat_id = None
-                                        continue
+        try:
+            user_id = auth["user_id"]
+            user_name = auth["user_name"]
+            logger.debug(f"Попытка WebSocket подключения от user_id={user_id}, user_name={user_name}")
 
-                                    client_msg = DbMessage(chat_id=current_chat_id, sender_id=str(user.user_id),
-                                                           text=text)
-                                    await db.add_message(client_msg)
+            if auth["verified_by"] == "token":
+                # Пользователь уже найден или создан при выдаче токена - в базу не ходим
+                user = db.User(user_id=user_id, user_name=user_name)
+            else:
+                try:
+                    user = await get_user_from_query(user_id, user_name)
+                    logger.info(f"WebSocket: Пользователь {user.user_id} ({user.user_name}) аутентифицирован.")
+                except HTTPException as e:
+                    logger.warning(f"WebSocket: Ошибка аутентификации для user_id={user_id}. Детали: {e.detail}")
+                    await websocket.close(code=1008)
+                    return
+                except Exception as e:
+                    logger.error(f"WebSocket: Непредвиденная ошибка при получении пользователя {user_id}: {e}")
+                    await websocket.close(code=1011)
+                    return
+            session_token = session_auth.issue_token(auth)
 
-                                    if chat.status == "ai_pending":
+            connection = await ws_manager.connect(websocket, user.user_id, held=True)
+            # Соединение уже в реестре: любая ошибка ниже (база, история, разрыв) должна его оттуда убрать,
+            # иначе оно до проверки молчания занимает место в лимите вкладок и помечает пользователя онлайн
+            pipeline = None
+            try:
+                chat = await db.get_active_chat(user.user_id)
+                current_chat_id = None
+                print(f"chat: {chat}")
+                if chat:
+                    logger.info(
+                        f"Найден активный чат {chat.chat_id} для пользователя {user.user_id}, статус: {chat.status}")
+
+                    current_chat_id = chat.chat_id
+                    missed = None
+                    if chat.status != "closed" and websocket.query_params.get("chat_id") == chat.chat_id:
+                        try:
+                            last_seq = int(websocket.query_params.get("last_seq", ""))
+                        except ValueError:
+                            last_seq = None
+                        if last_seq is not None:
+                            missed = await ws_manager.missed_frames(chat.chat_id, last_seq,
+                                websocket.query_params.get("epoch"))
+
+                    if missed is not None:
+                        logger.info(f"WebSocket: Клиент {user.user_id} продолжает чат {chat.chat_id} с сообщения "
+                                    f"{last_seq}, пропущено {len(missed)}")
+                        ws_manager.open_session(connection, {"type": "resume", "payload": {"chat_id": chat.chat_id,
+                            "status": chat.status, "seq": last_seq, "replayed": len(missed), "session": session_token,
+                            "ping_interval": ws_manager.ping_interval}}, missed)
+                    else:
+                        if chat.status == "closed":
+                            await db.reai_pending_chat(chat.chat_id)
+                            chat_memory.forget(chat.chat_id)
 
-                                        ai_response = await get_ai_response(text)
-
-                                        if ai_response:
+                        # Позиция читается до истории: кадр, отправленный между чтениями, придет повторно,
+                        # но не потеряется
+                        position = await ws_manager.replay_position(chat.chat_id)
+                        page = await get_history_page(chat)
 
-                                            ai_msg = DbMessage(chat_id=current_chat_id, sender_id="ai",
-                                                               text=ai_response)
-                                            await db.add_message(ai_msg)
-
-                                            await ws_manager.send_personal_message({"type": "ai_response",
-                                                "payload": {"chat_id": current_chat_id, "sender_id": "ai",
-                                                    "text": ai_response, "timestamp": ai_msg.timestamp.isoformat(),
-                                                    "show_buttons": True}}, user.user_id)
-                                        else:
-
-                                            error_message = "К сожалению, возникла ошибка при обработке вашего запроса. Попробуйте позже или позовите оператора."
-                                            await ws_manager.send_personal_message({"type": "error",
-                                                "payload": {"chat_id": current_chat_id, "message": error_message,
-                                                    "show_operator_button": True}}, user.user_id)
-
-                                    elif chat.status == "active" and chat.topic_id:
-                                        try:
-
-                                            message_text = f"<b>Сообщение от клиента ({user.user_name}):</b>\n{text}"
-
-                                            close_button = InlineKeyboardButton(text="✅ Завершить чат",
-                                                                                callback_data=f"closechat_{chat.chat_id}")
-                                            keyboard = InlineKeyboardMarkup(inline_keyboard=[[close_button]])
-
-                                            await tg_bot.send_message(chat_id=MANAGER_GROUP_CHAT_ID, text=message_text,
-                                                message_thread_id=chat.topic_id, parse_mode="HTML",
-                                                reply_markup=keyboard)
-                                            logger.info(
-                                                f"Сообщение от клиента {user.user_id} отправлено в чат менеджеров")
-                                        except Exception as e:
-                                            logger.error(f"Ошибка отправки сообщения в чат менеджеров: {e}")
+                        ws_manager.open_session(connection, {"type": "init",
+                            "payload": {**page, "status": chat.status, **position, "session": session_token,
+                                "ping_interval": ws_manager.ping_interval}})
+                else:
 
-                        elif message_data["type"] == "start_new_chat":
+                    logger.info(
+                        f"Активный чат для пользователя {user.user_id} не найден. Будет создан при первом сообщении.")
 
-                            logger.info(f"WebSocket: Клиент {user.user_id} инициировал новый чат.")
+                    ws_manager.open_session(connection,
+                        {"type": "init", "payload": {"chat_id": None, "history": [], "status": "no_chat",
+                            "epoch": ws_manager.replay.epoch, "session": session_token,
+                            "ping_interval": ws_manager.ping_interval}})
 
-                            chat = await db.get_active_chat(user.user_id)
-                            await db.reai_pending_chat(chat.chat_id)
+                session = ClientSession(user, connection, chat)
+                pipeline = MessagePipeline(lambda message_data: handle_client_message(session, message_data),
+                    max_pending=WS_MAX_PENDING_MESSAGES)
 
-                            await ws_manager.send_personal_message({"type": "init",
-                                                                    "payload": {"chat_id": chat.chat_id, "history": [],
-                                                                                "status": "ai_pending"}}, user.user_id)
-                        elif message_data["type"] == "message":
-                            text = message_data["payload"].get("text", "")
-                            file_info = message_data["payload"].get("file")
-                            chat_id = message_data["payload"].get("chat_id")
+                while True:
+                    data = await websocket.receive_text()
+                    connection.touch()
+                    logger.debug(f"WebSocket: Получено сообщение от {user.user_id} ({len(data)} символов)")
+                    try:
+                        message_data = json.loads(data)
 
-                            if chat_id != current_chat_id:
-                                logger.warning(f"Получено сообщение для старого чата {chat_id}, создаем новый")
-                                chat = await db.create_chat(user.user_id)
-                                current_chat_id = chat.chat_id
+                        if "type" not in message_data or "payload" not in message_data:
+                            raise ValueError("Invalid message format")
 
+                        if message_data["type"] == "pong":
+                            continue
 
+                        if message_data["type"] in CONTROL_MESSAGE_TYPES:
+                            await handle_control_message(session, pipeline, message_data)
+                        elif message_data["type"] == "message":
+                            # Сообщения одного чата обрабатываются по порядку, цикл приема их не ждет
+                            if not pipeline.submit(session.pipeline_key(pipeline), message_data):
+                                await ws_manager.send_to_connection(connection, {"type": "error",
+                                    "payload": {"message": "Слишком много сообщений, дождитесь ответа на предыдущие.",
+                                        "chat_id": session.chat_id}})
 
                     except json.JSONDecodeError:
                         logger.warning(f"WebSocket: Получены невалидные JSON данные от {user.user_id}: {data}")
@@ -604,19 +784,22 @@ async def websocket_endpoint(websocket: WebSocket):
 
                         await ws_manager.send_personal_message({"type": "error",
                                                                 "payload": {"message": "Произошла ошибка на сервере.",
-                                                                            "chat_id": current_chat_id}}, user.user_id)
+                                                                            "chat_id": session.chat_id}}, user.user_id)
 
             except WebSocketDisconnect:
                 logger.info(f"WebSocket: Клиент {user.user_id} отключился.")
-                ws_manager.disconnect(user.user_id)
             except Exception as e:
                 logger.error(f"WebSocket: Непредвиденная ошибка в соединении с {user.user_id}: {e}")
-                ws_manager.disconnect(user.user_id)
 
                 try:
                     await websocket.close(code=1011)
                 except RuntimeError:
                     pass
+            finally:
+                ws_manager.disconnect(connection)
+                if pipeline is not None:
+                    # Клиент уже отключен: ответы на принятые сообщения уйдут в Telegram
+                    await pipeline.close(AI_REQUEST_TIMEOUT)
 
         except json.JSONDecodeError:
             logger.error("WebSocket: Ошибка парсинга JSON данных пользователя")
@@ -637,7 +820,8 @@ if __name__ == "__main__":
     import uvicorn
 
     logger.info("Запуск FastAPI приложения через Uvicorn...")
-    uvicorn.run("main:app", host=os.getenv("HOST", "0.0.0.0"), port=int(os.getenv("PORT", "8000")), reload=True)
+    uvicorn.run("main:app", host=os.getenv("HOST", "0.0.0.0"), port=int(os.getenv("PORT", "8000")), reload=True,
+                ws_per_message_deflate=WS_PER_MESSAGE_DEFLATE)
 
 
 async def send_history_to_topic(topic_id: int, history: List[dict]):
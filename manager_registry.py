@@ -0,0 +1,101 @@
+import asyncio
+import time
+from typing import Dict, List, Optional
+
+from motor.motor_asyncio import AsyncIOMotorDatabase
+from pymongo import ReturnDocument
+
+from config import logger, MANAGER_REGISTRY_POLL_INTERVAL
+from models import Manager
+
+
+class ManagerRegistry:
+    """
+    Список менеджеров в памяти: проверка is_manager - поиск в словаре без запроса в базу. Список загружается
+    при подключении к базе и обновляется add_manager. Другие воркеры узнают об изменении по счетчику версии
+    (документ "managers" в коллекции registry_versions, add_manager увеличивает его): раз в poll_interval
+    секунд читается только счетчик, и список перечитывается, если он изменился. Раз в max_age секунд список
+    перечитывается в любом случае - на случай правки коллекции managers в обход приложения.
+    """
+
+    VERSION_ID = "managers"
+
+    def __init__(self, poll_interval: float = MANAGER_REGISTRY_POLL_INTERVAL, max_age: float = 600.0):
+        self.poll_interval = poll_interval
+        self.max_age = max_age
+        self._managers: Dict[int, Manager] = {}
+        self._db: Optional[AsyncIOMotorDatabase] = None
+        self._task: Optional[asyncio.Task] = None
+        self.version = 0
+        self.loaded = False
+        self.loaded_at = 0.0
+        self.lookups = 0
+        self.reloads = 0
+
+    async def start(self, db: AsyncIOMotorDatabase):
+        self._db = db
+        await self.reload()
+        if self.poll_interval > 0 and self._task is None:
+            self._task = asyncio.create_task(self._poll())
+
+    def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+
+    async def _read_version(self) -> int:
+        doc = await self._db.registry_versions.find_one({"_id": self.VERSION_ID})
+        return (doc or {}).get("version", 0)
+
+    async def reload(self):
+        # Версия читается до списка: изменение между чтениями вызовет еще одну перезагрузку, но не потеряется
+        version = await self._read_version()
+        managers = {}
+        async for doc in self._db.managers.find({}):
+            manager = Manager(**doc)
+            managers[manager.user_id] = manager
+        self._managers = managers
+        self.version = version
+        self.loaded = True
+        self.loaded_at = time.monotonic()
+        self.reloads += 1
+        logger.info(f"Загружен список менеджеров: {len(managers)} (версия {version})")
+
+    async def _poll(self):
+        while True:
+            await asyncio.sleep(self.poll_interval)
+            try:
+                if (await self._read_version() != self.version
+                        or time.monotonic() - self.loaded_at >= self.max_age):
+                    await self.reload()
+            except Exception as e:
+                logger.error(f"Не удалось обновить список менеджеров: {e}")
+
+    async def added(self, manager: Manager):
+        """Менеджер добавлен в базу: обновляет список и увеличивает версию для остальных воркеров."""
+        if self._db is None:
+            return  # список еще не загружен - start прочитает менеджера из базы
+        self._managers[manager.user_id] = manager
+        try:
+            doc = await self._db.registry_versions.find_one_and_update({"_id": self.VERSION_ID},
+                {"$inc": {"version": 1}}, upsert=True, return_document=ReturnDocument.AFTER)
+        except Exception as e:
+            logger.error(f"Не удалось увеличить версию списка менеджеров: {e}")
+            return
+        # Если версию успел увеличить и другой воркер, его изменение подхватит следующая проверка
+        if doc["version"] == self.version + 1:
+            self.version = doc["version"]
+
+    def contains(self, user_id: int) -> bool:
+        self.lookups += 1
+        return user_id in self._managers
+
+    def all(self) -> List[Manager]:
+        return list(self._managers.values())
+
+    def stats(self) -> dict:
+        return {"managers": len(self._managers), "version": self.version, "loaded": self.loaded,
+            "lookups": self.lookups, "reloads": self.reloads}
+
+
+manager_registry = ManagerRegistry()
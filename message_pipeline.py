@@ -0,0 +1,90 @@
+import asyncio
+from collections import deque
+from typing import Awaitable, Callable, Deque, Dict, Hashable
+
+from config import logger
+
+MessageHandler = Callable[[dict], Awaitable[None]]
+
+
+class MessagePipeline:
+    """
+    Очередь обработки входящих сообщений одного WebSocket-соединения. Сообщения с одним ключом (чатом)
+    обрабатываются строго по порядку отдельной задачей, сообщения разных чатов - параллельно. Цикл приема
+    только ставит сообщение в очередь и сразу читает следующее, поэтому управляющие сообщения (отмена,
+    новый чат) обрабатываются, пока для чата готовится ответ AI.
+    """
+
+    def __init__(self, handler: MessageHandler, max_pending: int = 20):
+        self.handler = handler
+        self.max_pending = max_pending
+        self._queues: Dict[Hashable, Deque[dict]] = {}
+        self._workers: Dict[Hashable, asyncio.Task] = {}
+        self._current: Dict[Hashable, asyncio.Task] = {}
+        self.closed = False
+        self.processed = 0
+        self.cancelled = 0
+
+    @property
+    def pending(self) -> int:
+        return sum(len(queue) for queue in self._queues.values()) + len(self._current)
+
+    def busy(self, key: Hashable) -> bool:
+        return key in self._current or bool(self._queues.get(key))
+
+    def submit(self, key: Hashable, message: dict) -> bool:
+        """Ставит сообщение в очередь чата key. False - у соединения слишком много необработанных сообщений."""
+        if self.closed or self.pending >= self.max_pending:
+            return False
+        self._queues.setdefault(key, deque()).append(message)
+        if key not in self._workers:
+            self._workers[key] = asyncio.create_task(self._run(key))
+        return True
+
+    def cancel(self, key: Hashable) -> int:
+        """Отменяет обрабатываемое сейчас сообщение чата и ожидающие за ним. Возвращает число отмененных."""
+        cancelled = len(self._queues.pop(key, ()))
+        task = self._current.get(key)
+        if task is not None and not task.done():
+            task.cancel()
+            cancelled += 1
+        self.cancelled += cancelled
+        return cancelled
+
+    async def close(self, timeout: float = 0) -> int:
+        """
+        Соединение закрыто: новые сообщения не принимаются, принятые дообрабатываются не дольше timeout секунд
+        (ответ дойдет через Telegram), остальные отменяются. Возвращает число отмененных сообщений.
+        """
+        self.closed = True
+        workers = list(self._workers.values())
+        if workers and timeout > 0:
+            await asyncio.wait(workers, timeout=timeout)
+        cancelled = sum(self.cancel(key) for key in set(self._queues) | set(self._current))
+        for worker in list(self._workers.values()):
+            worker.cancel()
+        return cancelled
+
+    async def _run(self, key: Hashable):
+        try:
+            while self._queues.get(key):
+                message = self._queues[key].popleft()
+                task = asyncio.create_task(self.handler(message))
+                self._current[key] = task
+                try:
+                    # wait, а не await: отмена сообщения (cancel) не должна останавливать обработку очереди
+                    await asyncio.wait([task])
+                except asyncio.CancelledError:
+                    task.cancel()
+                    raise
+                finally:
+                    self._current.pop(key, None)
+                if task.cancelled():
+                    continue
+                if task.exception() is not None:
+                    logger.error(f"Ошибка обработки сообщения чата {key}: {task.exception()}")
+                self.processed += 1
+        finally:
+            self._workers.pop(key, None)
+            if not self._queues.get(key):
+                self._queues.pop(key, None)
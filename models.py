@@ -55,6 +55,7 @@ class Message(BaseModel):
     sender_id: str
     text: Optional[str] = None
     media: Optional[MediaContent] = None
+    source: Optional[Literal["llm", "cache", "faq"]] = None
     timestamp: datetime = Field(default_factory=lambda: datetime.now(timezone.utc))
 
     model_config = ConfigDict(populate_by_name=True)
@@ -66,7 +67,7 @@ class Manager(BaseModel):
 
 
 class WebSocketMessage(BaseModel):
-    type: Literal["message", "status_update", "error", "init", "ai_response"]
+    type: Literal["message", "status_update", "error", "init", "ai_response", "ai_chunk", "ai_done", "ai_queue"]
     payload: dict
 
 
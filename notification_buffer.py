@@ -0,0 +1,114 @@
+import asyncio
+import time
+from typing import Awaitable, Callable, Dict, List, Optional
+
+from config import logger
+
+# flush(user_id, messages) отправляет сводку и возвращает число сделанных вызовов Telegram API
+FlushHandler = Callable[[int, List[dict]], Awaitable[int]]
+
+
+def legacy_calls(message: dict) -> int:
+    """Сколько вызовов Telegram API стоило сообщение, когда каждое отправлялось отдельно."""
+    media = message.get("payload", {}).get("media") if message.get("type") == "message" else None
+    return 2 if media and media.get("type") == "video_note" else 1
+
+
+class NotificationBuffer:
+    """
+    Буфер уведомлений для пользователей без WebSocket-соединения. Сообщения копятся по пользователю
+    и уходят одной сводкой, когда window секунд не приходит новых (но не позже max_delay после первого) или
+    в буфере набралось max_items. Если пользователь подключился раньше, буфер сбрасывается без отправки:
+    все эти сообщения он получит в init. Вызовы Telegram API, которые сэкономлены по сравнению с отправкой
+    каждого сообщения отдельно, считаются в calls_saved.
+    """
+
+    def __init__(self, flush: FlushHandler, window: float = 30.0, max_delay: Optional[float] = None,
+                 max_items: int = 50):
+        self.flush_handler = flush
+        self.window = window
+        self.max_delay = max_delay if max_delay is not None else window * 4
+        self.max_items = max_items
+        self._buffers: Dict[int, List[dict]] = {}
+        self._first_at: Dict[int, float] = {}
+        self._last_at: Dict[int, float] = {}
+        self._timers: Dict[int, asyncio.Task] = {}
+        self.buffered = 0
+        self.digests = 0
+        self.cancelled = 0
+        self.calls = 0
+        self.calls_saved = 0
+
+    @property
+    def pending_users(self) -> int:
+        return len(self._buffers)
+
+    async def add(self, user_id: int, message: dict):
+        """Добавляет сообщение в буфер пользователя; без окна (window <= 0) отправляет сразу."""
+        self.buffered += 1
+        buffer = self._buffers.setdefault(user_id, [])
+        buffer.append(message)
+        now = time.monotonic()
+        self._first_at.setdefault(user_id, now)
+        self._last_at[user_id] = now
+        if self.window <= 0 or len(buffer) >= self.max_items:
+            await self.flush(user_id)
+        elif user_id not in self._timers:
+            self._timers[user_id] = asyncio.create_task(self._wait_and_flush(user_id))
+
+    def cancel(self, user_id: int) -> int:
+        """Пользователь подключился: сводка не нужна. Возвращает число отброшенных сообщений."""
+        timer = self._timers.pop(user_id, None)
+        if timer is not None and timer is not asyncio.current_task():
+            timer.cancel()
+        messages = self._take(user_id)
+        if messages:
+            self.cancelled += len(messages)
+            self.calls_saved += sum(legacy_calls(message) for message in messages)
+        return len(messages)
+
+    def _take(self, user_id: int) -> List[dict]:
+        self._first_at.pop(user_id, None)
+        self._last_at.pop(user_id, None)
+        return self._buffers.pop(user_id, [])
+
+    def _deadline(self, user_id: int) -> float:
+        return min(self._last_at[user_id] + self.window, self._first_at[user_id] + self.max_delay)
+
+    async def _wait_and_flush(self, user_id: int):
+        try:
+            while user_id in self._buffers:
+                delay = self._deadline(user_id) - time.monotonic()
+                if delay <= 0:
+                    break
+                await asyncio.sleep(delay)
+        finally:
+            if self._timers.get(user_id) is asyncio.current_task():
+                del self._timers[user_id]
+        await self.flush(user_id)
+
+    async def flush(self, user_id: int):
+        timer = self._timers.pop(user_id, None)
+        if timer is not None and timer is not asyncio.current_task():
+            timer.cancel()
+        messages = self._take(user_id)
+        if not messages:
+            return
+        try:
+            calls = await self.flush_handler(user_id, messages)
+        except Exception as e:
+            logger.error(f"Ошибка отправки сводки уведомлений клиенту {user_id}: {e}")
+            return
+        self.digests += 1
+        self.calls += calls
+        self.calls_saved += max(sum(legacy_calls(message) for message in messages) - calls, 0)
+
+    async def stop(self):
+        """Отправляет все накопленные сводки (при остановке приложения)."""
+        for user_id in list(self._buffers):
+            await self.flush(user_id)
+
+    def stats(self) -> dict:
+        return {"window": self.window, "max_delay": self.max_delay, "pending_users": self.pending_users,
+            "buffered": self.buffered, "digests": self.digests, "cancelled": self.cancelled, "calls": self.calls,
+            "calls_saved": self.calls_saved}
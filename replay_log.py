@@ -0,0 +1,136 @@
+import uuid
+from collections import OrderedDict, deque
+from datetime import datetime, timezone
+from typing import Deque, Dict, List, Optional, Tuple
+
+from pymongo import ReturnDocument
+
+import database
+from config import logger
+
+# Промежуточные кадры (позиция в очереди, фрагменты ответа AI) номеров не получают: их заменяет итоговый кадр,
+# а init сам задает начальную позицию.
+UNSEQUENCED_TYPES = ("ai_queue", "ai_chunk", "init")
+
+
+def is_sequenced(message: dict) -> bool:
+    return message.get("type") not in UNSEQUENCED_TYPES and bool(message.get("payload", {}).get("chat_id"))
+
+
+class ReplayLog:
+    """
+    Журнал кадров, отправленных клиенту, с порядковым номером внутри чата. Клиент после переподключения
+    сообщает последний полученный номер и получает только пропущенные кадры; если журнал их уже не хранит
+    (или epoch не совпадает), сервер отправляет полный init.
+
+    Реализация в памяти: номера живут, пока жив процесс (epoch меняется при перезапуске). Хранятся
+    последние max_frames кадров для max_chats недавно активных чатов; счетчики номеров не вытесняются,
+    чтобы номер в чате никогда не начинался заново.
+    """
+
+    def __init__(self, max_frames: int = 200, max_chats: int = 10000):
+        self.epoch = uuid.uuid4().hex[:8]
+        self.max_frames = max_frames
+        self.max_chats = max_chats
+        self._counters: Dict[str, int] = {}
+        self._frames: "OrderedDict[str, Deque[Tuple[int, str]]]" = OrderedDict()
+        self.appended = 0
+        self.replayed = 0
+        self.full_inits = 0
+
+    async def start(self):
+        pass
+
+    async def next_seq(self, chat_id: str) -> int:
+        seq = self._counters.get(chat_id, 0) + 1
+        self._counters[chat_id] = seq
+        return seq
+
+    async def append(self, chat_id: str, seq: int, serialized_message: str):
+        frames = self._frames.get(chat_id)
+        if frames is None:
+            frames = self._frames[chat_id] = deque(maxlen=self.max_frames)
+            while len(self._frames) > self.max_chats:
+                self._frames.popitem(last=False)
+        else:
+            self._frames.move_to_end(chat_id)
+        frames.append((seq, serialized_message))
+        self.appended += 1
+
+    async def position(self, chat_id: str) -> int:
+        """Последний выданный номер в чате - с него клиент начинает после init."""
+        return self._counters.get(chat_id, 0)
+
+    async def since(self, chat_id: str, last_seq: int) -> Optional[List[Tuple[int, str]]]:
+        """Кадры с номером больше last_seq или None, если часть из них уже вытеснена (нужен полный init)."""
+        current = self._counters.get(chat_id, 0)
+        if last_seq > current:
+            return None
+        missed = [frame for frame in self._frames.get(chat_id, ()) if frame[0] > last_seq]
+        if len(missed) != current - last_seq:
+            return None
+        return missed
+
+    def stats(self) -> dict:
+        return {"backend": type(self).__name__, "epoch": self.epoch, "chats": len(self._frames),
+            "appended": self.appended, "replayed": self.replayed, "full_inits": self.full_inits}
+
+
+class MongoReplayLog(ReplayLog):
+    """
+    Журнал для нескольких воркеров: номер выдается атомарным $inc поля ws_seq в документе чата, кадры
+    хранятся в коллекции ws_replay и удаляются TTL-индексом через ttl секунд. Переподключиться можно
+    к любому воркеру; epoch постоянный, потому что номера хранятся в базе.
+    """
+
+    def __init__(self, max_frames: int = 200, ttl: int = 3600):
+        super().__init__(max_frames=max_frames)
+        self.epoch = "db"
+        self.ttl = ttl
+
+    @property
+    def db(self):
+        return database.db
+
+    async def start(self):
+        await self.db.ws_replay.create_index([("chat_id", 1), ("seq", 1)], unique=True)
+        await self.db.ws_replay.create_index("created_at", expireAfterSeconds=self.ttl)
+
+    async def next_seq(self, chat_id: str) -> int:
+        chat = await self.db.chats.find_one_and_update({"chat_id": chat_id}, {"$inc": {"ws_seq": 1}},
+            projection={"ws_seq": 1}, return_document=ReturnDocument.AFTER)
+        if chat is None:
+            raise ValueError(f"Чат {chat_id} не найден")
+        return chat["ws_seq"]
+
+    async def append(self, chat_id: str, seq: int, serialized_message: str):
+        await self.db.ws_replay.insert_one({"chat_id": chat_id, "seq": seq, "message": serialized_message,
+            "created_at": datetime.now(timezone.utc)})
+        self.appended += 1
+
+    async def position(self, chat_id: str) -> int:
+        chat = await self.db.chats.find_one({"chat_id": chat_id}, projection={"ws_seq": 1})
+        return (chat or {}).get("ws_seq", 0)
+
+    async def since(self, chat_id: str, last_seq: int) -> Optional[List[Tuple[int, str]]]:
+        current = await self.position(chat_id)
+        if last_seq > current or current - last_seq > self.max_frames:
+            return None
+        cursor = self.db.ws_replay.find({"chat_id": chat_id, "seq": {"$gt": last_seq}},
+            projection={"seq": 1, "message": 1}).sort("seq", 1)
+        missed = [(doc["seq"], doc["message"]) async for doc in cursor]
+        if len(missed) != current - last_seq:
+            return None
+        return missed
+
+    def stats(self) -> dict:
+        return {"backend": type(self).__name__, "epoch": self.epoch, "appended": self.appended,
+            "replayed": self.replayed, "full_inits": self.full_inits}
+
+
+def create_replay_log(name: str, max_frames: int = 200, max_chats: int = 10000, ttl: int = 3600) -> ReplayLog:
+    if name == "mongo":
+        return MongoReplayLog(max_frames=max_frames, ttl=ttl)
+    if name != "local":
+        logger.error(f"Неизвестный бэкенд журнала доставки {name}, используется local")
+    return ReplayLog(max_frames=max_frames, max_chats=max_chats)
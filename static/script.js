@@ -24,10 +24,52 @@ let inputTimeout;
 let lastWindowHeight = window.innerHeight;
 let lastSentMessage = null;
 let isSubmitting = false; // Флаг для предотвращения повторных отправок
+const aiStreams = {}; // Ответы AI, которые сейчас приходят по частям (stream_id -> элемент списка)
+// Последний полученный номер сообщения в чате: при переподключении сервер дошлет только пропущенное
+let seqChatId = null;
+let lastSeq = 0;
+let replayEpoch = null;
+// Токен сессии из init/resume: переподключение с ним не требует повторной проверки initData на сервере
+let sessionToken = null;
+let reconnectAttempts = 0;
+let reconnectTimer = null;
+const RECONNECT_BASE_DELAY = 1000;
+const RECONNECT_MAX_DELAY = 30000;
+// Курсор более старой страницы истории (null - история загружена целиком) и первый элемент истории на экране
+let historyCursor = null;
+let historyStart = null;
+let loadingHistory = false;
+// После временного сбоя загрузки истории следующий запрос - не раньше historyRetryAt (задержка удваивается)
+let historyRetryAt = 0;
+let historyRetryDelay = 0;
+// Сервер шлет ping раз в interval секунд (интервал приходит в init/resume); если от него долго не приходит
+// ни одного кадра, соединение считаем мертвым. 0 - сервер ping не отправляет, молчание не проверяется
+let lastServerFrameAt = Date.now();
+let serverSilenceTimeout = 75000;
 
 function addMessage(senderType, text, timestamp = new Date().toISOString(), senderId = '', media = null) {
+    const item = createMessageItem(senderType, text, timestamp, senderId, media);
+    if (!item) return null;
+    messages.appendChild(item);
+    scrollToLastMessage();
+    return item;
+}
+
+function senderTypeOf(senderId) {
+    if (String(senderId) === String(userId)) {
+        return 'client';
+    } else if (senderId === 'ai') {
+        return 'ai';
+    } else if (String(senderId).match(/^\d+$/)) {
+        return 'manager';
+    }
+    return 'system';
+}
+
+// Создает элемент сообщения; scrollOnLoad - прокрутить вниз, когда загрузится картинка
+function createMessageItem(senderType, text, timestamp, senderId = '', media = null, scrollOnLoad = true) {
     // Если нет ни текста, ни медиа, не создаем сообщение
-    if (!text && !media) return;
+    if (!text && !media) return null;
 
     const item = document.createElement('li');
     item.classList.add(senderType);
@@ -49,7 +91,9 @@ function addMessage(senderType, text, timestamp = new Date().toISOString(), send
                 img.style.cursor = 'pointer';
                 img.addEventListener('click', () => openMediaModal(media));
                 // Добавляем обработчик загрузки изображения
-                img.onload = () => scrollToLastMessage();
+                if (scrollOnLoad) {
+                    img.onload = () => scrollToLastMessage();
+                }
                 mediaContainer.appendChild(img);
                 break;
             case 'video':
@@ -117,11 +161,128 @@ function addMessage(senderType, text, timestamp = new Date().toISOString(), send
         timeNode.textContent += ` (${senderId})`;
     }
     item.appendChild(timeNode);
+    return item;
+}
 
-    messages.appendChild(item);
+// Вставляет страницу более старых сообщений над историей, сохраняя положение прокрутки
+function prependHistory(history) {
+    const fragment = document.createDocumentFragment();
+    history.forEach(msg => {
+        const item = createMessageItem(senderTypeOf(msg.sender_id), msg.text, msg.timestamp, msg.sender_id, msg.media, false);
+        if (item) {
+            fragment.appendChild(item);
+        }
+    });
+    const firstItem = fragment.firstChild;
+    if (!firstItem) return;
+    const previousHeight = messages.scrollHeight;
+    messages.insertBefore(fragment, historyStart && historyStart.parentNode === messages ? historyStart : messages.children[1] || null);
+    historyStart = firstItem;
+    messages.style.scrollBehavior = 'auto';
+    messages.scrollTop += messages.scrollHeight - previousHeight;
+    messages.style.scrollBehavior = '';
+}
+
+// Запрашивает предыдущую страницу истории (при прокрутке к началу)
+function loadOlderHistory() {
+    if (!historyCursor || loadingHistory || !ws || ws.readyState !== WebSocket.OPEN) return;
+    if (Date.now() < historyRetryAt) return;
+    loadingHistory = true;
+    ws.send(JSON.stringify({ type: 'load_more', payload: { chat_id: currentChatId, cursor: historyCursor } }));
+}
+
+// Если первая страница не заполнила экран, прокрутить вверх нельзя - подгружаем сразу
+function fillScreenWithHistory() {
+    if (messages.scrollHeight <= messages.clientHeight) {
+        loadOlderHistory();
+    }
+}
+
+messages.addEventListener('scroll', function() {
+    if (messages.scrollTop < 80) {
+        loadOlderHistory();
+    }
+});
+
+// Показывает или обновляет позицию вопроса в очереди к AI
+function showQueuePosition(position) {
+    let notice = document.getElementById('ai-queue-notice');
+    if (!notice) {
+        notice = document.createElement('li');
+        notice.id = 'ai-queue-notice';
+        notice.classList.add('system');
+        messages.appendChild(notice);
+    }
+    notice.textContent = `Много обращений, ваш вопрос в очереди: ${position} `;
+    notice.appendChild(createCancelButton());
+    scrollToLastMessage();
+}
+
+// Кнопка отмены ожидаемого ответа AI (в уведомлении об очереди и в ответе, который еще печатается)
+function createCancelButton() {
+    const button = document.createElement('button');
+    button.type = 'button';
+    button.classList.add('ai-cancel-btn');
+    button.textContent = 'Отменить';
+    button.addEventListener('click', cancelAiAnswer);
+    return button;
+}
+
+function cancelAiAnswer() {
+    if (!ws || ws.readyState !== WebSocket.OPEN) return;
+    ws.send(JSON.stringify({ type: 'cancel', payload: { chat_id: currentChatId } }));
+}
+
+function hideQueuePosition() {
+    const notice = document.getElementById('ai-queue-notice');
+    if (notice) {
+        notice.remove();
+    }
+}
+
+// Дописывает очередной фрагмент потокового ответа AI
+function appendAiChunk(streamId, delta) {
+    let stream = aiStreams[streamId];
+    if (!stream) {
+        const item = document.createElement('li');
+        item.classList.add('ai');
+        const textNode = document.createElement('span');
+        item.appendChild(textNode);
+        const cancelButton = createCancelButton();
+        item.appendChild(cancelButton);
+        messages.appendChild(item);
+        stream = aiStreams[streamId] = { item, textNode, cancelButton };
+    }
+    stream.textNode.textContent += delta;
+    scrollToLastMessage(false);
+}
+
+// Завершает потоковый ответ AI: подставляет итоговый текст и время
+function finishAiStream(streamId, text, timestamp) {
+    const stream = aiStreams[streamId];
+    if (!stream) {
+        addMessage('ai', text, timestamp, 'AI');
+        return;
+    }
+    delete aiStreams[streamId];
+    stream.cancelButton.remove();
+    stream.textNode.textContent = text;
+    const timeNode = document.createElement('small');
+    const date = new Date(timestamp);
+    timeNode.textContent = `${date.toLocaleTimeString([], { hour: '2-digit', minute: '2-digit' })} (AI)`;
+    stream.item.appendChild(timeNode);
     scrollToLastMessage();
 }
 
+// Убирает недописанный ответ AI, если генерация завершилась ошибкой
+function dropAiStream(streamId) {
+    const stream = aiStreams[streamId];
+    if (stream) {
+        stream.item.remove();
+        delete aiStreams[streamId];
+    }
+}
+
 function showButtons(show = true) {
     buttonContainer.style.display = show ? 'block' : 'none';
 }
@@ -131,6 +292,93 @@ function showNewChatButton(show = true) {
     form.style.display = show ? 'none' : 'flex'; // Скрываем форму ввода, если показываем кнопку "Начать новый чат"
 }
 
+// Бинарный протокол MessagePack экономит трафик; предлагаем его серверу в режиме экономии трафика
+// или если он включен вручную (localStorage.wsProtocol = 'msgpack'). По умолчанию - JSON
+function preferredWsProtocols() {
+    let saved = null;
+    try {
+        saved = localStorage.getItem('wsProtocol');
+    } catch (e) {
+        // localStorage может быть недоступен во встроенном браузере
+    }
+    const saveData = navigator.connection && navigator.connection.saveData;
+    return (saved === 'msgpack' || (saveData && saved !== 'json')) ? ['msgpack', 'json'] : [];
+}
+
+// Разбирает кадр сервера: текст - JSON, бинарный кадр - MessagePack
+function decodeServerFrame(data) {
+    return typeof data === 'string' ? JSON.parse(data) : decodeMsgpack(new Uint8Array(data));
+}
+
+const msgpackTextDecoder = new TextDecoder();
+
+// Минимальный декодер MessagePack: все типы, кроме расширений (сервер их не отправляет)
+function decodeMsgpack(bytes) {
+    const view = new DataView(bytes.buffer, bytes.byteOffset, bytes.byteLength);
+    let offset = 0;
+
+    function str(length) {
+        const value = msgpackTextDecoder.decode(bytes.subarray(offset, offset + length));
+        offset += length;
+        return value;
+    }
+    function bin(length) {
+        const value = bytes.slice(offset, offset + length);
+        offset += length;
+        return value;
+    }
+    function array(length) {
+        const value = new Array(length);
+        for (let i = 0; i < length; i++) value[i] = read();
+        return value;
+    }
+    function map(length) {
+        const value = {};
+        for (let i = 0; i < length; i++) {
+            const key = read();
+            value[key] = read();
+        }
+        return value;
+    }
+    function read() {
+        const type = view.getUint8(offset++);
+        if (type < 0x80) return type;
+        if (type < 0x90) return map(type & 0x0f);
+        if (type < 0xa0) return array(type & 0x0f);
+        if (type < 0xc0) return str(type & 0x1f);
+        if (type >= 0xe0) return type - 0x100;
+        let value;
+        switch (type) {
+            case 0xc0: return null;
+            case 0xc2: return false;
+            case 0xc3: return true;
+            case 0xc4: value = view.getUint8(offset); offset += 1; return bin(value);
+            case 0xc5: value = view.getUint16(offset); offset += 2; return bin(value);
+            case 0xc6: value = view.getUint32(offset); offset += 4; return bin(value);
+            case 0xca: value = view.getFloat32(offset); offset += 4; return value;
+            case 0xcb: value = view.getFloat64(offset); offset += 8; return value;
+            case 0xcc: value = view.getUint8(offset); offset += 1; return value;
+            case 0xcd: value = view.getUint16(offset); offset += 2; return value;
+            case 0xce: value = view.getUint32(offset); offset += 4; return value;
+            case 0xcf: value = Number(view.getBigUint64(offset)); offset += 8; return value;
+            case 0xd0: value = view.getInt8(offset); offset += 1; return value;
+            case 0xd1: value = view.getInt16(offset); offset += 2; return value;
+            case 0xd2: value = view.getInt32(offset); offset += 4; return value;
+            case 0xd3: value = Number(view.getBigInt64(offset)); offset += 8; return value;
+            case 0xd9: value = view.getUint8(offset); offset += 1; return str(value);
+            case 0xda: value = view.getUint16(offset); offset += 2; return str(value);
+            case 0xdb: value = view.getUint32(offset); offset += 4; return str(value);
+            case 0xdc: value = view.getUint16(offset); offset += 2; return array(value);
+            case 0xdd: value = view.getUint32(offset); offset += 4; return array(value);
+            case 0xde: value = view.getUint16(offset); offset += 2; return map(value);
+            case 0xdf: value = view.getUint32(offset); offset += 4; return map(value);
+        }
+        throw new Error(`MessagePack: неподдерживаемый тип 0x${type.toString(16)}`);
+    }
+
+    return read();
+}
+
 function connectWebSocket() {
     // Получаем user_id и user_name из Telegram Web App InitData
     if (tg.initDataUnsafe && tg.initDataUnsafe.user) {
@@ -145,21 +393,35 @@ function connectWebSocket() {
 
     // Формируем URL для WebSocket с InitData
     const wsProtocol = window.location.protocol === 'https:' ? 'wss:' : 'ws:';
-    const wsUrl = `${wsProtocol}//${window.location.host}/ws?initData=${encodeURIComponent(tg.initData)}`;
+    let wsUrl = `${wsProtocol}//${window.location.host}/ws?initData=${encodeURIComponent(tg.initData)}`;
+    if (sessionToken) {
+        // initData передаем и с токеном: если токен истек, сервер проверит initData
+        wsUrl += `&session=${encodeURIComponent(sessionToken)}`;
+    }
+    if (seqChatId && replayEpoch) {
+        // Переподключение: просим дослать сообщения после последнего полученного
+        wsUrl += `&chat_id=${encodeURIComponent(seqChatId)}&last_seq=${lastSeq}&epoch=${encodeURIComponent(replayEpoch)}`;
+    }
     console.log("Connecting to WebSocket:", wsUrl);
 
-    ws = new WebSocket(wsUrl);
+    ws = new WebSocket(wsUrl, preferredWsProtocols());
+    ws.binaryType = 'arraybuffer';
 
     ws.onopen = function(event) {
-        console.log("WebSocket connection opened");
-        addMessage('system', 'Соединение установлено.');
-        // Запрашиваем историю или статус при подключении (сервер отправит init)
+        console.log("WebSocket connection opened", ws.protocol || 'json');
+        if (!seqChatId && !document.getElementById('reconnect-notice')) {
+            addMessage('system', 'Соединение установлено.');
+        }
+        reconnectAttempts = 0;
+        lastServerFrameAt = Date.now();
+        hideReconnectNotice();
+        // Сервер отправит init или, при переподключении, resume с пропущенными сообщениями
     };
 
     ws.onmessage = function(event) {
-        console.log("Message from server:", event.data);
+        lastServerFrameAt = Date.now();
         try {
-            const data = JSON.parse(event.data);
+            const data = decodeServerFrame(event.data);
             handleServerMessage(data);
         } catch (e) {
             console.error("Failed to parse message or handle:", e);
@@ -169,19 +431,94 @@ function connectWebSocket() {
 
     ws.onerror = function(event) {
         console.error("WebSocket error observed:", event);
-        addMessage('system', 'Ошибка соединения. Попробуйте обновить страницу.');
     };
 
     ws.onclose = function(event) {
         console.log("WebSocket connection closed:", event);
-        addMessage('system', `Соединение закрыто (код: ${event.code}). ${event.reason || ''} Попробуйте обновить страницу.`);
         ws = null; // Сбросить объект WebSocket
-        showButtons(false);
-        showNewChatButton(false);
-        form.style.display = 'none'; // Скрыть форму ввода при разрыве
+        if (event.code === 1008) {
+            // Ошибка авторизации или чат открыт в другой вкладке: переподключение не поможет
+            addMessage('system', `Соединение закрыто (код: ${event.code}). ${event.reason || ''} Попробуйте обновить страницу.`);
+            showButtons(false);
+            showNewChatButton(false);
+            form.style.display = 'none'; // Скрыть форму ввода при разрыве
+            return;
+        }
+        scheduleReconnect();
     };
 }
 
+// Переподключение с экспоненциальной задержкой (1, 2, 4... до 30 секунд, со случайным разбросом)
+function scheduleReconnect() {
+    if (reconnectTimer) {
+        return;
+    }
+    const delay = Math.min(RECONNECT_BASE_DELAY * 2 ** reconnectAttempts, RECONNECT_MAX_DELAY) * (0.5 + Math.random() / 2);
+    reconnectAttempts++;
+    showReconnectNotice(Math.round(delay / 1000));
+    reconnectTimer = setTimeout(() => {
+        reconnectTimer = null;
+        connectWebSocket();
+    }, delay);
+}
+
+// Сеть вернулась или вкладка снова видна - переподключаемся сразу, не дожидаясь таймера
+function reconnectNow() {
+    if (ws || !reconnectTimer) {
+        return;
+    }
+    clearTimeout(reconnectTimer);
+    reconnectTimer = null;
+    connectWebSocket();
+}
+
+function showReconnectNotice(seconds) {
+    let notice = document.getElementById('reconnect-notice');
+    if (!notice) {
+        notice = document.createElement('li');
+        notice.id = 'reconnect-notice';
+        notice.classList.add('system');
+        messages.appendChild(notice);
+    }
+    notice.textContent = `Нет соединения с сервером, повторное подключение через ${seconds} с...`;
+    scrollToLastMessage();
+}
+
+function hideReconnectNotice() {
+    const notice = document.getElementById('reconnect-notice');
+    if (notice) {
+        notice.remove();
+    }
+}
+
+window.addEventListener('online', reconnectNow);
+// Молчание дольше трех интервалов ping - признак мертвого соединения
+function applyPingInterval(interval) {
+    if (typeof interval === 'number') {
+        serverSilenceTimeout = interval > 0 ? interval * 3000 : 0;
+    }
+}
+
+// Полуоткрытое соединение (телефон сменил сеть) не закрывается само - закрываем и переподключаемся
+setInterval(function() {
+    if (ws && ws.readyState === WebSocket.OPEN && serverSilenceTimeout > 0 &&
+            Date.now() - lastServerFrameAt > serverSilenceTimeout) {
+        console.warn("No frames from server, reconnecting");
+        // Закрытие мертвого соединения может ждать таймаута браузера, поэтому не ждем onclose
+        const deadSocket = ws;
+        deadSocket.onclose = null;
+        deadSocket.onmessage = null;
+        deadSocket.close(4000, 'heartbeat timeout');
+        ws = null;
+        scheduleReconnect();
+    }
+}, 10000);
+document.addEventListener('visibilitychange', function() {
+    if (document.visibilityState === 'visible') {
+        reconnectNow();
+    }
+});
+
 function handleServerMessage(data) {
     if (!data || !data.type || !data.payload) {
         console.warn("Received invalid message structure:", data);
@@ -189,6 +526,20 @@ function handleServerMessage(data) {
     }
     const payload = data.payload;
 
+    if (payload.session) {
+        sessionToken = payload.session.token;
+    }
+
+    // Сообщение с номером, который уже был (повтор после переподключения), пропускаем
+    if (payload.seq && data.type !== 'init' && data.type !== 'resume') {
+        if (payload.chat_id === seqChatId && payload.seq <= lastSeq) {
+            console.log("Skipping already received message:", payload.seq);
+            return;
+        }
+        seqChatId = payload.chat_id;
+        lastSeq = payload.seq;
+    }
+
     // Всегда обновляем currentChatId, если он пришел в сообщении
     if (payload.chat_id) {
         currentChatId = payload.chat_id;
@@ -197,21 +548,25 @@ function handleServerMessage(data) {
 
     switch (data.type) {
         case 'init':
+            applyPingInterval(payload.ping_interval);
+            seqChatId = payload.chat_id;
+            lastSeq = payload.seq || 0;
+            replayEpoch = payload.epoch || null;
+            historyCursor = payload.cursor || null;
+            historyStart = null;
+            loadingHistory = false;
+            historyRetryAt = 0;
+            historyRetryDelay = 0;
             messages.innerHTML = ''; // Очищаем старые сообщения
+            Object.keys(aiStreams).forEach(streamId => delete aiStreams[streamId]);
             addMessage('system', 'Начните диалог, отправив сообщение. Наш робот постарается ответить на ваш вопрос. Если вы будете не удовлетворены ответом, всегда можно позвать оператора.');
             if (payload.history && payload.history.length > 0) {
-                // Отключаем плавную прокрутку для загрузки истории
+                // Пришла последняя страница истории; более старые подгружаются при прокрутке вверх
                 payload.history.forEach((msg, index) => {
-                    let senderType = 'system'; // По умолчанию
-                    if (String(msg.sender_id) === String(userId)) {
-                        senderType = 'client';
-                    } else if (msg.sender_id === 'ai') {
-                        senderType = 'ai';
-                    } else if (String(msg.sender_id).match(/^\d+$/)) {
-                        senderType = 'manager';
+                    const item = addMessage(senderTypeOf(msg.sender_id), msg.text, msg.timestamp, msg.sender_id, msg.media);
+                    if (item && !historyStart) {
+                        historyStart = item;
                     }
-                    // Используем плавную прокрутку только для последнего сообщения
-                    addMessage(senderType, msg.text, msg.timestamp, msg.sender_id, msg.media);
                 });
             }
             showButtons(payload.show_buttons || false);
@@ -219,20 +574,46 @@ function handleServerMessage(data) {
             form.style.display = 'flex';
             input.disabled = false;
             // Убеждаемся, что последнее сообщение видно
-            setTimeout(() => scrollToLastMessage(true), 100);
+            setTimeout(() => {
+                scrollToLastMessage(true);
+                fillScreenWithHistory();
+            }, 100);
             break;
-        case 'message':
-            // Определяем тип отправителя
-            let senderType;
-            if (String(payload.sender_id) === String(userId)) {
-                senderType = 'client';
-            } else if (payload.sender_id === 'ai') {
-                senderType = 'ai';
-            } else if (String(payload.sender_id).match(/^\d+$/)) {
-                senderType = 'manager';
+        case 'history_page':
+            loadingHistory = false;
+            historyCursor = payload.has_more === false ? null : payload.cursor || null;
+            historyRetryDelay = 0;
+            prependHistory(payload.history || []);
+            fillScreenWithHistory();
+            break;
+        case 'history_error':
+            console.warn("History page not loaded:", payload.message);
+            loadingHistory = false;
+            if (payload.retryable) {
+                // Временный сбой: курсор сохраняем, повторим при следующей прокрутке, но не чаще задержки
+                historyRetryDelay = Math.min(historyRetryDelay ? historyRetryDelay * 2 : 1000, 30000);
+                historyRetryAt = Date.now() + historyRetryDelay;
             } else {
-                senderType = 'system';
+                // Курсор некорректен - повторный запрос закончится так же, старые сообщения больше не подгружаем
+                historyCursor = null;
+            }
+            break;
+        case 'ping':
+            applyPingInterval(payload.interval);
+            ws.send(JSON.stringify({ type: 'pong', payload: {} }));
+            break;
+        case 'resume':
+            applyPingInterval(payload.ping_interval);
+            // Сервер продолжил сессию: история на экране актуальна, следом придут только пропущенные сообщения
+            console.log(`Session resumed from ${payload.seq}, missed: ${payload.replayed}`);
+            if (payload.status !== 'closed') {
+                form.style.display = 'flex';
+                input.disabled = false;
             }
+            break;
+        case 'message':
+            // Определяем тип отправителя
+            const senderType = senderTypeOf(payload.sender_id);
             
             // Проверяем, не является ли это дубликатом файла
             if (payload.media && lastSentMessage && payload.media.file_id === `${currentChatId}/${selectedFile?.name}`) {
@@ -242,12 +623,27 @@ function handleServerMessage(data) {
             
             addMessage(senderType, payload.text, payload.timestamp, payload.sender_id, payload.media);
             break;
+        case 'ai_queue':
+            showQueuePosition(payload.position);
+            break;
         case 'ai_response':
+            hideQueuePosition();
             addMessage('ai', payload.text, payload.timestamp, 'AI');
             if (payload.show_buttons) {
                 showButtons(true);
             }
             break;
+        case 'ai_chunk':
+            hideQueuePosition();
+            appendAiChunk(payload.stream_id, payload.delta);
+            break;
+        case 'ai_done':
+            hideQueuePosition();
+            finishAiStream(payload.stream_id, payload.text, payload.timestamp);
+            if (payload.show_buttons) {
+                showButtons(true);
+            }
+            break;
         case 'status_update':
             addMessage('system', payload.message);
             if (payload.new_chat_id) {
@@ -260,7 +656,18 @@ function handleServerMessage(data) {
                 input.disabled = true;
             }
             break;
+        case 'ai_cancelled':
+            hideQueuePosition();
+            Object.keys(aiStreams).forEach(dropAiStream);
+            if (payload.cancelled) {
+                addMessage('system', 'Ответ отменен. Можете задать другой вопрос.');
+            }
+            break;
         case 'error':
+            hideQueuePosition();
+            if (payload.stream_id) {
+                dropAiStream(payload.stream_id);
+            }
             addMessage('system', `Ошибка: ${payload.message}`);
             if (payload.show_operator_button) {
                 showButtons(true);
@@ -14,6 +14,7 @@ from datetime import datetime, timedelta, timezone
 from typing import Optional
 
 import database as db
+from ai_integration import reload_ai, get_ai_stats, chat_memory
 from config import TELEGRAM_BOT_TOKEN, MANAGER_GROUP_CHAT_ID, logger, ADMIN_USER_ID
 from minio_storage import minio_storage
 from models import Chat, Message as DbMessage, MediaContent
@@ -164,6 +165,16 @@ async def add_manager_command(message: Message):
     await message.reply(f"Пользователь {manager_id} ({manager_name or 'Без имени'}) успешно добавлен как менеджер.")
 
 
+@dp.message(Command("reload"))
+async def reload_command(message: Message):
+    if str(message.from_user.id) != db.ADMIN_USER_ID:
+        return await message.reply("У вас нет прав для выполнения этой команды.")
+    await reload_ai()
+    stats = get_ai_stats()["context"]
+    await message.reply(f"Контекст и настройки AI перезагружены. Версия контекста: {stats['version']}, "
+                        f"записей: {stats['entries']}.")
+
+
 @dp.message(F.chat.id == MANAGER_GROUP_CHAT_ID, F.message_thread_id)
 async def handle_manager_message(message: types.Message):
     manager_id = int(message.from_user.id)
@@ -226,6 +237,7 @@ async def handle_manager_message(message: types.Message):
             logger.error(f"Ошибка при загрузке файла в MinIO: {e}")
             return
     await db.add_message(db_message)
+    chat_memory.record(chat.chat_id, "assistant", db_message.text)
     message_data = {"type": "message",
         "payload": {"chat_id": chat.chat_id, "sender_id": str(manager_id), "sender_type": "manager",
             "text": db_message.text, "timestamp": db_message.timestamp.isoformat()}}
@@ -0,0 +1,8 @@
+"""Общая подготовка тестов: корень репозитория в sys.path и обязательные переменные окружения config.py."""
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+for name, value in {"TELEGRAM_BOT_TOKEN": "123:test", "MONGO_CONNECTION_STRING": "mongodb://localhost",
+                    "MANAGER_GROUP_CHAT_ID": "-1"}.items():
+    os.environ.setdefault(name, value)
@@ -0,0 +1,146 @@
+"""Автомат AI-бэкенда (circuit breaker), переключение на другой бэкенд и hedging в BackendPool."""
+import asyncio
+import time
+from types import SimpleNamespace
+
+import pytest
+
+import ai_backends
+from ai_backends import Backend, BackendPool, BackendSettings, NoBackendAvailable
+
+
+class Clock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self) -> float:
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    # Подменяется модуль time внутри ai_backends, а не time.monotonic: на нем работают таймеры asyncio
+    monkeypatch.setattr(ai_backends, "time", SimpleNamespace(monotonic=clock, perf_counter=time.perf_counter))
+    return clock
+
+
+def make_backend(name: str, delay: float = 0.0, error: Exception = None, failure_threshold: int = 3,
+                 cooldown: float = 30.0) -> Backend:
+    """Бэкенд без сети: отвечает своим именем через delay секунд или падает с error до первого фрагмента."""
+    backend = Backend(BackendSettings(name=name, base_url="http://localhost", model_name="test"), client=None,
+        failure_threshold=failure_threshold, cooldown=cooldown)
+    backend.closed_streams = 0
+
+    async def deltas(messages: list, stream: bool, **params):
+        try:
+            await asyncio.sleep(delay)
+            if error is not None:
+                raise error
+            yield name
+        finally:
+            backend.closed_streams += 1
+
+    backend.deltas = deltas
+    return backend
+
+
+async def answer(pool: BackendPool) -> str:
+    return "".join([delta async for delta in pool.complete([], True)])
+
+
+def test_breaker_opens_after_consecutive_failures(clock):
+    backend = make_backend("main", failure_threshold=3)
+    for _ in range(2):
+        backend.record_failure(RuntimeError("500"))
+    assert backend.available()
+
+    backend.record_failure(RuntimeError("500"))
+    assert backend.state == "open"
+    assert not backend.available()
+
+
+def test_breaker_lets_one_probe_through_after_cooldown(clock):
+    backend = make_backend("main", failure_threshold=1, cooldown=30)
+    backend.record_failure(RuntimeError("500"))
+
+    clock.now += 30
+    assert backend.available()
+    assert backend.state == "half_open"
+    backend.acquire()
+    assert not backend.available()
+
+    backend.record_success(0.1)
+    backend.release()
+    assert backend.state == "closed"
+    assert backend.available()
+
+
+def test_failed_probe_opens_breaker_again(clock):
+    backend = make_backend("main", failure_threshold=3, cooldown=30)
+    for _ in range(3):
+        backend.record_failure(RuntimeError("500"))
+    clock.now += 30
+    assert backend.available()
+    backend.acquire()
+
+    backend.record_failure(RuntimeError("500"))
+    backend.release()
+    assert backend.state == "open"
+    assert not backend.available()
+
+
+def test_request_fails_over_to_next_backend():
+    broken = make_backend("broken", error=RuntimeError("connection refused"))
+    spare = make_backend("spare")
+    spare.latency_ewma = 1.0  # без замеров бэкенд пробуется первым: первым должен быть broken
+    pool = BackendPool([broken, spare])
+
+    assert asyncio.run(answer(pool)) == "spare"
+    assert pool.failovers == 1
+    assert broken.failures == 1
+    assert broken.in_flight == 0 and spare.in_flight == 0
+
+
+def test_no_available_backend_raises_last_error():
+    pool = BackendPool([make_backend("broken", error=RuntimeError("connection refused"))])
+    with pytest.raises(RuntimeError, match="connection refused"):
+        asyncio.run(answer(pool))
+
+    pool = BackendPool([make_backend("down", failure_threshold=1)])
+    pool.backends[0].record_failure(RuntimeError("500"))
+    with pytest.raises(NoBackendAvailable):
+        asyncio.run(answer(pool))
+
+
+def test_hedge_wins_when_first_backend_is_slow():
+    slow = make_backend("slow", delay=5)
+    fast = make_backend("fast", delay=0.01)
+    fast.latency_ewma = 1.0
+    pool = BackendPool([slow, fast], hedging=True, hedge_min_delay=0.05)
+
+    async def scenario():
+        result = await answer(pool)
+        await asyncio.sleep(0.01)  # отмененная попытка закрывает поток
+        return result
+
+    assert asyncio.run(scenario()) == "fast"
+    assert pool.hedges == 1
+    assert fast.hedges_won == 1
+    assert slow.closed_streams == 1
+    assert slow.in_flight == 0 and fast.in_flight == 0
+
+
+def test_cancelled_probe_reopens_breaker(clock):
+    probe = make_backend("probe", delay=5, failure_threshold=1, cooldown=30)
+    probe.record_failure(RuntimeError("500"))
+    clock.now += 30
+    fast = make_backend("fast", delay=0.01)
+    fast.latency_ewma = 1.0
+    pool = BackendPool([probe, fast], hedging=True, hedge_min_delay=0.05)
+
+    assert asyncio.run(answer(pool)) == "fast"
+    assert probe.state == "open"
+    assert not probe.probing
+    clock.now += 30
+    assert probe.available()
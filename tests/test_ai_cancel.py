@@ -0,0 +1,110 @@
+"""
+Отмена ответа AI (сообщение cancel): отмена задачи чата в MessagePipeline должна отменять и запрос к модели,
+если ответа больше никто не ждет, и не трогать его, пока ответ нужен другому клиенту. Модель заменена
+пулом-заглушкой, сеть, MongoDB и MinIO не нужны.
+
+Запуск из корня репозитория:
+    python -m pytest -q tests
+"""
+import asyncio
+from contextlib import aclosing
+
+import pytest
+
+import ai_integration
+from message_pipeline import MessagePipeline
+
+
+class FakePool:
+    """Бэкенд, который отдает первый фрагмент и ждет; запоминает, что запрос к нему отменили."""
+
+    def __init__(self):
+        self.calls = 0
+        self.cancelled = 0
+        self.started = asyncio.Event()
+
+    async def complete(self, messages: list, stream: bool = True, **params):
+        self.calls += 1
+        try:
+            yield "Здравствуйте"
+            self.started.set()
+            await asyncio.sleep(60)
+            yield "!"
+        except asyncio.CancelledError:
+            self.cancelled += 1
+            raise
+
+
+@pytest.fixture
+def pool(monkeypatch):
+    pool = FakePool()
+
+    async def get_pool(route):
+        return pool
+
+    monkeypatch.setattr(ai_integration, "_settings", object())
+    monkeypatch.setattr(ai_integration, "_get_pool", get_pool)
+    monkeypatch.setattr(ai_integration, "_choose_route", lambda user_message, history: ("main", 100))
+    monkeypatch.setattr(ai_integration, "_build_messages", lambda user_message, history: ([], None))
+    monkeypatch.setattr(ai_integration, "_store_answer", lambda *args: None)
+    monkeypatch.setattr(ai_integration, "_inflight", {})
+    return pool
+
+
+def answer_pipeline(received: list) -> MessagePipeline:
+    """Очередь сообщений, которая, как main.generate_ai_answer, пересылает фрагменты ответа модели."""
+
+    async def handler(message: dict):
+        async with aclosing(ai_integration.stream_ai_response(message["text"])) as deltas:
+            async for delta in deltas:
+                received.append(delta)
+
+    return MessagePipeline(handler)
+
+
+async def wait_idle(pipeline: MessagePipeline, chat_id: str):
+    for _ in range(100):
+        if not pipeline.busy(chat_id):
+            return
+        await asyncio.sleep(0.01)
+    raise AssertionError("задача чата не завершилась после отмены")
+
+
+def test_cancel_stops_upstream_request(pool):
+    async def scenario():
+        received = []
+        pipeline = answer_pipeline(received)
+        pipeline.submit("chat-1", {"text": "Как продлить аренду?"})
+        await asyncio.wait_for(pool.started.wait(), 1)
+
+        assert pipeline.cancel("chat-1") == 1
+        await wait_idle(pipeline, "chat-1")
+        await asyncio.sleep(0)
+
+        assert received == ["Здравствуйте"]
+        assert pool.cancelled == 1
+        assert not ai_integration.is_answer_in_flight("Как продлить аренду?")
+
+    asyncio.run(scenario())
+
+
+def test_cancel_keeps_request_shared_with_other_client(pool):
+    async def scenario():
+        first, second = [], []
+        first_pipeline, second_pipeline = answer_pipeline(first), answer_pipeline(second)
+        first_pipeline.submit("chat-1", {"text": "Как продлить аренду?"})
+        second_pipeline.submit("chat-2", {"text": "как продлить аренду"})
+        await asyncio.wait_for(pool.started.wait(), 1)
+
+        first_pipeline.cancel("chat-1")
+        await wait_idle(first_pipeline, "chat-1")
+        assert pool.calls == 1
+        assert pool.cancelled == 0
+        assert ai_integration.is_answer_in_flight("Как продлить аренду?")
+
+        second_pipeline.cancel("chat-2")
+        await wait_idle(second_pipeline, "chat-2")
+        await asyncio.sleep(0)
+        assert pool.cancelled == 1
+
+    asyncio.run(scenario())
@@ -0,0 +1,131 @@
+"""AIScheduler: лимит одновременных запросов, очередь с позициями, переполнение и один вопрос на пользователя."""
+import asyncio
+
+import pytest
+
+from ai_scheduler import AIQueueFull, AIScheduler, AIUserBusy
+
+
+async def hold_slot(scheduler: AIScheduler, user_id: int, release: asyncio.Event, positions: list = None,
+                    needs_capacity: bool = True):
+    async def on_queue_position(position: int):
+        positions.append(position)
+
+    async with scheduler.slot(user_id, on_queue_position if positions is not None else None,
+                              needs_capacity=needs_capacity):
+        await release.wait()
+
+
+def test_requests_over_capacity_wait_in_queue():
+    async def scenario():
+        scheduler = AIScheduler(max_concurrency=1, max_queue=10)
+        release_first, release_second = asyncio.Event(), asyncio.Event()
+        positions = []
+        first = asyncio.create_task(hold_slot(scheduler, 1, release_first))
+        second = asyncio.create_task(hold_slot(scheduler, 2, release_second, positions))
+        await asyncio.sleep(0.01)
+        assert scheduler.stats()["active"] == 1
+        assert scheduler.stats()["queued"] == 1
+        assert positions == [1]
+
+        release_first.set()
+        await first
+        await asyncio.sleep(0.01)
+        assert scheduler.stats()["active"] == 1
+        assert scheduler.stats()["queued"] == 0
+
+        release_second.set()
+        await second
+        assert scheduler.stats()["active"] == 0
+        assert scheduler.admitted == 2
+
+    asyncio.run(scenario())
+
+
+def test_queue_positions_move_up_as_slots_free():
+    async def scenario():
+        scheduler = AIScheduler(max_concurrency=1, max_queue=10)
+        releases = [asyncio.Event() for _ in range(3)]
+        positions = {user_id: [] for user_id in range(3)}
+        tasks = [asyncio.create_task(hold_slot(scheduler, user_id, releases[user_id], positions[user_id]))
+                 for user_id in range(3)]
+        await asyncio.sleep(0.01)
+        releases[0].set()
+        await asyncio.sleep(0.01)
+
+        assert positions[1] == [1]
+        assert positions[2] == [2, 1]
+        for release in releases:
+            release.set()
+        await asyncio.gather(*tasks)
+
+    asyncio.run(scenario())
+
+
+def test_full_queue_rejects_request():
+    async def scenario():
+        scheduler = AIScheduler(max_concurrency=1, max_queue=1)
+        release = asyncio.Event()
+        tasks = [asyncio.create_task(hold_slot(scheduler, user_id, release)) for user_id in (1, 2)]
+        await asyncio.sleep(0.01)
+
+        with pytest.raises(AIQueueFull):
+            await hold_slot(scheduler, 3, release)
+        assert scheduler.rejected_queue_full == 1
+        release.set()
+        await asyncio.gather(*tasks)
+
+    asyncio.run(scenario())
+
+
+def test_second_question_of_same_user_is_rejected():
+    async def scenario():
+        scheduler = AIScheduler(max_concurrency=4, max_queue=10)
+        release = asyncio.Event()
+        task = asyncio.create_task(hold_slot(scheduler, 1, release))
+        await asyncio.sleep(0.01)
+
+        with pytest.raises(AIUserBusy):
+            await hold_slot(scheduler, 1, release)
+        assert scheduler.rejected_user_busy == 1
+        release.set()
+        await task
+        # После ответа пользователь снова может спрашивать
+        await hold_slot(scheduler, 1, release)
+
+    asyncio.run(scenario())
+
+
+def test_cancelled_waiter_leaves_queue():
+    async def scenario():
+        scheduler = AIScheduler(max_concurrency=1, max_queue=10)
+        release = asyncio.Event()
+        first = asyncio.create_task(hold_slot(scheduler, 1, release))
+        waiter = asyncio.create_task(hold_slot(scheduler, 2, release))
+        await asyncio.sleep(0.01)
+
+        waiter.cancel()
+        await asyncio.sleep(0.01)
+        assert scheduler.stats()["queued"] == 0
+        release.set()
+        await first
+        assert scheduler.stats()["active"] == 0
+
+    asyncio.run(scenario())
+
+
+def test_joining_request_does_not_need_capacity():
+    async def scenario():
+        scheduler = AIScheduler(max_concurrency=1, max_queue=0)
+        release = asyncio.Event()
+        first = asyncio.create_task(hold_slot(scheduler, 1, release))
+        await asyncio.sleep(0.01)
+
+        joined = asyncio.create_task(hold_slot(scheduler, 2, release, needs_capacity=False))
+        await asyncio.sleep(0.01)
+        assert not joined.done()
+        assert scheduler.stats()["active"] == 1
+        release.set()
+        await asyncio.gather(first, joined)
+
+    asyncio.run(scenario())
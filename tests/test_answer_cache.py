@@ -0,0 +1,70 @@
+"""AnswerCache: нормализация вопроса, TTL, LRU-вытеснение и сброс при смене версии контекста."""
+import time
+from types import SimpleNamespace
+
+import pytest
+
+import answer_cache
+from answer_cache import AnswerCache
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = SimpleNamespace(now=1000.0)
+    monkeypatch.setattr(answer_cache, "time", SimpleNamespace(monotonic=lambda: clock.now, time=time.time))
+    return clock
+
+
+def test_hit_ignores_case_and_punctuation():
+    cache = AnswerCache()
+    cache.get("Как продлить аренду?", "v1")
+    cache.put("Как продлить аренду?", "v1", "Напишите оператору")
+
+    assert cache.get("как продлить  аренду", "v1") == "Напишите оператору"
+    assert cache.hits == 1
+    assert cache.misses == 1
+
+
+def test_entry_expires_after_ttl(clock):
+    cache = AnswerCache(ttl=60)
+    cache.get("Где офис?", "v1")
+    cache.put("Где офис?", "v1", "В центре")
+
+    clock.now += 59
+    assert cache.get("Где офис?", "v1") == "В центре"
+    clock.now += 2
+    assert cache.get("Где офис?", "v1") is None
+    assert cache.stats()["size"] == 0
+
+
+def test_context_version_change_clears_cache():
+    cache = AnswerCache()
+    cache.get("Где офис?", "v1")
+    cache.put("Где офис?", "v1", "В центре")
+
+    assert cache.get("Где офис?", "v2") is None
+    assert cache.stats()["size"] == 0
+    assert cache.stats()["context_version"] == "v2"
+
+
+def test_answer_computed_for_old_version_is_not_stored():
+    cache = AnswerCache()
+    cache.get("Где офис?", "v1")
+    cache.get("Где офис?", "v2")
+    cache.put("Где офис?", "v1", "Старый адрес")
+
+    assert cache.get("Где офис?", "v2") is None
+
+
+def test_least_recently_used_entry_is_evicted():
+    cache = AnswerCache(max_size=2)
+    cache.get("первый", "v1")
+    cache.put("первый", "v1", "1")
+    cache.put("второй", "v1", "2")
+    cache.get("первый", "v1")
+    cache.put("третий", "v1", "3")
+
+    assert cache.get("второй", "v1") is None
+    assert cache.get("первый", "v1") == "1"
+    assert cache.get("третий", "v1") == "3"
+    assert cache.evictions == 1
@@ -0,0 +1,122 @@
+"""Миграции базы: порядок, запись примененных версий, повторный запуск и дубликаты под уникальным индексом."""
+import asyncio
+
+import pytest
+from pymongo.errors import DuplicateKeyError, OperationFailure
+
+import db_migrations
+
+
+class FakeCollection:
+    """Коллекция, которая записывает вызовы в общий журнал; дубликаты user_id задаются списком групп."""
+
+    def __init__(self, name: str, log: list):
+        self.name = name
+        self.log = log
+        self.docs = []
+        self.duplicates = []
+
+    async def create_index(self, keys, **options):
+        self.log.append((self.name, "create_index", keys, options.get("unique", False)))
+
+    async def drop_index(self, name: str):
+        raise OperationFailure("index not found", code=27)
+
+    def aggregate(self, pipeline: list, **options):
+        async def groups():
+            for group in self.duplicates:
+                yield group
+        return groups()
+
+    async def delete_many(self, query: dict):
+        self.log.append((self.name, "delete_many", query["_id"]["$in"]))
+        return type("DeleteResult", (), {"deleted_count": len(query["_id"]["$in"])})()
+
+    def find(self, query: dict):
+        async def documents():
+            for doc in list(self.docs):
+                yield doc
+        return documents()
+
+    async def insert_one(self, doc: dict):
+        if any(existing["_id"] == doc["_id"] for existing in self.docs):
+            raise DuplicateKeyError("duplicate _id")
+        self.docs.append(doc)
+
+
+class FakeDB:
+    def __init__(self):
+        self.log = []
+        self.collections = {}
+
+    def __getitem__(self, name: str) -> FakeCollection:
+        return self.collections.setdefault(name, FakeCollection(name, self.log))
+
+    def __getattr__(self, name: str) -> FakeCollection:
+        if name.startswith("_"):
+            raise AttributeError(name)
+        return self[name]
+
+
+@pytest.fixture
+def db():
+    return FakeDB()
+
+
+def test_migrations_are_applied_in_order_and_recorded(db):
+    applied = asyncio.run(db_migrations.apply_migrations(db))
+
+    versions = [version for version, _, _ in db_migrations.MIGRATIONS]
+    assert applied == versions == sorted(versions)
+    assert [doc["_id"] for doc in db.schema_migrations.docs] == versions
+    created = [name for name, action, _, _ in db.log if action == "create_index"]
+    assert created == ["chats"] * 4 + ["chat_messages", "chats", "users", "managers"]
+
+
+def test_second_run_applies_nothing(db):
+    asyncio.run(db_migrations.apply_migrations(db))
+    calls = len(db.log)
+
+    assert asyncio.run(db_migrations.apply_migrations(db)) == []
+    assert len(db.log) == calls
+
+
+def test_migration_recorded_by_another_worker_is_not_an_error(db, monkeypatch):
+    original = db_migrations.applied_versions
+
+    async def stale_versions(database):
+        # Другой воркер записал миграцию 1 между чтением списка и записью этого воркера
+        versions = await original(database)
+        await db.schema_migrations.insert_one({"_id": 1, "description": "другой воркер"})
+        return versions
+
+    monkeypatch.setattr(db_migrations, "applied_versions", stale_versions)
+
+    assert 1 in asyncio.run(db_migrations.apply_migrations(db))
+    assert [doc["_id"] for doc in db.schema_migrations.docs].count(1) == 1
+
+
+def test_duplicates_block_unique_index_without_deleting(db):
+    db.users.duplicates = [{"_id": 42, "ids": ["a", "b", "c"]}]
+
+    with pytest.raises(db_migrations.DuplicatesFound, match="users"):
+        asyncio.run(db_migrations.apply_migrations(db))
+
+    assert not [entry for entry in db.log if entry[1] == "delete_many"]
+    assert ("users", "create_index", "user_id", True) not in db.log
+    assert ("managers", "create_index", "user_id", True) in db.log
+    assert 4 not in [doc["_id"] for doc in db.schema_migrations.docs]
+
+
+def test_blocked_migration_is_retried_after_dedupe(db):
+    db.users.duplicates = [{"_id": 42, "ids": ["a", "b", "c"]}]
+    with pytest.raises(db_migrations.DuplicatesFound):
+        asyncio.run(db_migrations.apply_migrations(db))
+
+    assert asyncio.run(db_migrations.remove_duplicates(db.users, "user_id")) == 2
+    assert not [entry for entry in db.log if entry[1] == "delete_many"]
+    assert asyncio.run(db_migrations.remove_duplicates(db.users, "user_id", apply=True)) == 2
+    assert ("users", "delete_many", ["b", "c"]) in db.log
+
+    db.users.duplicates = []
+    assert asyncio.run(db_migrations.apply_migrations(db)) == [4]
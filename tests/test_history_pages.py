@@ -0,0 +1,113 @@
+"""Keyset-пагинация истории чата: курсор "timestamp|_id" и границы страниц при одинаковом времени сообщений."""
+import asyncio
+from datetime import datetime, timedelta, timezone
+
+import pytest
+
+import database
+
+
+class FakeCursor:
+    def __init__(self, docs: list):
+        self.docs = docs
+
+    def sort(self, keys: list):
+        for field, direction in reversed(keys):
+            self.docs.sort(key=lambda doc: doc[field], reverse=direction < 0)
+        return self
+
+    def limit(self, count: int):
+        self.docs = self.docs[:count]
+        return self
+
+    async def to_list(self, length: int) -> list:
+        return self.docs[:length]
+
+
+def matches(doc: dict, query: dict) -> bool:
+    """Условия, которые строит get_chat_history_page: равенство, $lt, $gte и $or."""
+    for field, condition in query.items():
+        if field == "$or":
+            if not any(matches(doc, option) for option in condition):
+                return False
+        elif isinstance(condition, dict):
+            if "$lt" in condition and not doc[field] < condition["$lt"]:
+                return False
+            if "$gte" in condition and not doc[field] >= condition["$gte"]:
+                return False
+        elif doc[field] != condition:
+            return False
+    return True
+
+
+class FakeMessages:
+    def __init__(self, docs: list):
+        self.docs = docs
+
+    def find(self, query: dict) -> FakeCursor:
+        return FakeCursor([doc for doc in self.docs if matches(doc, query)])
+
+
+@pytest.fixture
+def chat_messages(monkeypatch):
+    """Семь сообщений чата; у третьего-пятого одинаковое время, порядок между ними задает _id."""
+    start = datetime(2026, 1, 1, tzinfo=timezone.utc)
+    times = [0, 1, 2, 2, 2, 3, 4]
+    docs = [{"_id": f"m{index}", "chat_id": "chat-1", "sender_id": "1", "text": str(index),
+             "timestamp": start + timedelta(minutes=minute)} for index, minute in enumerate(times)]
+    docs.append({"_id": "other", "chat_id": "chat-2", "sender_id": "1", "text": "x", "timestamp": start})
+    monkeypatch.setattr(database, "db", type("FakeDB", (), {"chat_messages": FakeMessages(docs)})())
+    return docs
+
+
+def load_all_pages(limit: int, since=None) -> list:
+    async def scenario():
+        pages = []
+        before = None
+        while True:
+            messages, cursor = await database.get_chat_history_page("chat-1", limit, before=before, since=since)
+            pages.append([message.id for message in messages])
+            if cursor is None:
+                return pages
+            before = database.decode_history_cursor(database.encode_history_cursor(cursor))
+
+    return asyncio.run(scenario())
+
+
+def test_cursor_round_trip():
+    cursor = (datetime(2026, 1, 1, 12, 30, 15, 123000, tzinfo=timezone.utc), "5f0c2d9e|with-separator")
+    encoded = database.encode_history_cursor(cursor)
+
+    assert database.decode_history_cursor(encoded) == cursor
+    assert database.encode_history_cursor(None) is None
+
+
+@pytest.mark.parametrize("value", ["", "no-separator", "not-a-date|m1"])
+def test_malformed_cursor_is_rejected(value):
+    with pytest.raises(ValueError):
+        database.decode_history_cursor(value)
+
+
+def test_pages_cover_history_once_in_order(chat_messages):
+    pages = load_all_pages(limit=2)
+
+    assert pages == [["m5", "m6"], ["m3", "m4"], ["m1", "m2"], ["m0"]]
+
+
+def test_page_boundary_inside_equal_timestamps(chat_messages):
+    pages = load_all_pages(limit=3)
+
+    assert pages == [["m4", "m5", "m6"], ["m1", "m2", "m3"], ["m0"]]
+
+
+def test_last_full_page_has_no_cursor(chat_messages):
+    pages = load_all_pages(limit=7)
+
+    assert pages == [["m0", "m1", "m2", "m3", "m4", "m5", "m6"]]
+
+
+def test_reopened_chat_shows_only_new_messages(chat_messages):
+    since = chat_messages[5]["timestamp"]
+    pages = load_all_pages(limit=1, since=since)
+
+    assert pages == [["m6"], ["m5"]]
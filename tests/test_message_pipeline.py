@@ -0,0 +1,83 @@
+"""
+MessagePipeline: сообщения одного чата обрабатываются по порядку, разных чатов - параллельно; при закрытии
+соединения очереди не переживают его.
+
+Запуск из корня репозитория:
+    python -m pytest -q tests
+"""
+import asyncio
+
+from message_pipeline import MessagePipeline
+
+
+def recording_pipeline(events: list, delays: dict) -> MessagePipeline:
+    """Обработчик записывает начало и конец сообщения; delays - время обработки по тексту сообщения."""
+
+    async def handler(message: dict):
+        events.append(("start", message["text"]))
+        await asyncio.sleep(delays.get(message["text"], 0))
+        events.append(("done", message["text"]))
+
+    return MessagePipeline(handler)
+
+
+async def wait_idle(pipeline: MessagePipeline):
+    for _ in range(200):
+        if not pipeline.pending:
+            return
+        await asyncio.sleep(0.01)
+    raise AssertionError("очередь не обработана")
+
+
+def test_messages_of_one_chat_are_processed_in_order():
+    async def scenario():
+        events = []
+        pipeline = recording_pipeline(events, {"первое": 0.05, "второе": 0})
+        assert pipeline.submit("chat-1", {"text": "первое"})
+        assert pipeline.submit("chat-1", {"text": "второе"})
+        await wait_idle(pipeline)
+        assert events == [("start", "первое"), ("done", "первое"), ("start", "второе"), ("done", "второе")]
+
+    asyncio.run(scenario())
+
+
+def test_messages_of_different_chats_run_concurrently():
+    async def scenario():
+        events = []
+        pipeline = recording_pipeline(events, {"медленное": 0.05, "быстрое": 0})
+        pipeline.submit("chat-1", {"text": "медленное"})
+        pipeline.submit("chat-2", {"text": "быстрое"})
+        await wait_idle(pipeline)
+        assert events.index(("done", "быстрое")) < events.index(("done", "медленное"))
+
+    asyncio.run(scenario())
+
+
+def test_close_cancels_current_and_queued_messages():
+    async def scenario():
+        events = []
+        pipeline = recording_pipeline(events, {"первое": 60})
+        pipeline.submit("chat-1", {"text": "первое"})
+        pipeline.submit("chat-1", {"text": "второе"})
+        await asyncio.sleep(0.01)
+
+        assert await pipeline.close() == 2
+        await asyncio.sleep(0.01)
+        assert events == [("start", "первое")]
+        assert pipeline.pending == 0
+        assert not pipeline.submit("chat-1", {"text": "третье"})
+
+    asyncio.run(scenario())
+
+
+def test_close_lets_accepted_messages_finish_within_timeout():
+    async def scenario():
+        events = []
+        pipeline = recording_pipeline(events, {"первое": 0.02})
+        pipeline.submit("chat-1", {"text": "первое"})
+        pipeline.submit("chat-1", {"text": "второе"})
+
+        assert await pipeline.close(timeout=1) == 0
+        assert events[-1] == ("done", "второе")
+
+    asyncio.run(scenario())
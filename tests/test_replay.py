@@ -0,0 +1,92 @@
+"""Журнал повторной доставки: номера кадров в чате, epoch и пропущенные кадры после переподключения."""
+import asyncio
+import sys
+import types
+
+import pytest
+
+from replay_log import ReplayLog, is_sequenced
+
+# websocket_manager при импорте создает клиент MinIO; для журнала он не нужен
+sys.modules.setdefault("minio_storage", types.SimpleNamespace(minio_storage=None))
+
+from delivery import InProcessDelivery  # noqa: E402
+from websocket_manager import ConnectionManager  # noqa: E402
+
+
+async def fill(replay: ReplayLog, chat_id: str, count: int):
+    for _ in range(count):
+        seq = await replay.next_seq(chat_id)
+        await replay.append(chat_id, seq, f"frame-{seq}")
+
+
+@pytest.fixture
+def manager():
+    return ConnectionManager(delivery=InProcessDelivery(), replay=ReplayLog(max_frames=3), ping_interval=0)
+
+
+def test_only_final_chat_frames_are_sequenced():
+    assert is_sequenced({"type": "message", "payload": {"chat_id": "chat-1"}})
+    assert not is_sequenced({"type": "ai_chunk", "payload": {"chat_id": "chat-1"}})
+    assert not is_sequenced({"type": "init", "payload": {"chat_id": "chat-1"}})
+    assert not is_sequenced({"type": "message", "payload": {"chat_id": None}})
+
+
+def test_sequence_numbers_are_per_chat():
+    async def scenario():
+        replay = ReplayLog()
+        await fill(replay, "chat-1", 3)
+        await fill(replay, "chat-2", 1)
+        return await replay.position("chat-1"), await replay.position("chat-2"), await replay.position("chat-3")
+
+    assert asyncio.run(scenario()) == (3, 1, 0)
+
+
+def test_missed_frames_are_replayed(manager):
+    async def scenario():
+        await fill(manager.replay, "chat-1", 5)
+        return await manager.missed_frames("chat-1", 3, manager.replay.epoch)
+
+    assert asyncio.run(scenario()) == ["frame-4", "frame-5"]
+    assert manager.replay.replayed == 2
+
+
+def test_up_to_date_client_gets_nothing(manager):
+    async def scenario():
+        await fill(manager.replay, "chat-1", 2)
+        return await manager.missed_frames("chat-1", 2, manager.replay.epoch)
+
+    assert asyncio.run(scenario()) == []
+
+
+def test_evicted_frames_require_full_init(manager):
+    async def scenario():
+        await fill(manager.replay, "chat-1", 5)
+        return await manager.missed_frames("chat-1", 1, manager.replay.epoch)
+
+    assert asyncio.run(scenario()) is None
+    assert manager.replay.full_inits == 1
+
+
+def test_other_epoch_requires_full_init(manager):
+    async def scenario():
+        await fill(manager.replay, "chat-1", 2)
+        return await manager.missed_frames("chat-1", 1, "restarted")
+
+    assert asyncio.run(scenario()) is None
+
+
+def test_sequence_ahead_of_server_requires_full_init(manager):
+    async def scenario():
+        await fill(manager.replay, "chat-1", 2)
+        return await manager.missed_frames("chat-1", 7, manager.replay.epoch)
+
+    assert asyncio.run(scenario()) is None
+
+
+def test_replay_position_carries_epoch(manager):
+    async def scenario():
+        await fill(manager.replay, "chat-1", 4)
+        return await manager.replay_position("chat-1")
+
+    assert asyncio.run(scenario()) == {"seq": 4, "epoch": manager.replay.epoch}
@@ -0,0 +1,104 @@
+"""SessionAuth: подпись initData, срок действия токена сессии и предельный возраст auth_date."""
+import hashlib
+import hmac
+import json
+from types import SimpleNamespace
+from urllib.parse import urlencode
+
+import pytest
+
+import webapp_auth
+from webapp_auth import AuthError, SessionAuth, webapp_secret
+
+BOT_TOKEN = "123:test"
+NOW = 1_800_000_000
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = SimpleNamespace(now=float(NOW))
+    monkeypatch.setattr(webapp_auth, "time", SimpleNamespace(time=lambda: clock.now))
+    return clock
+
+
+def init_data(auth_date: int, user: dict = None, bot_token: str = BOT_TOKEN) -> str:
+    """initData так, как его подписывает Telegram."""
+    fields = {"auth_date": str(auth_date), "query_id": "AAE",
+              "user": json.dumps(user or {"id": 42, "first_name": "Анна", "last_name": "К"})}
+    check_string = "\n".join(f"{key}={value}" for key, value in sorted(fields.items()))
+    fields["hash"] = hmac.new(webapp_secret(bot_token), check_string.encode(), hashlib.sha256).hexdigest()
+    return urlencode(fields)
+
+
+def test_init_data_is_verified(clock):
+    auth = SessionAuth(BOT_TOKEN, max_age=3600, token_ttl=900)
+    session = auth.verify_init_data(init_data(NOW - 10))
+
+    assert session == {"user_id": 42, "user_name": "Анна К", "auth_date": NOW - 10, "verified_by": "init_data"}
+
+
+def test_init_data_signed_by_other_bot_is_rejected(clock):
+    auth = SessionAuth(BOT_TOKEN, max_age=3600, token_ttl=900)
+    with pytest.raises(AuthError):
+        auth.verify_init_data(init_data(NOW, bot_token="999:other"))
+    assert auth.rejected["signature"] == 1
+
+
+def test_stale_init_data_is_rejected(clock):
+    auth = SessionAuth(BOT_TOKEN, max_age=3600, token_ttl=900)
+    with pytest.raises(AuthError, match="auth_date"):
+        auth.verify_init_data(init_data(NOW - 3601))
+    assert auth.rejected["expired"] == 1
+
+
+def test_token_round_trip(clock):
+    auth = SessionAuth(BOT_TOKEN, max_age=3600, token_ttl=900)
+    session = auth.verify_init_data(init_data(NOW))
+    issued = auth.issue_token(session)
+
+    assert issued["expires_in"] == 900
+    assert auth.verify_token(issued["token"]) == {**session, "verified_by": "token"}
+
+
+def test_tampered_token_is_rejected(clock):
+    auth = SessionAuth(BOT_TOKEN, max_age=3600, token_ttl=900)
+    token = auth.issue_token(auth.verify_init_data(init_data(NOW)))["token"]
+    signature = token.partition(".")[2]
+    forged = webapp_auth._b64encode(json.dumps({"uid": 1, "name": "x", "auth": NOW, "exp": NOW + 900}).encode())
+
+    with pytest.raises(AuthError):
+        auth.verify_token(f"{forged}.{signature}")
+    with pytest.raises(AuthError):
+        SessionAuth("999:other", max_age=3600, token_ttl=900).verify_token(token)
+
+
+def test_token_expires_after_ttl(clock):
+    auth = SessionAuth(BOT_TOKEN, max_age=86400, token_ttl=900)
+    token = auth.issue_token(auth.verify_init_data(init_data(NOW)))["token"]
+
+    clock.now += 899
+    auth.verify_token(token)
+    clock.now += 1
+    with pytest.raises(AuthError, match="истек"):
+        auth.verify_token(token)
+
+
+def test_token_does_not_outlive_auth_date_max_age(clock):
+    auth = SessionAuth(BOT_TOKEN, max_age=3600, token_ttl=900)
+    session = auth.verify_init_data(init_data(NOW - 3300))
+    issued = auth.issue_token(session)
+
+    assert issued["expires_in"] == 300
+    clock.now += 300
+    with pytest.raises(AuthError):
+        auth.verify_token(issued["token"])
+
+
+def test_rejected_token_falls_back_to_init_data(clock):
+    auth = SessionAuth(BOT_TOKEN, max_age=3600, token_ttl=900)
+
+    session = auth.authenticate("broken.token", init_data(NOW))
+    assert session["verified_by"] == "init_data"
+    with pytest.raises(AuthError):
+        auth.authenticate("broken.token", None)
+    assert auth.authenticate(None, None) is None
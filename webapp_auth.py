@@ -0,0 +1,146 @@
+import base64
+import hashlib
+import hmac
+import json
+import time
+from functools import lru_cache
+from typing import Optional
+from urllib.parse import parse_qsl
+
+from config import logger, TELEGRAM_BOT_TOKEN, WS_INIT_DATA_MAX_AGE, WS_SESSION_TOKEN_TTL
+
+
+class AuthError(Exception):
+    """initData или токен сессии не прошли проверку - соединение закрывается с кодом 1008."""
+
+
+@lru_cache(maxsize=4)
+def webapp_secret(bot_token: str) -> bytes:
+    """Ключ проверки initData: HMAC-SHA256 токена бота с ключом "WebAppData" (считается один раз на токен)."""
+    return hmac.new(b"WebAppData", bot_token.encode(), hashlib.sha256).digest()
+
+
+@lru_cache(maxsize=4)
+def session_secret(bot_token: str) -> bytes:
+    """Ключ подписи токенов сессии; выводится из токена бота, поэтому одинаков на всех воркерах."""
+    return hmac.new(b"WebAppSession", bot_token.encode(), hashlib.sha256).digest()
+
+
+def _b64encode(data: bytes) -> str:
+    return base64.urlsafe_b64encode(data).rstrip(b"=").decode()
+
+
+def _b64decode(data: str) -> bytes:
+    return base64.urlsafe_b64decode(data + "=" * (-len(data) % 4))
+
+
+class SessionAuth:
+    """
+    Аутентификация клиента Mini App. Первое подключение проверяет подписанный Telegram initData (подпись
+    и свежесть auth_date - не старше max_age секунд) и получает короткоживущий токен сессии. При
+    переподключении клиент предъявляет токен: проверка - одна HMAC-подпись, без разбора initData
+    и без запроса пользователя в базе.
+
+    Токен содержит user_id, имя пользователя, исходный auth_date и срок действия (token_ttl секунд).
+    При каждом подключении выдается новый токен, но сессия не переживает auth_date + max_age: после
+    этого нужен свежий initData (повторный запуск Mini App).
+    """
+
+    def __init__(self, bot_token: str = TELEGRAM_BOT_TOKEN, max_age: float = WS_INIT_DATA_MAX_AGE,
+                 token_ttl: float = WS_SESSION_TOKEN_TTL):
+        self.bot_token = bot_token
+        self.max_age = max_age
+        self.token_ttl = token_ttl
+        self.init_data_checks = 0
+        self.token_checks = 0
+        self.issued = 0
+        self.rejected = {"signature": 0, "expired": 0, "malformed": 0}
+
+    def _reject(self, reason: str, message: str) -> AuthError:
+        self.rejected[reason] += 1
+        return AuthError(message)
+
+    def _check_age(self, auth_date: int, now: float):
+        if self.max_age > 0 and now - auth_date > self.max_age:
+            raise self._reject("expired", f"auth_date устарел на {now - auth_date - self.max_age:.0f} с")
+
+    def verify_init_data(self, init_data: str) -> dict:
+        """Проверяет initData и возвращает сессию {"user_id", "user_name", "auth_date", "verified_by"}."""
+        self.init_data_checks += 1
+        fields = dict(parse_qsl(init_data, keep_blank_values=True))
+        received_hash = fields.pop("hash", None)
+        if not received_hash or "user" not in fields:
+            raise self._reject("malformed", "в initData нет hash или user")
+        check_string = "\n".join(f"{key}={value}" for key, value in sorted(fields.items()))
+        computed_hash = hmac.new(webapp_secret(self.bot_token), check_string.encode(), hashlib.sha256).hexdigest()
+        if not hmac.compare_digest(computed_hash, received_hash):
+            raise self._reject("signature", "неверная подпись initData")
+        try:
+            auth_date = int(fields.get("auth_date", ""))
+            user_data = json.loads(fields["user"])
+            user_id = int(user_data["id"])
+        except (ValueError, KeyError, TypeError):
+            raise self._reject("malformed", "в initData нет auth_date или id пользователя")
+        self._check_age(auth_date, time.time())
+
+        user_name = user_data.get("username", "")
+        if not user_name:
+            user_name = user_data.get("first_name", "")
+            if "last_name" in user_data:
+                user_name += f" {user_data['last_name']}"
+        return {"user_id": user_id, "user_name": user_name, "auth_date": auth_date, "verified_by": "init_data"}
+
+    def issue_token(self, session: dict) -> dict:
+        """Подписанный токен сессии и срок его действия в секундах (для payload init/resume)."""
+        now = time.time()
+        expires_at = now + self.token_ttl
+        if self.max_age > 0:
+            expires_at = min(expires_at, session["auth_date"] + self.max_age)
+        body = _b64encode(json.dumps({"uid": session["user_id"], "name": session["user_name"],
+            "auth": session["auth_date"], "exp": int(expires_at)}, separators=(",", ":")).encode())
+        signature = _b64encode(hmac.new(session_secret(self.bot_token), body.encode(), hashlib.sha256).digest())
+        self.issued += 1
+        return {"token": f"{body}.{signature}", "expires_in": max(int(expires_at - now), 0)}
+
+    def verify_token(self, token: str) -> dict:
+        """Проверяет токен сессии и возвращает сессию в том же виде, что verify_init_data."""
+        self.token_checks += 1
+        body, _, signature = token.partition(".")
+        expected = _b64encode(hmac.new(session_secret(self.bot_token), body.encode(), hashlib.sha256).digest())
+        if not signature or not hmac.compare_digest(expected, signature):
+            raise self._reject("signature", "неверная подпись токена сессии")
+        try:
+            payload = json.loads(_b64decode(body))
+            session = {"user_id": int(payload["uid"]), "user_name": payload["name"],
+                "auth_date": int(payload["auth"]), "verified_by": "token"}
+            expires_at = float(payload["exp"])
+        except (ValueError, KeyError, TypeError):
+            raise self._reject("malformed", "поврежденный токен сессии")
+        now = time.time()
+        if now >= expires_at:
+            raise self._reject("expired", "срок действия токена сессии истек")
+        self._check_age(session["auth_date"], now)
+        return session
+
+    def authenticate(self, token: Optional[str], init_data: Optional[str]) -> Optional[dict]:
+        """
+        Сессия по токену, а если его нет или он не подошел - по initData. None - клиент не предъявил
+        ни того, ни другого; AuthError - предъявленные данные не прошли проверку.
+        """
+        if token:
+            try:
+                return self.verify_token(token)
+            except AuthError as e:
+                if not init_data:
+                    raise
+                logger.info(f"Токен сессии отклонен ({e}), проверяется initData")
+        if init_data:
+            return self.verify_init_data(init_data)
+        return None
+
+    def stats(self) -> dict:
+        return {"init_data_checks": self.init_data_checks, "token_checks": self.token_checks, "issued": self.issued,
+            "rejected": dict(self.rejected), "token_ttl": self.token_ttl, "init_data_max_age": self.max_age}
+
+
+session_auth = SessionAuth()
@@ -1,56 +1,603 @@
+import asyncio
+import html
 import json
 import os
+import time
 from aiogram import Bot, Dispatcher, types, F
 from aiogram.enums import ParseMode
 from aiogram.exceptions import TelegramBadRequest
 from aiogram.filters import CommandStart, Command
 from aiogram.types import Message, CallbackQuery, InlineKeyboardButton, InlineKeyboardMarkup, ReplyKeyboardRemove, \
-    ForumTopic, FSInputFile
+    ForumTopic, FSInputFile, InputMediaDocument, InputMediaPhoto, InputMediaVideo
 from datetime import datetime
 from fastapi import WebSocket
-from typing import Dict
+from collections import deque
+from typing import Callable, Deque, Dict, Iterable, List, Optional, Sequence, Set, Tuple, Union
 
-from config import logger
+from config import logger, WS_MAX_CONNECTIONS_PER_USER, WS_DELIVERY_BACKEND, WS_PRESENCE_TTL, WS_QUEUE_SIZE, \
+    WS_OVERFLOW_POLICY, WS_SEND_TIMEOUT, WS_BROADCAST_BATCH_SIZE, WS_REPLAY_BUFFER, WS_REPLAY_TTL, WS_PING_INTERVAL, \
+    WS_IDLE_TIMEOUT, WS_MSGPACK_ENABLED, WS_TELEGRAM_DIGEST_WINDOW
+from delivery import DeliveryBackend, create_delivery_backend
+from notification_buffer import NotificationBuffer
+from replay_log import ReplayLog, create_replay_log, is_sequenced
 from minio_storage import minio_storage
 
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
 bot = Bot(token=os.getenv("TELEGRAM_BOT_TOKEN"))
 
+# Закрытие сокетов соединений, закрытых сервером: ссылка нужна, иначе задачу может собрать сборщик мусора
+_closing_sockets: Set[asyncio.Task] = set()
+
+
+def _json_default(obj):
+    if isinstance(obj, datetime):
+        return obj.isoformat()
+    raise TypeError(f"Тип {type(obj).__name__} не сериализуется в JSON")
+
+
+def encode_message(message: dict) -> str:
+    """Сериализует сообщение в JSON-текст кадра: через orjson, если он установлен, иначе через json."""
+    if orjson is not None:
+        return orjson.dumps(message, default=_json_default, option=orjson.OPT_NON_STR_KEYS).decode()
+    return json.dumps(message, default=_json_default, ensure_ascii=False)
+
+
+class FrameCodec:
+    """
+    Формат исходящих кадров соединения. По умолчанию - JSON-текст; сообщение сериализуется один раз
+    (encode_message), и этот текст уходит во все JSON-соединения без изменений.
+    """
+
+    name = "json"
+    binary = False
+
+    def encode(self, message: Optional[dict], data: str) -> Union[str, bytes]:
+        return data
+
+
+class MsgpackCodec(FrameCodec):
+    """
+    Бинарные кадры MessagePack: меньше байт в сети за счет компактных чисел и строк без кавычек и
+    экранирования. Кадр упаковывается из исходного сообщения (из журнала повторной доставки - из JSON).
+    Последний результат запоминается, поэтому при рассылке одного сообщения (один и тот же объект data)
+    упаковка выполняется один раз на все msgpack-соединения.
+    """
+
+    name = "msgpack"
+    binary = True
 
-class ConnectionManager:
     def __init__(self):
-        self.active_connections: Dict[int, WebSocket] = {}
+        self._last: Tuple[Optional[str], bytes] = (None, b"")
+
+    def encode(self, message: Optional[dict], data: str) -> bytes:
+        last_data, last_packed = self._last
+        if data is last_data:
+            return last_packed
+        if message is None:
+            message = json.loads(data)
+        packed = msgpack.packb(message, default=_json_default)
+        self._last = (data, packed)
+        return packed
+
+
+JSON_CODEC = FrameCodec()
+# Имя подпротокола WebSocket (Sec-WebSocket-Protocol) -> формат кадров
+FRAME_CODECS: Dict[str, FrameCodec] = {"json": JSON_CODEC}
+if msgpack is not None:
+    FRAME_CODECS["msgpack"] = MsgpackCodec()
+
+
+# Промежуточные кадры, которые устаревают со следующим кадром того же потока (позиция в очереди, фрагмент
+# ответа AI - ai_done все равно несет полный текст). Только их можно выбросить при переполнении очереди.
+STATUS_FRAME_TYPES = ("ai_queue", "ai_chunk", "ping")
+OVERFLOW_POLICIES = ("drop_oldest", "coalesce", "disconnect")
+
+
+class OutboundFrame:
+    """
+    Кадр в очереди соединения: данные в формате соединения (JSON-текст или MessagePack) и исходное сообщение
+    (для объединения). Для кадров из журнала повторной доставки исходного сообщения нет - их нельзя
+    выбросить или объединить.
+    """
+
+    __slots__ = ("message", "data")
+
+    def __init__(self, message: Optional[dict], data: Union[str, bytes]):
+        self.message = message
+        self.data = data
+
+    @property
+    def type(self) -> Optional[str]:
+        return self.message.get("type") if self.message is not None else None
+
+    @property
+    def droppable(self) -> bool:
+        return self.type in STATUS_FRAME_TYPES
+
+    @property
+    def coalesce_key(self) -> Optional[tuple]:
+        if not self.droppable:
+            return None
+        return self.type, self.message.get("payload", {}).get("stream_id")
+
+
+class ClientConnection:
+    """
+    Одно WebSocket-соединение пользователя (вкладка или устройство). Исходящие сообщения складываются
+    в ограниченную очередь и отправляются отдельной задачей-писателем, поэтому отправитель никогда не ждет
+    сеть. Если клиент не успевает читать и очередь заполнена, срабатывает политика overflow_policy:
+    drop_oldest - выбросить самый старый промежуточный кадр (ai_queue, ai_chunk);
+    coalesce - объединить кадр с уже стоящим в очереди кадром того же потока (фрагменты ответа
+    склеиваются, позиция в очереди заменяется), а если такого нет - как drop_oldest;
+    disconnect - закрыть соединение. Если выбросить нечего, соединение закрывается при любой политике.
+
+    Кадры кодируются форматом codec, согласованным при подключении (JSON или MessagePack); входящие
+    сообщения клиента всегда JSON-текст.
+    """
+
+    def __init__(self, websocket: WebSocket, user_id: int, max_queue: int = WS_QUEUE_SIZE,
+                 overflow_policy: str = WS_OVERFLOW_POLICY, send_timeout: float = WS_SEND_TIMEOUT,
+                 on_close: Optional[Callable[["ClientConnection", int], None]] = None, held: bool = False,
+                 codec: FrameCodec = JSON_CODEC):
+        self.websocket = websocket
+        self.user_id = user_id
+        self.codec = codec
+        self.connected_at = time.time()
+        self.last_seen = time.monotonic()
+        self.max_queue = max_queue
+        self.overflow_policy = overflow_policy
+        self.send_timeout = send_timeout
+        self.on_close = on_close
+        self.queue: Deque[OutboundFrame] = deque()
+        self.closed = False
+        self.sent = 0
+        self.dropped = 0
+        self.coalesced = 0
+        self.max_depth = 0
+        self._wakeup = asyncio.Event()
+        self._released = asyncio.Event()
+        if not held:
+            self._released.set()
+        self._writer = asyncio.create_task(self._write_loop())
+
+    @property
+    def depth(self) -> int:
+        return len(self.queue)
+
+    def touch(self):
+        """Клиент прислал кадр (сообщение или pong) - соединение живое."""
+        self.last_seen = time.monotonic()
+
+    def enqueue(self, message: dict, data: str) -> bool:
+        """Ставит кадр в очередь без ожидания. False - соединение закрыто (или закрылось из-за переполнения)."""
+        if self.closed:
+            return False
+        frame = OutboundFrame(message, self.codec.encode(message, data))
+        if len(self.queue) >= self.max_queue and not self._make_room(frame):
+            return not self.closed
+        self.queue.append(frame)
+        self.max_depth = max(self.max_depth, len(self.queue))
+        self._wakeup.set()
+        return True
+
+    def _make_room(self, frame: OutboundFrame) -> bool:
+        """Освобождает место по политике переполнения. False - кадр не нужно добавлять в очередь."""
+        if self.overflow_policy == "coalesce" and self._coalesce(frame):
+            self.coalesced += 1
+            return False
+        if self.overflow_policy != "disconnect":
+            for index, queued in enumerate(self.queue):
+                if queued.droppable:
+                    del self.queue[index]
+                    self.dropped += 1
+                    return True
+        self.close(f"очередь исходящих сообщений переполнена ({self.max_queue})")
+        return False
+
+    def _coalesce(self, frame: OutboundFrame) -> bool:
+        key = frame.coalesce_key
+        if key is None:
+            return False
+        for index in range(len(self.queue) - 1, -1, -1):
+            queued = self.queue[index]
+            if queued.coalesce_key != key:
+                continue
+            if frame.type == "ai_chunk":
+                payload = dict(queued.message["payload"])
+                payload["delta"] = payload.get("delta", "") + frame.message["payload"].get("delta", "")
+                merged = {**queued.message, "payload": payload}
+                self.queue[index] = OutboundFrame(merged, self.codec.encode(merged, encode_message(merged)))
+            else:
+                del self.queue[index]
+                self.queue.append(frame)
+            return True
+        return False
+
+    def release(self, first_frames: Sequence[Tuple[Optional[dict], str]] = ()):
+        """
+        Ставит first_frames - пары (сообщение, JSON-текст) - в начало очереди и разрешает отправку
+        (для соединения, созданного с held=True).
+        """
+        frames = [OutboundFrame(message, self.codec.encode(message, data)) for message, data in first_frames]
+        self.queue.extendleft(reversed(frames))
+        self._released.set()
+        self._wakeup.set()
+
+    async def _write_loop(self):
+        await self._released.wait()
+        send = self.websocket.send_bytes if self.codec.binary else self.websocket.send_text
+        while True:
+            while not self.queue:
+                self._wakeup.clear()
+                await self._wakeup.wait()
+            frame = self.queue.popleft()
+            try:
+                await asyncio.wait_for(send(frame.data), self.send_timeout)
+                self.sent += 1
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                reason = "таймаут отправки" if isinstance(e, asyncio.TimeoutError) else f"ошибка отправки: {e}"
+                self.close(reason, code=1011)
+                return
+
+    def shutdown(self):
+        """
+        Останавливает писателя и сбрасывает очередь; сокет не трогает (клиент уже отключился). Ссылка на
+        менеджер тоже сбрасывается, чтобы закрытое соединение ничего не удерживало.
+        """
+        self.closed = True
+        self.queue.clear()
+        self.on_close = None
+        if self._writer is not asyncio.current_task():
+            self._writer.cancel()
+
+    def close(self, reason: str, code: int = 1013):
+        """
+        Закрывает соединение со стороны сервера: 1013 - переполнение очереди, 1011 - сбой отправки,
+        1001 - клиент не отвечает на ping.
+        """
+        if self.closed:
+            return
+        on_close = self.on_close
+        self.shutdown()
+        logger.warning(f"Соединение клиента {self.user_id} закрыто: {reason}")
+        task = asyncio.create_task(self._close_socket(code))
+        _closing_sockets.add(task)
+        task.add_done_callback(_closing_sockets.discard)
+        if on_close is not None:
+            on_close(self, code)
+
+    async def _close_socket(self, code: int):
+        try:
+            await self.websocket.close(code=code)
+        except Exception:
+            pass
+
+    def stats(self) -> dict:
+        return {"user_id": self.user_id, "protocol": self.codec.name, "depth": self.depth,
+            "max_depth": self.max_depth, "sent": self.sent, "dropped": self.dropped, "coalesced": self.coalesced}
+
+
+class ConnectionMetrics:
+    """Подключения и отключения за последнюю минуту, причины отключений и длительность завершенных сессий."""
+
+    WINDOW = 60.0
+
+    def __init__(self):
+        self.connects: Deque[float] = deque()
+        self.disconnects: Deque[float] = deque()
+        self.durations: Deque[float] = deque(maxlen=1000)
+        self.reasons: Dict[str, int] = {}
+
+    def _trim(self, events: Deque[float], now: float):
+        while events and now - events[0] > self.WINDOW:
+            events.popleft()
+
+    def connected(self):
+        now = time.monotonic()
+        self.connects.append(now)
+        self._trim(self.connects, now)
+
+    def disconnected(self, connection: ClientConnection, reason: str):
+        now = time.monotonic()
+        self.disconnects.append(now)
+        self._trim(self.disconnects, now)
+        self.durations.append(time.time() - connection.connected_at)
+        self.reasons[reason] = self.reasons.get(reason, 0) + 1
+
+    def stats(self) -> dict:
+        now = time.monotonic()
+        self._trim(self.connects, now)
+        self._trim(self.disconnects, now)
+        ordered = sorted(self.durations)
+
+        def percentile(q: float) -> Optional[float]:
+            return ordered[max(int(len(ordered) * q + 0.999999) - 1, 0)] if ordered else None
+
+        return {"connects_per_minute": len(self.connects), "disconnects_per_minute": len(self.disconnects),
+            "disconnect_reasons": dict(self.reasons),
+            "session_seconds": {"count": len(ordered), "avg": sum(ordered) / len(ordered) if ordered else None,
+                "p50": percentile(0.5), "p95": percentile(0.95), "max": ordered[-1] if ordered else None}}
+
+
+class ConnectionManager:
+    """
+    Реестр WebSocket-соединений: у пользователя может быть несколько соединений (вкладки, устройства),
+    не больше max_per_user; при превышении закрывается самое старое. Соединения на других воркерах
+    обслуживаются через бэкенд доставки (см. delivery.py). Отправка только ставит сообщение в очередь
+    соединения (см. ClientConnection), сеть ждет писатель соединения.
+
+    Раз в ping_interval секунд всем соединениям отправляется ping (клиент отвечает pong, а по отсутствию
+    ping сам замечает, что сервер пропал); соединение, молчащее дольше idle_timeout, считается мертвым (в том числе
+    полуоткрытое - отправка в него не падает) и закрывается, чтобы сообщения сразу уходили в Telegram.
+
+    Если ни одно соединение не приняло сообщение, оно уходит пользователю в Telegram - не сразу, а сводкой
+    через буфер уведомлений (см. notification_buffer.py): все, что пришло за telegram_digest_window секунд,
+    отправляется одним сообщением (вложения - альбомами), а если пользователь за это время подключился -
+    не отправляется вовсе.
+
+    Формат кадров выбирается при подключении через подпротокол WebSocket: клиент перечисляет поддерживаемые
+    (например, "msgpack", "json") в порядке предпочтения, сервер принимает первый разрешенный. Клиент без
+    подпротокола получает JSON. Сжатие permessage-deflate договаривается сервером uvicorn (WS_PER_MESSAGE_DEFLATE)
+    и от формата не зависит.
+    """
+
+    # Коды закрытия со стороны сервера (см. ClientConnection.close) -> причина отключения в метриках
+    CLOSE_REASONS = {1013: "overflow", 1011: "send_error", 1001: "idle"}
+
+    def __init__(self, max_per_user: int = WS_MAX_CONNECTIONS_PER_USER, delivery: Optional[DeliveryBackend] = None,
+                 max_queue: int = WS_QUEUE_SIZE, overflow_policy: str = WS_OVERFLOW_POLICY,
+                 send_timeout: float = WS_SEND_TIMEOUT, replay: Optional[ReplayLog] = None,
+                 ping_interval: float = WS_PING_INTERVAL, idle_timeout: float = WS_IDLE_TIMEOUT,
+                 msgpack_enabled: bool = WS_MSGPACK_ENABLED,
+                 telegram_digest_window: float = WS_TELEGRAM_DIGEST_WINDOW):
+        self.active_connections: Dict[int, List[ClientConnection]] = {}
+        self.max_per_user = max_per_user
+        self.delivery = delivery or create_delivery_backend(WS_DELIVERY_BACKEND, WS_PRESENCE_TTL)
+        self.replay = replay or create_replay_log(WS_DELIVERY_BACKEND, max_frames=WS_REPLAY_BUFFER, ttl=WS_REPLAY_TTL)
+        if overflow_policy not in OVERFLOW_POLICIES:
+            logger.error(f"Неизвестная политика переполнения очереди {overflow_policy}, используется drop_oldest")
+            overflow_policy = "drop_oldest"
+        self.max_queue = max_queue
+        self.overflow_policy = overflow_policy
+        self.send_timeout = send_timeout
+        self.ping_interval = ping_interval
+        self.idle_timeout = idle_timeout
+        if msgpack_enabled and "msgpack" not in FRAME_CODECS:
+            logger.warning("Протокол MessagePack недоступен: пакет msgpack не установлен, используется JSON")
+        self.codecs = {name: codec for name, codec in FRAME_CODECS.items() if msgpack_enabled or not codec.binary}
+        self.protocol_connects: Dict[str, int] = {}
+        self.notifications = NotificationBuffer(self._send_telegram_digest, window=telegram_digest_window)
+        self.metrics = ConnectionMetrics()
+        self._heartbeat_task: Optional[asyncio.Task] = None
+        self.pings = 0
+        self.reaped = 0
+        self.total_connects = 0
+        self.evicted = 0
+        self.send_failures = 0
+        self.overflow_disconnects = 0
+        self.telegram_fallbacks = 0
         logger.info("Менеджер WebSocket соединений инициализирован.")
 
-    async def connect(self, websocket: WebSocket, user_id: int):
-        await websocket.accept()
-        self.active_connections[user_id] = websocket
-        logger.info(f"Клиент {user_id} подключился через WebSocket.")
+    async def start(self):
+        await self.replay.start()
+        await self.delivery.start(self._deliver_local)
+        if self.ping_interval > 0:
+            self._heartbeat_task = asyncio.create_task(self._heartbeat())
+
+    async def stop(self):
+        if self._heartbeat_task is not None:
+            self._heartbeat_task.cancel()
+            self._heartbeat_task = None
+        await self.notifications.stop()
+        await self.delivery.stop()
+
+    async def _heartbeat(self):
+        while True:
+            await asyncio.sleep(self.ping_interval)
+            try:
+                self.check_connections()
+            except Exception as e:
+                logger.error(f"Ошибка проверки WebSocket соединений: {e}")
+
+    def check_connections(self):
+        """Закрывает соединения, молчащие дольше idle_timeout (0 - не закрывать), остальным отправляет ping."""
+        now = time.monotonic()
+        ping = {"type": "ping", "payload": {"interval": self.ping_interval}}
+        serialized_ping = encode_message(ping)
+        for connections in list(self.active_connections.values()):
+            for connection in list(connections):
+                idle = now - connection.last_seen
+                if self.idle_timeout > 0 and idle >= self.idle_timeout:
+                    self.reaped += 1
+                    connection.close(f"нет ответа {idle:.0f} с", code=1001)
+                else:
+                    self.pings += 1
+                    connection.enqueue(ping, serialized_ping)
+
+    def negotiate_protocol(self, websocket: WebSocket) -> Tuple[FrameCodec, Optional[str]]:
+        """Формат кадров и подпротокол для ответа клиенту (None - клиент подпротокол не запрашивал)."""
+        for name in websocket.scope.get("subprotocols") or ():
+            codec = self.codecs.get(name)
+            if codec is not None:
+                return codec, name
+        return JSON_CODEC, None
+
+    async def connect(self, websocket: WebSocket, user_id: int, held: bool = False) -> ClientConnection:
+        """
+        Регистрирует соединение. С held=True сообщения копятся в очереди, но не отправляются до open_session:
+        так init или пропущенные кадры гарантированно уходят клиенту раньше кадров, пришедших в это время.
+        """
+        codec, subprotocol = self.negotiate_protocol(websocket)
+        await websocket.accept(subprotocol=subprotocol)
+        connection = ClientConnection(websocket, user_id, self.max_queue, self.overflow_policy, self.send_timeout,
+            on_close=self._on_connection_closed, held=held, codec=codec)
+        self.protocol_connects[codec.name] = self.protocol_connects.get(codec.name, 0) + 1
+        connections = self.active_connections.setdefault(user_id, [])
+        connections.append(connection)
+        self.delivery.track(user_id, 1)
+        self.total_connects += 1
+        self.metrics.connected()
+        self.notifications.cancel(user_id)
+        while len(connections) > self.max_per_user:
+            oldest = connections.pop(0)
+            oldest.shutdown()
+            self.delivery.track(user_id, -1)
+            self.metrics.disconnected(oldest, "evicted")
+            self.evicted += 1
+            logger.info(f"Клиент {user_id}: превышен лимит соединений ({self.max_per_user}), "
+                        f"старое соединение закрыто.")
+            try:
+                await oldest.websocket.close(code=1008)
+            except Exception:
+                pass
+        logger.info(f"Клиент {user_id} подключился через WebSocket (соединений: {len(connections)}).")
+        return connection
+
+    def disconnect(self, connection: ClientConnection, reason: str = "client"):
+        """Убирает из реестра только указанное соединение; остальные соединения пользователя остаются."""
+        connection.shutdown()
+        connections = self.active_connections.get(connection.user_id)
+        if connections and connection in connections:
+            connections.remove(connection)
+            self.delivery.track(connection.user_id, -1)
+            self.metrics.disconnected(connection, reason)
+            if not connections:
+                del self.active_connections[connection.user_id]
+            logger.info(f"Клиент {connection.user_id} отключился от WebSocket (осталось соединений: "
+                        f"{len(connections)}).")
+
+    def is_connected(self, user_id: int) -> bool:
+        return bool(self.active_connections.get(user_id))
+
+    def _on_connection_closed(self, connection: ClientConnection, code: int):
+        reason = self.CLOSE_REASONS.get(code, "server")
+        if reason == "overflow":
+            self.overflow_disconnects += 1
+        elif reason == "send_error":
+            self.send_failures += 1
+        self.disconnect(connection, reason)
+
+    async def send_to_connection(self, connection: ClientConnection, message: dict) -> bool:
+        """Ставит сообщение в очередь одного соединения (например, init для только что открытой вкладки)."""
+        return connection.enqueue(message, encode_message(message))
 
-    def disconnect(self, user_id: int):
-        if user_id in self.active_connections:
-            del self.active_connections[user_id]
-            logger.info(f"Клиент {user_id} отключился от WebSocket.")
+    def open_session(self, connection: ClientConnection, first_message: dict, replayed: Sequence[str] = ()):
+        """Отправляет первым init (или resume и пропущенные кадры) и открывает очередь соединения."""
+        frames = [(first_message, encode_message(first_message))]
+        frames.extend((None, data) for data in replayed)
+        connection.release(frames)
 
-    def _serialize_datetime(self, obj):
-        if isinstance(obj, datetime):
-            return obj.isoformat()
-        return obj
+    async def replay_position(self, chat_id: str) -> dict:
+        """Номер последнего кадра чата и epoch журнала - клиент получает их в init."""
+        return {"seq": await self.replay.position(chat_id), "epoch": self.replay.epoch}
 
-    async def send_personal_message(self, message: dict, user_id: int):
-        if user_id in self.active_connections:
-            websocket = self.active_connections[user_id]
+    async def missed_frames(self, chat_id: str, last_seq: int, epoch: Optional[str]) -> Optional[List[str]]:
+        """Кадры чата после last_seq или None, если продолжить нельзя и клиенту нужен полный init."""
+        missed = None
+        if epoch == self.replay.epoch:
             try:
-                serialized_message = json.dumps(message, default=self._serialize_datetime)
-                await websocket.send_text(serialized_message)
-                logger.debug(f"Сообщение отправлено клиенту {user_id} через WebSocket: {message}")
+                missed = await self.replay.since(chat_id, last_seq)
             except Exception as e:
-                logger.error(f"Ошибка отправки сообщения клиенту {user_id} через WebSocket: {e}")
-                await self._send_telegram_message(user_id, message)
+                logger.error(f"Не удалось прочитать журнал доставки чата {chat_id}: {e}")
+        if missed is None:
+            self.replay.full_inits += 1
+            return None
+        self.replay.replayed += len(missed)
+        return [data for _, data in missed]
+
+    async def _sequence(self, message: dict) -> Tuple[dict, str]:
+        """Присваивает сообщению номер в чате и записывает его в журнал повторной доставки."""
+        chat_id = message["payload"]["chat_id"]
+        try:
+            seq = await self.replay.next_seq(chat_id)
+        except Exception as e:
+            logger.error(f"Не удалось получить номер сообщения в чате {chat_id}: {e}")
+            return message, encode_message(message)
+        message = {**message, "payload": {**message["payload"], "seq": seq}}
+        serialized_message = encode_message(message)
+        try:
+            await self.replay.append(chat_id, seq, serialized_message)
+        except Exception as e:
+            logger.error(f"Не удалось записать сообщение {seq} чата {chat_id} в журнал доставки: {e}")
+        return message, serialized_message
+
+    def _enqueue_local(self, user_id: int, message: dict, serialized_message: str) -> bool:
+        connections = list(self.active_connections.get(user_id, ()))
+        results = [connection.enqueue(message, serialized_message) for connection in connections]
+        return any(results)
+
+    async def _deliver_local(self, user_id: int, serialized_message: str) -> bool:
+        """Доставка сообщения, пришедшего от другого воркера, во все соединения пользователя на этом воркере."""
+        if not self.active_connections.get(user_id):
+            return False
+        return self._enqueue_local(user_id, json.loads(serialized_message), serialized_message)
+
+    async def send_personal_message(self, message: dict, user_id: int, telegram_fallback: bool = True) -> bool:
+        """
+        Отправляет сообщение во все соединения пользователя одновременно; ошибка в одном соединении не
+        влияет на остальные. Если пользователь подключен к другому воркеру, сообщение публикуется через
+        бэкенд доставки. Если ни одно соединение не приняло сообщение, оно дублируется в Telegram,
+        кроме случаев telegram_fallback=False (например, промежуточные фрагменты ответа AI).
+        Сообщения чата получают номер seq и попадают в журнал повторной доставки (см. replay_log.py).
+        Возвращает True, если сообщение доставлено (или передано другому воркеру).
+        """
+        if is_sequenced(message):
+            message, serialized_message = await self._sequence(message)
+        else:
+            serialized_message = encode_message(message)
+        delivered = self._enqueue_local(user_id, message, serialized_message)
+        if await self.delivery.has_remote_connections(user_id):
+            try:
+                await self.delivery.publish(user_id, serialized_message)
+                delivered = True
+            except Exception as e:
+                logger.error(f"Не удалось передать сообщение клиенту {user_id} через другой воркер: {e}")
+        if delivered:
+            logger.debug(f"Сообщение {message.get('type')} отправлено клиенту {user_id} через WebSocket")
         else:
             logger.warning(f"Попытка отправки сообщения отключенному клиенту {user_id}")
-            await self._send_telegram_message(user_id, message)
+        if not delivered and telegram_fallback:
+            self.telegram_fallbacks += 1
+            await self.notifications.add(user_id, message)
+        return delivered
+
+    def stats(self) -> dict:
+        connections = [connection for user_connections in self.active_connections.values()
+            for connection in user_connections]
+        deepest = sorted(connections, key=lambda c: c.depth, reverse=True)[:5]
+        return {"users": len(self.active_connections), "connections": len(connections),
+            "max_per_user": self.max_per_user, "total_connects": self.total_connects, "evicted": self.evicted,
+            "send_failures": self.send_failures, "telegram_fallbacks": self.telegram_fallbacks,
+            "heartbeat": {"ping_interval": self.ping_interval, "idle_timeout": self.idle_timeout, "pings": self.pings,
+                "reaped": self.reaped}, **self.metrics.stats(),
+            "protocols": {"available": list(self.codecs), "connects": dict(self.protocol_connects),
+                "active": {name: sum(c.codec.name == name for c in connections) for name in self.codecs}},
+            "queue": {"max_size": self.max_queue, "overflow_policy": self.overflow_policy,
+                "depth": sum(c.depth for c in connections), "max_depth": max((c.max_depth for c in connections),
+                    default=0), "dropped": sum(c.dropped for c in connections),
+                "coalesced": sum(c.coalesced for c in connections), "overflow_disconnects": self.overflow_disconnects,
+                "deepest": [c.stats() for c in deepest if c.depth]},
+            "delivery": self.delivery.stats(), "replay": self.replay.stats(),
+            "telegram": {"fallbacks": self.telegram_fallbacks, **self.notifications.stats()}}
+
+    def _open_chat_keyboard(self) -> InlineKeyboardMarkup:
+        web_app_url = os.getenv("WEB_APP_URL")
+        return InlineKeyboardMarkup(inline_keyboard=[
+            [InlineKeyboardButton(text="Открыть чат ВАША КОМПАНИЯ", web_app=types.WebAppInfo(url=web_app_url))]])
 
-    async def _send_telegram_message(self, user_id: int, message: dict):
+    async def _send_telegram_message(self, user_id: int, message: dict) -> int:
+        """Отправляет одно сообщение в Telegram; возвращает число вызовов API."""
         try:
             if message["type"] == "message":
                 text = f"🔔 У вас новое сообщение в чате!\n\n"
@@ -62,9 +609,8 @@ class ConnectionManager:
             else:
                 text = f"🔔 У вас новое уведомление в чате!\n\nОткройте чат, чтобы продолжить."
 
-            web_app_url = os.getenv("WEB_APP_URL")
-            keyboard = InlineKeyboardMarkup(inline_keyboard=[
-                [InlineKeyboardButton(text="Открыть чат ВАША КОМПАНИЯ", web_app=types.WebAppInfo(url=web_app_url))]])
+            keyboard = self._open_chat_keyboard()
+            calls = 1
 
             if message["type"] == "message" and "media" in message["payload"]:
                 media = message["payload"]["media"]
@@ -79,21 +625,130 @@ class ConnectionManager:
                 elif media["type"] == "video_note":
                     await bot.send_video_note(chat_id=user_id, video_note=file_url)
                     await bot.send_message(chat_id=user_id, text=text, reply_markup=keyboard)
+                    calls = 2
                 elif media["type"] == "document":
                     await bot.send_document(chat_id=user_id, document=file_url, caption=text, reply_markup=keyboard)
             else:
                 await bot.send_message(chat_id=user_id, text=text, parse_mode="HTML", reply_markup=keyboard)
 
             logger.info(f"Сообщение отправлено клиенту {user_id} через Telegram")
+            return calls
         except Exception as e:
             logger.error(f"Ошибка отправки сообщения клиенту {user_id} через Telegram: {e}")
+            return 0
 
-    async def broadcast(self, message: str):
-        for user_id, connection in self.active_connections.items():
-            try:
-                await connection.send_text(message)
-            except Exception as e:
-                logger.error(f"Ошибка широковещательной отправки клиенту {user_id}: {e}")
+    # Сколько символов текста одного сообщения и всей сводки помещается в сообщение Telegram (лимит 4096)
+    DIGEST_LINE_LIMIT = 300
+    DIGEST_TEXT_LIMIT = 3500
+
+    async def _send_telegram_digest(self, user_id: int, messages: List[dict]) -> int:
+        """
+        Отправляет накопленные сообщения сводкой: фото и видео (и отдельно документы) - альбомами до 10 штук,
+        голосовые и видео-кружки - по одному (в альбом они не входят), тексты - одним сообщением с кнопкой
+        открытия чата. Если пользователь тем временем подключился (в том числе к другому воркеру), ничего
+        не отправляет. Возвращает число вызовов Telegram API.
+        """
+        if self.is_connected(user_id) or await self.delivery.has_remote_connections(user_id):
+            return 0
+        if len(messages) == 1:
+            return await self._send_telegram_message(user_id, messages[0])
+
+        lines = []
+        attachments = []
+        for message in messages:
+            payload = message.get("payload", {})
+            if message["type"] == "message":
+                media = payload.get("media")
+                if media:
+                    attachments.append(media)
+                line = payload.get("text") or (media or {}).get("caption") or ("📎 Вложение" if media else "")
+            elif message["type"] == "status_update":
+                line = payload.get("message", "")
+            else:
+                line = "Новое уведомление в чате"
+                if line in lines:
+                    continue
+            if line:
+                lines.append(line)
+
+        calls = 0
+        try:
+            calls += await self._send_telegram_attachments(user_id, attachments)
+            text = f"🔔 Новые сообщения в чате ({len(messages)}):\n"
+            for index, line in enumerate(lines):
+                if len(line) > self.DIGEST_LINE_LIMIT:
+                    line = line[:self.DIGEST_LINE_LIMIT] + "…"
+                entry = f"\n• {html.escape(line)}"
+                if len(text) + len(entry) > self.DIGEST_TEXT_LIMIT:
+                    text += f"\n… и еще {len(lines) - index}"
+                    break
+                text += entry
+            text += "\n\nОткройте чат, чтобы ответить."
+            await bot.send_message(chat_id=user_id, text=text, parse_mode="HTML",
+                reply_markup=self._open_chat_keyboard())
+            calls += 1
+            logger.info(f"Сводка из {len(messages)} сообщений отправлена клиенту {user_id} через Telegram "
+                        f"({calls} вызовов API)")
+        except Exception as e:
+            logger.error(f"Ошибка отправки сводки клиенту {user_id} через Telegram: {e}")
+        return calls
+
+    async def _send_telegram_attachments(self, user_id: int, attachments: List[dict]) -> int:
+        """Отправляет вложения сводки; возвращает число вызовов Telegram API."""
+        calls = 0
+        visual = []
+        documents = []
+        for media in attachments:
+            file_url = minio_storage.get_presigned_url(media["file_id"])
+            if media["type"] == "photo":
+                visual.append(InputMediaPhoto(media=file_url))
+            elif media["type"] == "video":
+                visual.append(InputMediaVideo(media=file_url))
+            elif media["type"] == "document":
+                documents.append(InputMediaDocument(media=file_url))
+            elif media["type"] == "voice":
+                await bot.send_voice(chat_id=user_id, voice=file_url)
+                calls += 1
+            elif media["type"] == "video_note":
+                await bot.send_video_note(chat_id=user_id, video_note=file_url)
+                calls += 1
+        for group in (visual, documents):
+            for start in range(0, len(group), 10):
+                album = group[start:start + 10]
+                if len(album) == 1:
+                    item = album[0]
+                    if isinstance(item, InputMediaPhoto):
+                        await bot.send_photo(chat_id=user_id, photo=item.media)
+                    elif isinstance(item, InputMediaVideo):
+                        await bot.send_video(chat_id=user_id, video=item.media)
+                    else:
+                        await bot.send_document(chat_id=user_id, document=item.media)
+                else:
+                    await bot.send_media_group(chat_id=user_id, media=album)
+                calls += 1
+        return calls
+
+    async def broadcast(self, message: dict, user_ids: Optional[Iterable[int]] = None,
+                        batch_size: int = WS_BROADCAST_BATCH_SIZE) -> int:
+        """
+        Рассылает сообщение всем клиентам, подключенным к этому воркеру, или только пользователям user_ids
+        (например, db.get_active_chat_user_ids()). Сообщение сериализуется один раз на всех получателей;
+        после каждых batch_size соединений управление отдается циклу событий, чтобы писатели соединений
+        отправляли уже поставленные кадры, не дожидаясь конца обхода. Возвращает число соединений,
+        принявших сообщение.
+        """
+        serialized_message = encode_message(message)
+        targets = list(self.active_connections) if user_ids is None else user_ids
+        accepted = 0
+        processed = 0
+        for user_id in targets:
+            for connection in list(self.active_connections.get(user_id, ())):
+                accepted += connection.enqueue(message, serialized_message)
+                processed += 1
+                if processed % batch_size == 0:
+                    await asyncio.sleep(0)
+        logger.info(f"Рассылка {message.get('type')}: сообщение принято {accepted} соединениями из {processed}")
+        return accepted
 
 
 manager = ConnectionManager()